@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how logging affects the per-sample latency of worker threads.
+
+Each worker handles samples that take --work-ms milliseconds and log --lines INFO records per sample, one of them
+with a --payload sized error string, like the converters do. The handler formats every record and takes
+--handler-ms milliseconds to write it, standing in for a console or a CloudWatch handler. Records are handled on the
+worker threads ('direct') or queued for a single shipping thread ('pipeline', monitor.LogPipeline).
+
+    python -m benchmarks.log_overhead --workers 4 --samples 200
+"""
+import argparse
+import io
+import logging
+import statistics
+import time
+from threading import Thread, Lock
+
+from monitor.LogPipeline import LogPipeline, QUEUE_SIZE
+from monitor.TraceStore import percentile
+
+FORMAT = '%(levelname)-8s | %(asctime)s | %(threadName)10s | %(filename)-20s:(%(lineno)3s) %(funcName)-20s | %(message)s'
+
+
+class SlowHandler(logging.StreamHandler):
+    """Formats records into memory and waits a fixed time per record, serialized like a real stream"""
+
+    def __init__(self, delay: float):
+        super().__init__(io.StringIO())
+        self.delay = delay
+        self.setFormatter(logging.Formatter(FORMAT))
+
+    def emit(self, record):
+        super().emit(record)
+        time.sleep(self.delay)
+        self.stream.seek(0)
+        self.stream.truncate()
+
+
+def worker(logger: logging.Logger, args, latencies: list, lock: Lock):
+    error = {'exit_code': 1, 'stderr': 'x' * args.payload}
+    for i in range(args.samples):
+        start = time.perf_counter()
+        time.sleep(args.work_ms / 1000)
+        for line in range(args.lines - 1):
+            logger.info(f'Sample sample_{i}.d step {line}')
+        logger.info(f'\tConversion of sample_{i}.d failed: {str(error)}')
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+
+def run(mode: str, args) -> list:
+    logger = logging.getLogger(f'bench.{mode}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO if mode != 'off' else logging.WARNING)
+
+    pipeline = None
+    handler = SlowHandler(args.handler_ms / 1000)
+    if mode == 'pipeline':
+        pipeline = LogPipeline([handler], queue_size=args.queue_size, burst=args.burst)
+        logger.addHandler(pipeline.handler)
+        pipeline.start()
+    else:
+        logger.addHandler(handler)
+
+    latencies = []
+    lock = Lock()
+    threads = [Thread(target=worker, args=(logger, args, latencies, lock), name=f'Converter{x}')
+               for x in range(args.workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stats = pipeline.stats() if pipeline else {}
+    if pipeline:
+        pipeline.stop()
+    return sorted(latencies), stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=200, help='samples per worker')
+    parser.add_argument('--work-ms', type=float, default=5, help='time spent on each sample without logging')
+    parser.add_argument('--lines', type=int, default=6, help='log records per sample')
+    parser.add_argument('--payload', type=int, default=4096, help='characters of the error logged per sample')
+    parser.add_argument('--handler-ms', type=float, default=0.5, help='time the handler takes per record')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    parser.add_argument('--burst', type=int, default=0, help='sampling burst of the pipeline, 0 disables it')
+    args = parser.parse_args()
+
+    print(f'{args.workers} workers x {args.samples} samples, {args.work_ms}ms of work and {args.lines} records '
+          f'per sample, {args.handler_ms}ms per record in the handler')
+    print(f'{"mode":<10}{"mean":>10}{"p50":>10}{"p95":>10}{"p99":>10}  (ms per sample)')
+    for mode in ['off', 'direct', 'pipeline']:
+        latencies, stats = run(mode, args)
+        row = [statistics.mean(latencies)] + [percentile(latencies, p) for p in [50, 95, 99]]
+        print(f'{mode:<10}' + ''.join(f'{v * 1000:>10.2f}' for v in row) + (f'  {stats}' if stats else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,29 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import atexit
 import json
 import logging
 import os
 import platform
+import time
 
 import watchtower
 import yamlconf
 
+from monitor.LogPipeline import install_pipeline, QUEUE_SIZE, SAMPLE_INTERVAL, SAMPLE_BURST
 from monitor.Monitor import Monitor
-from monitor.QueueManager import QueueManager
+from monitor.PoolSupervisor import pool_bounds
+from monitor.QueueBackend import create_backend
+from monitor.QueueManager import QueueManager, MAX_RECEIVES
+from monitor.SampleLedger import SampleLedger, ledger_path
+from monitor.TraceStore import TraceStore, traces_path, format_report, format_lifecycle
 from monitor.client.BackendClient import BackendClient
+from monitor.client.StatusDispatcher import SENDERS
 
 fmt = '%(levelname)-8s | %(asctime)s | %(threadName)10s | %(filename)-20s:(%(lineno)3s) %(funcName)-20s | %(message)s'
 logging.basicConfig(format=fmt, level='INFO')
 logger = logging.getLogger()
 
-if not logger.handlers:
-    h = watchtower.CloudWatchLogHandler(
-        log_group_name=f'/lcb/monitor/{platform.node()}',
-        log_group_retention_days=3,
-        send_interval=30)
-    logger.addHandler(h)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -34,6 +35,16 @@ if __name__ == "__main__":
                         help='run in test mode, no data will be converted or sent to aws. This '
                              'overrides the -c option to use \'appconfig-test.yml\'')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--ledger-compact', action='store_true',
+                        help='remove entries of samples not uploaded or missing from the sample ledger and exit')
+    parser.add_argument('--ledger-export', type=str, metavar='FILE',
+                        help='export the sample ledger to a csv (or .jsonl) file and exit')
+    parser.add_argument('--report', action='store_true',
+                        help='print the p50/p95/p99 duration of each stage per instrument path and exit')
+    parser.add_argument('--window', type=float, default=24, metavar='HOURS',
+                        help='hours of traces included in the report (default: 24)')
+    parser.add_argument('--trace', type=str, metavar='SAMPLE',
+                        help='print the recorded stages of a sample and exit')
 
     args = parser.parse_args()
 
@@ -53,14 +64,53 @@ if __name__ == "__main__":
         config['test'] = args.test
         config['debug'] = args.debug
 
+    # basicConfig already added the console handler, CloudWatch is added next to it
+    try:
+        logger.addHandler(watchtower.CloudWatchLogHandler(
+            log_group_name=f'/lcb/monitor/{platform.node()}',
+            log_group_retention_days=3,
+            send_interval=30))
+    except Exception as ex:
+        logger.warning(f'Can\'t ship logs to CloudWatch: {str(ex)}')
+
+    # ship the records to the console and CloudWatch from a single thread, workers only queue them
+    logging_cfg = config['monitor'].get('logging', {})
+    pipeline = install_pipeline(logger,
+                                queue_size=logging_cfg.get('queue_size', QUEUE_SIZE),
+                                interval=logging_cfg.get('sample_interval', SAMPLE_INTERVAL),
+                                burst=logging_cfg.get('sample_burst', SAMPLE_BURST))
+    atexit.register(pipeline.stop)
+
+    if args.ledger_compact or args.ledger_export:
+        ledger = SampleLedger(ledger_path(config))
+        if args.ledger_compact:
+            ledger.compact()
+        if args.ledger_export:
+            logger.info(f'Exported {ledger.export(args.ledger_export)} samples to {args.ledger_export}')
+        exit(0)
+
+    if args.report or args.trace:
+        traces = TraceStore(traces_path(config), config['monitor']['paths'])
+        if args.report:
+            print(f'Stage durations in seconds, last {args.window:g} hours')
+            print(format_report(traces.report(since=time.time() - args.window * 3600)))
+        if args.trace:
+            print(format_lifecycle(traces.lifecycle(args.trace)))
+        exit(0)
+
     if os.path.exists(config['monitor']['msconvert']):
         logger.info('Found ProteoWizard')
     else:
         logger.error(f"Can't find ProteoWizard at {config['monitor']['msconvert']}")
         exit(1)
 
+    # one stasis connection per worker thread that can call the api at the same time
+    pool_size = config['backend'].get('pool_size',
+                                      pool_bounds(config, 'converters')[1] + pool_bounds(config, 'uploaders')[1] +
+                                      config['backend'].get('status', {}).get('senders', SENDERS))
     backend_cli = BackendClient(config, os.getenv(config['backend']['url_var'], "https://test-api.metabolomics.us"),
-                                os.getenv(config['backend']['api_key_var'], "9MjbJRbAtj8spCJJVTPbP3YWc4wjlW0c7AP47Pmi"))
+                                os.getenv(config['backend']['api_key_var'], "9MjbJRbAtj8spCJJVTPbP3YWc4wjlW0c7AP47Pmi"),
+                                pool_size=pool_size)
     if backend_cli:
         logger.info(f'Backend client initialized. (url: {backend_cli._url})')
 
@@ -69,6 +119,10 @@ if __name__ == "__main__":
         logger.debug('Configuration: ' + json.dumps(config, indent=2))
 
 
-    queue_mgr = QueueManager(stage)
+    queue_cfg = config['aws'].get('queue', {})
+    queue_mgr = QueueManager(stage, backend=create_backend(config),
+                             leases=queue_cfg.get('leases', False),
+                             max_receives=queue_cfg.get('max_receives', MAX_RECEIVES),
+                             fifo=queue_cfg.get('fifo', False))
 
     Monitor(config, backend_cli, queue_mgr).run()
@@ -1,29 +1,108 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
+import hashlib
 import logging
+import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from threading import Lock, BoundedSemaphore
 
 import boto3
 import botocore
 from botocore.exceptions import ClientError
 
+from monitor.BucketIndex import BucketIndex, INDEX_TTL, CRAWL_WORKERS
+from monitor.Metrics import UPLOADED_BYTES, UPLOAD_SECONDS, RETRIES
+from monitor.TraceStore import TraceStore, traced
+from monitor.exceptions import UploadVerificationException
+
+MB = 1024 * 1024
+CHUNK_SIZE_MB = 64  # multipart chunk size, S3 requires at least 5 MB
+MAX_CONCURRENCY = 8  # parallel part uploads, shared by all the users of a Bucket
+PART_RETRIES = 3
+UPLOAD_RETRIES = 2
+
 logger = logging.getLogger('BucketWorker')
 
 
+class TransferProgress:
+    """
+    Thread-safe upload progress callback that logs the transfer rate
+    """
+
+    def __init__(self, name, total: int, interval: float = 10):
+        """
+
+        Args:
+            name: name of the transferred file
+            total: size of the file in bytes
+            interval: seconds between progress log lines
+        """
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.sent = 0
+        self.start = time.monotonic()
+        self._last_log = self.start
+        self._lock = Lock()
+
+    def __call__(self, bytes_amount: int):
+        with self._lock:
+            self.sent += bytes_amount
+            now = time.monotonic()
+            if now - self._last_log < self.interval:
+                return
+            self._last_log = now
+
+        logger.info(f'\t\t{self.name}: {self.sent}/{self.total} bytes ({self.rate() / MB:.2f} MB/s)')
+
+    def rate(self) -> float:
+        """Bytes per second since the start of the transfer"""
+        return self.sent / max(time.monotonic() - self.start, 1e-6)
+
+
 class Bucket:
     """ this defines an easy access to a AWS bucket """
 
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, transfer: dict = None, index: dict = None, traces: TraceStore = None):
+        """
+
+        Args:
+            bucket_name: name of the S3 bucket
+            transfer: dict (Optional)
+                Upload settings: 'chunk_size_mb' (multipart chunk size) and 'max_concurrency' (parallel parts)
+            index: dict (Optional)
+                Settings of the local object index used by 'exists': 'enabled', 'ttl' (seconds), 'path' (file to
+                persist the index) and 'workers' (parallel listings). Without it every check is a HEAD request
+            traces: TraceStore (Optional)
+                Store of the sample spans, the completion and check of multipart uploads is saved as 'verify'
+        """
+        transfer = transfer or {}
         self.bucket_name = bucket_name
         self.s3 = boto3.resource('s3')
+        self.client = boto3.client('s3')
+        self.chunk_size = max(5, transfer.get('chunk_size_mb', CHUNK_SIZE_MB)) * MB
+        self.concurrency = transfer.get('max_concurrency', MAX_CONCURRENCY)
+        self.traces = traces
+
+        # shared by every thread uploading through this object
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='S3Part')
+
+        index = index or {}
+        self.index = BucketIndex(self.client, bucket_name,
+                                 ttl=index.get('ttl', INDEX_TTL),
+                                 path=index.get('path'),
+                                 workers=index.get('workers', CRAWL_WORKERS)) if index.get('enabled') else None
 
         try:
-            response = boto3.client('s3').list_buckets()
+            response = self.client.list_buckets()
 
             buckets = [bucket["Name"] for bucket in response['Buckets']]
             if not self.bucket_name in buckets:
-                boto3.client('s3').create_bucket(Bucket=self.bucket_name, CreateBucketConfiguration={
+                self.client.create_bucket(Bucket=self.bucket_name, CreateBucketConfiguration={
                     'LocationConstraint': 'us-west-2'})
                 logger.info(f'Created bucket: {self.bucket_name}')
             else:
@@ -31,23 +110,205 @@ class Bucket:
         except Exception as ex:
             logger.error(f'Error checking for destination bucket: {str(ex)}')
 
-    def save(self, filename):
+    def save(self, filename, callback=None):
         """
-            stores the specified file in the bucket
+            stores the specified file in the bucket, large files are uploaded in parallel parts.
+            Interrupted multipart uploads are resumed from the last uploaded part.
+            The md5 of every request is computed while reading the file and checked against the returned ETags,
+            an UploadVerificationException is raised on mismatch
         :param filename: the name of the file to be uploaded
+        :param callback: optional callable receiving the number of bytes sent (default: TransferProgress)
         :return:
         """
         remote_name = filename.split(os.sep)[-1]
+        size = os.path.getsize(filename)
+        progress = callback or TransferProgress(remote_name, size)
+
+        start = time.monotonic()
+        for attempt in range(1, UPLOAD_RETRIES + 1):
+            try:
+                logger.info(f'\tSaving file {remote_name} on {self.bucket_name}')
+                if size <= self.chunk_size:
+                    with open(filename, 'rb') as data:
+                        etag = self._put_object(remote_name, data.read())
+                    progress(size)
+                else:
+                    etag = self._multipart_upload(remote_name, filename, size, progress)
+
+                if self.index:
+                    self.index.put(remote_name, size, etag)
+
+                if isinstance(progress, TransferProgress):
+                    logger.info(f'\tUploaded {size} bytes at {progress.rate() / MB:.2f} MB/s')
+                UPLOADED_BYTES.inc(size)
+                UPLOAD_SECONDS.observe(time.monotonic() - start)
+                return remote_name
+            except ConnectionResetError as cre:
+                logger.error(f'Connection reset uploading {remote_name} (attempt {attempt}). {str(cre)}')
+                if attempt == UPLOAD_RETRIES:
+                    raise cre
+                RETRIES.labels('upload').inc()
+            except Exception as e:
+                raise e
+
+    def save_stream(self, key, stream, callback=None):
+        """
+            stores the content of a binary stream (ie: a process' stdout) in the bucket without writing it to disk.
+            Memory use is bounded to max_concurrency + 1 chunks. The upload is aborted if the stream can't be
+            fully uploaded
+        :param key: name of the object to create
+        :param stream: a readable binary file-like object
+        :param callback: optional callable receiving the number of bytes sent (default: TransferProgress)
+        :return: the name of the object
+        """
+        progress = callback or TransferProgress(key, -1)
+        start = time.monotonic()
+        data = stream.read(self.chunk_size)
+        next_data = stream.read(self.chunk_size) if len(data) == self.chunk_size else b''
+
+        logger.info(f'\tStreaming {key} to {self.bucket_name}')
+        if not next_data:
+            etag = self._put_object(key, data)
+            progress(len(data))
+            if self.index:
+                self.index.put(key, len(data), etag)
+            UPLOADED_BYTES.inc(len(data))
+            UPLOAD_SECONDS.observe(time.monotonic() - start)
+            return key
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key)['UploadId']
+        slots = BoundedSemaphore(self.concurrency)
+        futures = []
+        size = 0
         try:
-            # from https://boto3.readthedocs.io/en/latest/reference/services/s3.html#S3.Object.upload_file
-            logger.info(f'\tSaving file {remote_name} on {self.bucket_name}')
-            self.s3.Object(self.bucket_name, remote_name).upload_file(filename)
-            return remote_name
-        except ConnectionResetError as cre:
-            logger.error('Connection reset.', str(cre))
-            raise cre
-        except Exception as e:
-            raise e
+            number = 1
+            while data:
+                slots.acquire()
+                failed = next((f for f in futures if f.done() and f.exception()), None)
+                if failed:
+                    raise failed.exception()
+
+                future = self._executor.submit(self._send_part, key, upload_id, number, data, progress)
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+
+                number += 1
+                size += len(data)
+                data, next_data = next_data, stream.read(self.chunk_size) if next_data else b''
+
+            etag = self._complete_upload(key, upload_id, [f.result() for f in futures])
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+        if isinstance(progress, TransferProgress):
+            logger.info(f'\tStreamed {size} bytes at {progress.rate() / MB:.2f} MB/s')
+        if self.index:
+            self.index.put(key, size, etag)
+        UPLOADED_BYTES.inc(size)
+        UPLOAD_SECONDS.observe(time.monotonic() - start)
+        return key
+
+    def _put_object(self, key, data: bytes):
+        """Uploads an object in a single request, S3 checks the content against the md5 sent along"""
+        digest = hashlib.md5(data).digest()
+        response = self.client.put_object(Bucket=self.bucket_name, Key=key, Body=data,
+                                          ContentMD5=base64.b64encode(digest).decode('ascii'))
+        self._verify(key, digest.hex(), response['ETag'])
+        return response['ETag'].strip('"')
+
+    def _verify(self, key, expected: str, etag: str):
+        if etag.strip('"') != expected:
+            raise UploadVerificationException(key, expected, etag.strip('"'))
+
+    def _multipart_upload(self, key, filename, size, progress):
+        upload_id, done = self._find_upload(key, size)
+        if upload_id:
+            # parts of an earlier conversion or of a concurrent upload of the same key are sent again
+            stale = [n for n, etag in done.items() if etag.strip('"') != self._part_md5(filename, n)]
+            for n in stale:
+                del done[n]
+            logger.info(f'\tResuming upload of {key}, {len(done)} parts already uploaded, {len(stale)} stale')
+            progress(sum(min(self.chunk_size, size - (n - 1) * self.chunk_size) for n in done))
+        else:
+            upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=key)['UploadId']
+
+        futures = [self._executor.submit(self._upload_part, key, upload_id, filename, n, progress)
+                   for n in range(1, math.ceil(size / self.chunk_size) + 1) if n not in done]
+        # the upload is kept open on errors so it can be resumed
+        parts = [f.result() for f in futures]
+        parts += [{'PartNumber': n, 'ETag': etag} for n, etag in done.items()]
+
+        return self._complete_upload(key, upload_id, parts)
+
+    def _part_md5(self, filename, number) -> str:
+        """Hex md5 of a chunk of a local file, the ETag S3 gives to the part holding it"""
+        digest = hashlib.md5()
+        with open(filename, 'rb') as file:
+            file.seek((number - 1) * self.chunk_size)
+            remaining = self.chunk_size
+            while remaining:
+                data = file.read(min(remaining, MB))
+                if not data:
+                    break
+                digest.update(data)
+                remaining -= len(data)
+        return digest.hexdigest()
+
+    def _upload_part(self, key, upload_id, filename, number, progress) -> dict:
+        with open(filename, 'rb') as file:
+            file.seek((number - 1) * self.chunk_size)
+            data = file.read(self.chunk_size)
+
+        return self._send_part(key, upload_id, number, data, progress)
+
+    def _send_part(self, key, upload_id, number, data: bytes, progress) -> dict:
+        digest = hashlib.md5(data).digest()
+        for attempt in range(1, PART_RETRIES + 1):
+            try:
+                response = self.client.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                                   PartNumber=number, Body=data,
+                                                   ContentMD5=base64.b64encode(digest).decode('ascii'))
+                self._verify(f'{key} (part {number})', digest.hex(), response['ETag'])
+                progress(len(data))
+                return {'PartNumber': number, 'ETag': response['ETag']}
+            except (ConnectionResetError, botocore.exceptions.ConnectionError) as ex:
+                logger.warning(f'\t\tPart {number} of {key} failed (attempt {attempt}): {str(ex)}')
+                if attempt == PART_RETRIES:
+                    raise ConnectionResetError(f'Failed uploading part {number} of {key}') from ex
+                RETRIES.labels('upload').inc()
+
+    def _complete_upload(self, key, upload_id, parts: list):
+        parts = sorted(parts, key=lambda p: p['PartNumber'])
+        with traced(self.traces, key, 'verify'):
+            response = self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                                             MultipartUpload={'Parts': parts})
+
+            # the ETag of a multipart object is the md5 of the concatenated part md5s plus the number of parts
+            digests = b''.join(bytes.fromhex(p['ETag'].strip('"')) for p in parts)
+            self._verify(key, f'{hashlib.md5(digests).hexdigest()}-{len(parts)}', response['ETag'])
+        return response['ETag'].strip('"')
+
+    def _find_upload(self, key, size) -> tuple:
+        """
+        Finds an unfinished multipart upload of a key compatible with the current chunk size
+        :return: a tuple (upload id, {part number: etag}) or (None, {}) if there is nothing to resume
+        """
+        uploads = self.client.list_multipart_uploads(Bucket=self.bucket_name, Prefix=key).get('Uploads', [])
+        for upload in [u for u in uploads if u['Key'] == key]:
+            parts = self.client.list_parts(Bucket=self.bucket_name, Key=key,
+                                           UploadId=upload['UploadId']).get('Parts', [])
+            expected = {n: min(self.chunk_size, size - (n - 1) * self.chunk_size)
+                        for n in range(1, math.ceil(size / self.chunk_size) + 1)}
+            if all(expected.get(p['PartNumber']) == p['Size'] for p in parts):
+                return upload['UploadId'], {p['PartNumber']: p['ETag'] for p in parts}
+
+            logger.info(f'\tDiscarding incompatible upload of {key}')
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload['UploadId'])
+
+        return None, {}
 
     def exists(self, name) -> bool:
         """
@@ -56,6 +317,10 @@ class Bucket:
         :return:
         """
 
+        if self.index:
+            entry = self.index.get(name)
+            return entry is not None and datetime.now(timezone.utc) - entry[1] < timedelta(days=30)
+
         try:
             file = self.s3.Object(self.bucket_name, name)
             file.load()
@@ -77,7 +342,7 @@ class Bucket:
 
     def object_head(self, filename) -> bool:
         try:
-            boto3.client('s3').head_object(Bucket=self.bucket_name, Key=filename)
+            self.client.head_object(Bucket=self.bucket_name, Key=filename)
             logger.info(f"\tKey: '{filename}' found!")
             return True
         except botocore.exceptions.ClientError as e:
@@ -96,12 +361,15 @@ class Bucket:
         :return:
         """
         self.s3.Object(self.bucket_name, name).delete()
+        if self.index:
+            self.index.remove(name)
 
 
     def list(self):
         """
             lists the files in the raw data bucket
 
-        :return:
+        :return: a list with the objects' descriptions (Key, Size, LastModified, ETag, ...)
         """
-        return boto3.client('s3').list_objects(Bucket=self.bucket_name)
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name)
+        return [obj for page in pages for obj in page.get('Contents', [])]
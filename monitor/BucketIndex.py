@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from threading import Lock, Thread
+
+INDEX_TTL = 3600  # seconds before the index is crawled again
+CRAWL_WORKERS = 8
+# the key space is split at these characters and each range is listed in parallel
+BOUNDARIES = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+logger = logging.getLogger('BucketIndex')
+
+
+class BucketIndex:
+    """
+    In-memory index of the objects of a bucket (key -> (size, last modified, etag)).
+    It is built with a paginated list_objects_v2 crawl split by key ranges, updated by our own uploads and
+    crawled again when older than its TTL. It can be saved to disk to avoid crawling on every start
+    """
+
+    def __init__(self, client, bucket_name, ttl: int = INDEX_TTL, path: str = None, workers: int = CRAWL_WORKERS):
+        """
+
+        Args:
+            client:
+                A boto3 s3 client
+            bucket_name: str
+                Name of the bucket to index
+            ttl: int (Optional. Default: 3600)
+                Seconds before the index is refreshed
+            path: str (Optional. Default: None)
+                File where the index is saved after each crawl and loaded from on start
+            workers: int (Optional. Default: 8)
+                Number of key ranges listed in parallel
+        """
+        self.client = client
+        self.bucket_name = bucket_name
+        self.ttl = ttl
+        self.path = path
+        self.workers = workers
+
+        self._entries = {}
+        self._lock = Lock()
+        self._loaded_at = None
+        self._refreshing = Lock()
+        # key -> entry, or None if removed, of the changes made while a crawl is running
+        self._changes = None
+
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    def get(self, key):
+        """
+        Returns the (size, last modified, etag) of an object or None if it's not in the bucket.
+        The first call crawls the bucket, later calls trigger a background refresh when the index is stale
+        """
+        if self._loaded_at is None:
+            self.refresh(if_stale=True)
+        elif self.stale() and not self._refreshing.locked():
+            Thread(target=self.refresh, args=(True,), name='BucketIndexRefresh', daemon=True).start()
+
+        return self._entries.get(key)
+
+    def put(self, key, size: int, etag: str, last_modified: datetime = None):
+        """Adds or updates an object, used after our own uploads"""
+        entry = (size, last_modified or datetime.now(timezone.utc), etag)
+        with self._lock:
+            self._entries[key] = entry
+            if self._changes is not None:
+                self._changes[key] = entry
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._changes is not None:
+                self._changes[key] = None
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    def stale(self) -> bool:
+        return self._loaded_at is None or time.time() - self._loaded_at > self.ttl
+
+    def refresh(self, if_stale: bool = False):
+        """
+        Crawls the whole bucket and replaces the index, keeping the objects added or removed during the crawl
+        Args:
+            if_stale: only crawl if the index is still stale once the lock is taken, ie: another caller
+                      waiting on the same lock already crawled it
+        """
+        with self._refreshing:
+            if if_stale and not self.stale():
+                return
+
+            start = time.monotonic()
+            with self._lock:
+                self._changes = {}
+            try:
+                entries = self.crawl()
+            except BaseException:
+                with self._lock:
+                    self._changes = None
+                raise
+
+            with self._lock:
+                changes, self._changes = self._changes, None
+                for key, entry in changes.items():
+                    if entry is None:
+                        entries.pop(key, None)
+                    else:
+                        entries[key] = entry
+                self._entries = entries
+                self._loaded_at = time.time()
+
+            logger.info(f'Indexed {len(entries)} objects of {self.bucket_name} in {time.monotonic() - start:.1f}s')
+
+            if self.path:
+                self.save()
+
+    def crawl(self) -> dict:
+        """Lists all the objects of the bucket, splitting the key space in ranges listed in parallel"""
+        bounds = [None, *BOUNDARIES, None]
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+
+        entries = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='BucketCrawler') as pool:
+            for result in pool.map(lambda r: self._crawl_range(*r), ranges):
+                entries.update(result)
+
+        return entries
+
+    def _crawl_range(self, first, end) -> dict:
+        """Lists the keys k with first <= k < end, None means unbounded"""
+        kwargs = {'Bucket': self.bucket_name}
+        if first:
+            # keys are returned after StartAfter, use the highest key lower than 'first'
+            kwargs['StartAfter'] = chr(ord(first) - 1) + '\U0010ffff'
+
+        entries = {}
+        for page in self.client.get_paginator('list_objects_v2').paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                if end and obj['Key'] >= end:
+                    return entries
+                entries[obj['Key']] = (obj['Size'], obj['LastModified'], obj['ETag'].strip('"'))
+
+        return entries
+
+    def save(self):
+        with self._lock:
+            data = {'loaded_at': self._loaded_at,
+                    'entries': {k: [v[0], v[1].isoformat(), v[2]] for k, v in self._entries.items()}}
+
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(data, file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+
+            with self._lock:
+                self._entries = {k: (v[0], datetime.fromisoformat(v[1]), v[2]) for k, v in data['entries'].items()}
+                self._loaded_at = data['loaded_at']
+            logger.info(f'Loaded {len(self._entries)} objects of {self.bucket_name} from {self.path}')
+        except (OSError, ValueError, KeyError) as ex:
+            logger.warning(f'Can\'t load bucket index from {self.path}: {str(ex)}')
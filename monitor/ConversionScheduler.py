@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import logging
+import platform
+import re
+import time
+from collections import deque
+from queue import Empty
+from threading import Condition
+from typing import Callable, Optional
+
+import watchtower
+
+MB = 1024 ** 2
+SJF_RATE = 100 * MB  # bytes converted per second, turns a sample's size into an estimated conversion time
+AGING = 1  # seconds of priority gained per second waiting
+MAX_WAIT = 4 * 3600  # seconds a sample can wait before it's converted regardless of its priority
+
+logger = logging.getLogger('ConversionScheduler')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+def fifo_cost(path: str, size: int, mtime_ns: int) -> float:
+    """Samples are converted in arrival order"""
+    return 0
+
+
+def sjf_cost(path: str, size: int, mtime_ns: int) -> float:
+    """Shortest job first, estimated conversion time from the sample's size"""
+    return size / SJF_RATE
+
+
+def recency_cost(path: str, size: int, mtime_ns: int) -> float:
+    """Most recently acquired samples first"""
+    return time.time() - mtime_ns / 1e9 if mtime_ns else 0
+
+
+# policy name -> function returning the cost of a sample in seconds, lower costs are converted first
+POLICIES = {
+    'fifo': fifo_cost,
+    'sjf': sjf_cost,
+    'recency': recency_cost,
+}
+
+
+def register_policy(name: str, cost: Callable[[str, int, int], float]):
+    """Adds a scheduling policy, cost(path, size, mtime_ns) returns seconds, lower goes first"""
+    POLICIES[name] = cost
+
+
+class ConversionScheduler:
+    """
+    Priority queue of the samples ready to be converted, with the same get/put/qsize interface as queue.Queue.
+    A sample's priority is the cost given by the policy minus the boost of the first configured pattern its path
+    matches. Waiting samples gain priority over time (aging) and any sample waiting more than max_wait seconds is
+    converted next, so large or low priority samples are delayed but never starved
+    """
+
+    def __init__(self, policy: str = 'fifo', aging: float = AGING, max_wait: Optional[float] = MAX_WAIT,
+                 priorities: Optional[list] = None):
+        """
+
+        Args:
+            policy: str (Optional. Default: fifo)
+                Name of the scheduling policy, one of POLICIES
+            aging: float (Optional. Default: 1)
+                Seconds of priority gained per second waiting, 0 disables aging
+            max_wait: float (Optional. Default: 4 hours)
+                Seconds after which a sample is converted next, None disables it
+            priorities: list (Optional. Default: None)
+                List of {'pattern': regex, 'boost': seconds}, samples matching a pattern go ahead of samples
+                costing up to 'boost' seconds more
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Invalid scheduling policy "{policy}", options: {", ".join(POLICIES)}')
+
+        self.policy = policy
+        self.aging = aging
+        self.max_wait = max_wait
+        self.priorities = [(re.compile(p['pattern']), p.get('boost', 0)) for p in (priorities or [])]
+
+        # waiting samples gain 'aging' per second, so ordering by cost + aging * arrival time is the same as
+        # ordering by the aged cost at any later time and the heap never needs to be rebuilt
+        self._heap = []
+        self._arrivals = deque()
+        self._seq = itertools.count()
+        self._size = 0
+        self._cond = Condition()
+
+    def cost(self, path: str, size: int = 0, mtime_ns: int = 0) -> float:
+        """Cost of a sample at arrival, lower costs are converted first"""
+        boost = next((b for rx, b in self.priorities if rx.search(path)), 0)
+        return POLICIES[self.policy](path, size, mtime_ns) - boost
+
+    def put(self, path: str, size: int = 0, mtime_ns: int = 0):
+        """
+        Adds a sample ready to be converted
+        Args:
+            path: the sample
+            size: size of the sample in bytes
+            mtime_ns: newest modification time of the sample
+        """
+        now = time.monotonic()
+        entry = {'path': path, 'arrived': now, 'taken': False}
+        key = self.cost(path, size, mtime_ns) + self.aging * now
+
+        with self._cond:
+            heapq.heappush(self._heap, (key, next(self._seq), entry))
+            self._arrivals.append(entry)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> str:
+        """
+        Returns the next sample to convert
+        Raises:
+            queue.Empty if there's no sample after 'timeout' seconds
+        """
+        with self._cond:
+            if block and not self._cond.wait_for(lambda: self._size, timeout):
+                raise Empty
+            if not self._size:
+                raise Empty
+
+            while self._arrivals[0]['taken']:
+                self._arrivals.popleft()
+
+            oldest = self._arrivals[0]
+            waited = time.monotonic() - oldest['arrived']
+            if self.max_wait is not None and waited >= self.max_wait:
+                logger.info(f'\tSample {oldest["path"]} waited {waited:.0f} seconds, converting it next')
+                entry = self._arrivals.popleft()
+            else:
+                entry = heapq.heappop(self._heap)[2]
+                while entry['taken']:
+                    entry = heapq.heappop(self._heap)[2]
+
+            entry['taken'] = True
+            self._size -= 1
+            return entry['path']
+
+    def qsize(self) -> int:
+        with self._cond:
+            return self._size
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import platform
+import time
+from threading import Lock
+from typing import Optional
+
+import watchtower
+
+from monitor.SampleLedger import sample_name
+
+MAX_AGE = 6 * 3600  # seconds after which a claim is considered abandoned
+DEFER_DELAY = 60  # seconds before a deferred duplicate is delivered again
+DUPLICATES = ['drop', 'defer']
+
+logger = logging.getLogger('InFlightRegistry')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+def sample_key(path: str) -> str:
+    """Normalized name of a sample, the raw data file and its converted file share the same key"""
+    return sample_name(path).lower()
+
+
+class InFlightRegistry:
+    """
+    Samples being converted or uploaded by any worker of this monitor, keyed by normalized sample name.
+    A converter claims a sample before running msconvert, the claim moves to the uploaders with the converted
+    file and is released once the upload is done, so a second message for the same sample (ie: a created and a
+    moved event) never runs msconvert nor writes the same mzML file concurrently
+    """
+
+    def __init__(self, duplicates: str = 'drop', max_age: float = MAX_AGE):
+        """
+
+        Args:
+            duplicates: str (Optional. Default: drop)
+                What workers do with a sample already in flight: 'drop' it or 'defer' it to be checked again later
+            max_age: float (Optional. Default: 6 hours)
+                Seconds after which a claim is considered abandoned and the sample can be claimed again
+        """
+        if duplicates not in DUPLICATES:
+            raise ValueError(f'Invalid duplicates option "{duplicates}", options: {", ".join(DUPLICATES)}')
+
+        self.duplicates = duplicates
+        self.max_age = max_age
+        self.dropped = 0
+        self.deferred = 0
+
+        # sample key -> [stage, path, claim time]
+        self._claims = {}
+        self._lock = Lock()
+
+    def acquire(self, path: str, stage: str = 'converting') -> bool:
+        """
+        Claims a sample
+        Returns:
+            True if the sample was free, False if another worker has it in flight
+        """
+        key = sample_key(path)
+        now = time.monotonic()
+        with self._lock:
+            claim = self._claims.get(key)
+            if claim and now - claim[2] < self.max_age:
+                return False
+            if claim:
+                logger.warning(f'\tClaim of {claim[1]} ({claim[0]}) expired, releasing it')
+            self._claims[key] = [stage, path, now]
+            return True
+
+    def move(self, path: str, stage: str):
+        """Hands a claimed sample to the next stage, ie: from 'converting' to 'uploading'"""
+        with self._lock:
+            claim = self._claims.get(sample_key(path))
+            if claim:
+                claim[0] = stage
+                claim[2] = time.monotonic()
+
+    def release(self, path: str) -> bool:
+        """
+        Releases the claim of a sample
+        Returns:
+            True if the sample was claimed
+        """
+        with self._lock:
+            return self._claims.pop(sample_key(path), None) is not None
+
+    def stage(self, path: str) -> Optional[str]:
+        """Stage of a sample in flight or None"""
+        with self._lock:
+            claim = self._claims.get(sample_key(path))
+            return claim[0] if claim else None
+
+    def duplicate(self, path: str) -> str:
+        """
+        Counts a duplicate of a sample in flight
+        Returns:
+            What to do with it, 'drop' or 'defer'
+        """
+        with self._lock:
+            claim = self._claims.get(sample_key(path))
+            if self.duplicates == 'defer':
+                self.deferred += 1
+            else:
+                self.dropped += 1
+
+        logger.info(f'\tSample {path} is already {claim[0] if claim else "in flight"} '
+                    f'({claim[1] if claim else ""}), {"deferring" if self.duplicates == "defer" else "dropping"} it')
+        return self.duplicates
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._claims)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': len(self._claims), 'dropped': self.dropped, 'deferred': self.deferred}
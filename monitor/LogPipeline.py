@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from typing import Optional
+
+from monitor.Metrics import LOG_DROPPED
+
+QUEUE_SIZE = 10000  # log records buffered for the shipping thread, the oldest are dropped when full
+SAMPLE_INTERVAL = 60  # seconds of each sampling window
+SAMPLE_BURST = 50  # records logged per call site and window below WARNING, the rest are dropped
+
+
+class DropOldestQueue(queue.Queue):
+    """Bounded queue that never blocks the producer, the oldest item is discarded to make room for a new one"""
+
+    def __init__(self, maxsize: int = QUEUE_SIZE):
+        super().__init__(maxsize)
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            while 0 < self.maxsize <= self._qsize():
+                self._get()
+                self.dropped += 1
+                LOG_DROPPED.labels('full').inc()
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limits noisy log lines. Records below WARNING are counted per call site (file and line) and only the first
+    'burst' of each 'interval' seconds pass, the next record that passes reports how many were suppressed
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, burst: int = SAMPLE_BURST, level: int = logging.WARNING):
+        """
+
+        Args:
+            interval: float (Optional. Default: 60)
+                Seconds of each sampling window
+            burst: int (Optional. Default: 50)
+                Records per call site and window
+            level: int (Optional. Default: WARNING)
+                Records at or above this level are never sampled
+        """
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.level = level
+        self.suppressed = 0
+
+        # (pathname, lineno) -> [window start, records in window, records suppressed]
+        self._sites = {}
+        self._lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.level:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.interval:
+                skipped = site[2] if site else 0
+                site = self._sites[key] = [now, 0, 0]
+            else:
+                skipped = 0
+
+            if site[1] >= self.burst:
+                site[2] += 1
+                self.suppressed += 1
+                LOG_DROPPED.labels('sampled').inc()
+                return False
+            site[1] += 1
+
+        if skipped:
+            record.msg = f'{record.msg} [{skipped} similar messages suppressed]'
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves all the work to the shipping thread: records are queued as they are, without
+    formatting them, and a full queue drops its oldest record instead of blocking
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatting, including tracebacks, happens on the listener's thread
+        return record
+
+
+class LogPipeline:
+    """
+    Sends the records of a logger to its handlers from a single shipping thread, so worker threads only pay for
+    putting a record in a bounded in-memory queue
+    """
+
+    def __init__(self, handlers: list, queue_size: int = QUEUE_SIZE, interval: float = SAMPLE_INTERVAL,
+                 burst: Optional[int] = SAMPLE_BURST):
+        """
+
+        Args:
+            handlers: list
+                Handlers receiving the records, ie: a stream handler and a CloudWatch handler
+            queue_size: int (Optional. Default: 10000)
+                Records buffered, the oldest are dropped when full
+            interval: float (Optional. Default: 60)
+                Seconds of each sampling window
+            burst: int (Optional. Default: 50)
+                Records per call site and window below WARNING, 0 or None disables sampling
+        """
+        self.queue = DropOldestQueue(queue_size)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.sampler = SamplingFilter(interval, burst) if burst else None
+        if self.sampler:
+            self.handler.addFilter(self.sampler)
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.running = False
+
+    def start(self):
+        self.listener.start()
+        self.running = True
+
+    def stop(self):
+        """Ships the queued records and stops the shipping thread"""
+        if self.running:
+            self.running = False
+            self.listener.stop()
+
+    def stats(self) -> dict:
+        return {'queued': self.queue.qsize(),
+                'dropped': self.queue.dropped,
+                'suppressed': self.sampler.suppressed if self.sampler else 0}
+
+
+def install_pipeline(logger: logging.Logger = None, queue_size: int = QUEUE_SIZE, interval: float = SAMPLE_INTERVAL,
+                     burst: Optional[int] = SAMPLE_BURST) -> LogPipeline:
+    """
+    Moves the handlers of a logger (the root logger by default) behind a started LogPipeline
+    Returns:
+        The pipeline, stop it before exiting to ship the queued records
+    """
+    logger = logger or logging.getLogger()
+    handlers = list(logger.handlers)
+    for h in handlers:
+        logger.removeHandler(h)
+
+    pipeline = LogPipeline(handlers, queue_size, interval, burst)
+    logger.addHandler(pipeline.handler)
+    pipeline.start()
+    return pipeline
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import logging
+import math
+import platform
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from typing import Callable, Optional
+
+import watchtower
+
+METRICS_PORT = 9108
+METRICS_ADDRESS = '127.0.0.1'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+logger = logging.getLogger('Metrics')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for m in metrics:
+            lines.append(f'# HELP {m.name} {m.help}')
+            lines.append(f'# TYPE {m.name} {m.kind}')
+            lines.extend(m.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Returns the child metric for a combination of label values"""
+        if len(values) != len(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}')
+        values = tuple(str(v) for v in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._child()
+            return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        return self.labels()
+
+    def samples(self) -> list:
+        with self._lock:
+            children = list(self._children.items())
+        return [line for values, child in sorted(children) for line in child.samples(self, values)]
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return math.nan
+        return self.value
+
+    def samples(self, metric, values) -> list:
+        return [f'{metric.name}{_labels(metric.label_names, values)} {_format(self.get())}']
+
+
+class _GaugeValue(_Value):
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """The value is read from function when the metrics are collected"""
+        self.function = function
+
+
+class Counter(_Metric):
+    """Monotonically increasing value"""
+    kind = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    kind = 'gauge'
+
+    def _child(self):
+        return _GaugeValue()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.monotonic() - self.start
+        self.child.observe(self.elapsed)
+
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    def time(self) -> _Timer:
+        """Context manager observing the seconds spent in its block"""
+        return _Timer(self)
+
+    def samples(self, metric, values) -> list:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [math.inf], counts):
+            cumulative += count
+            le = 'le="' + _format(bound) + '"'
+            lines.append(f'{metric.name}_bucket{_labels(metric.label_names, values, le)} {cumulative}')
+        lines.append(f'{metric.name}_sum{_labels(metric.label_names, values)} {_format(total)}')
+        lines.append(f'{metric.name}_count{_labels(metric.label_names, values)} {cumulative}')
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 registry: Optional[Registry] = REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self) -> _Timer:
+        return self._default().time()
+
+
+# Pipeline metrics, rate() of the byte counters gives the conversion and upload throughput
+SETTLE_SECONDS = Histogram('monitor_settle_seconds', 'Seconds from tracking a sample until its acquisition finished',
+                           buckets=DURATION_BUCKETS)
+MSCONVERT_SECONDS = Histogram('monitor_msconvert_seconds', 'Seconds running msconvert per sample',
+                              buckets=DURATION_BUCKETS)
+CONVERTED_BYTES = Counter('monitor_converted_bytes_total', 'Bytes of mzML produced by msconvert')
+UPLOAD_SECONDS = Histogram('monitor_upload_seconds', 'Seconds uploading a file to the bucket',
+                           buckets=DURATION_BUCKETS)
+UPLOADED_BYTES = Counter('monitor_uploaded_bytes_total', 'Bytes uploaded to the bucket')
+SAMPLES = Counter('monitor_samples_total', 'Samples handled by stage and outcome', ('stage', 'outcome'))
+STASIS_SECONDS = Histogram('monitor_stasis_request_seconds', 'Latency of the Stasis api calls', ('call',))
+RETRIES = Counter('monitor_retries_total', 'Operations retried by stage', ('stage',))
+FAILURES = Counter('monitor_failures_total', 'Failures by stage and reason', ('stage', 'reason'))
+LOG_DROPPED = Counter('monitor_log_records_dropped_total', 'Log records not shipped, by reason', ('reason',))
+ACTIVE_WORKERS = Gauge('monitor_active_workers', 'Workers running in each pool', ('pool',))
+QUEUE_DEPTH = Gauge('monitor_queue_depth', 'Last known number of items waiting in each queue', ('queue',))
+STASIS_POOL = Gauge('monitor_stasis_pool', 'Connections opened, requests sent and requests that reused a connection '
+                    'of the Stasis connection pool', ('kind',))
+QUEUE_INFLIGHT = Gauge('monitor_queue_inflight', 'Last known number of messages received but not deleted',
+                       ('queue',))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsServer(Thread):
+    """
+    Serves the metrics of a registry over http for Prometheus to scrape
+    """
+
+    def __init__(self, port: int = METRICS_PORT, address: str = METRICS_ADDRESS, registry: Registry = REGISTRY,
+                 name='Metrics', daemon=True):
+        """
+
+        Args:
+            port: int (Optional. Default: 9108)
+                Port to listen on, 0 picks a free one
+            address: str (Optional. Default: 127.0.0.1)
+                Address to listen on, '0.0.0.0' exposes the metrics to other hosts
+            registry: Registry (Optional. Default: REGISTRY)
+                Metrics to serve
+            name: str (Optional. Default: Metrics)
+                Name of the thread
+            daemon:
+                Run the server as daemon. (Optional. Default: True)
+        """
+        super().__init__(name=name, daemon=daemon)
+        handler = type('Handler', (MetricsHandler,), {'registry': registry})
+        self.server = ThreadingHTTPServer((address, port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.running = False
+
+    def run(self):
+        self.running = True
+        logger.info(f'Serving metrics on port {self.port}')
+        self.server.serve_forever(poll_interval=1)
+
+    def join(self, timeout=None):
+        # Monitor.join_threads joins every thread, stop serving first
+        if self.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+        super().join(timeout)
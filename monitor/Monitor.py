@@ -3,18 +3,29 @@
 import logging
 import os
 import platform
+import tempfile
 import time
-import math
 from threading import Thread
 
 import watchtower
 
+from monitor.Bucket import Bucket
+from monitor.InFlightRegistry import InFlightRegistry, MAX_AGE
+from monitor.Metrics import MetricsServer, ACTIVE_WORKERS, QUEUE_DEPTH, STASIS_POOL, METRICS_PORT, METRICS_ADDRESS
 from monitor.ObserverFactory import ObserverFactory
-from monitor.QueueManager import QueueManager
-from monitor.RawDataEventHandler import RawDataEventHandler
+from monitor.PoolSupervisor import PoolSupervisor, WorkerPool, pool_bounds
+from monitor.QueueManager import QueueManager, QueueDepthSampler, LeaseHeartbeat, DEPTH_INTERVAL, \
+    HEARTBEAT_INTERVAL
+from monitor.RawDataEventHandler import RawDataEventHandler, QUIET_WINDOW
+from monitor.SampleFilter import SampleFilter
+from monitor.SampleLedger import SampleLedger, ledger_path
+from monitor.StartupScanner import StartupScanner, SCAN_WORKERS, checkpoint_path
+from monitor.TraceStore import TraceStore, traces_path, RETENTION
 from monitor.client.BackendClient import BackendClient
+from monitor.client.StatusDispatcher import StatusDispatcher, QUEUE_SIZE, SENDERS
 from monitor.workers.BucketWorker import BucketWorker
-from monitor.workers.PwizWorker import PwizWorker
+from monitor.workers.PwizWorker import PwizWorker, MSCONVERT_ARGS
+from monitor.workers.SettleWorker import SettleWorker
 
 THREAD_TIMEOUT = 5
 
@@ -57,41 +68,120 @@ class Monitor(Thread):
         self.test = config['test']
         self.threads = []
         self.queue_mgr = queue_mgr
+        self.status_cli = None
 
     def run(self):
         """Starts the monitoring of the selected folders"""
-        observer = ObserverFactory().getObserver(self.config['monitor']['mode'])
+        observer = ObserverFactory().getObserver(self.config['monitor']['mode'], self.config)
+        event_handler = None
+        inflight = None
 
         try:
-            proc_cores = math.floor(os.cpu_count() / 3)
-            upld_cores = math.ceil(proc_cores / 3)
-            # proc_cores = 10
-            # upld_cores = 2
+            # Timestamped spans of each stage of each sample
+            traces = None
+            traces_cfg = self.config['monitor'].get('traces', {})
+            if traces_cfg.get('enabled', False):
+                traces = TraceStore(traces_path(self.config), self.config['monitor']['paths'])
+                traces.compact(traces_cfg.get('retention', RETENTION))
+                logger.info(f'Saving sample traces to {traces.path}')
+
+            # S3 bucket and transfer pool shared by all the workers
+            bucket = Bucket(self.config['aws']['bucket_name'], self.config['aws'].get('transfer'),
+                            self.config['aws'].get('index'), traces=traces)
+
+            # Write-behind sender of the sample state updates
+            status = self.config['backend'].get('status', {})
+            self.status_cli = StatusDispatcher(self.backend_cli,
+                                               spill_file=status.get('spill_file',
+                                                                     os.path.join(tempfile.gettempdir(),
+                                                                                  'monitor-status.jsonl')),
+                                               max_size=status.get('queue_size', QUEUE_SIZE),
+                                               senders=status.get('senders', SENDERS),
+                                               traces=traces)
+
+            # Filter of invalid samples shared by the event handler and the converters
+            sample_filter = SampleFilter(self.config['monitor']['skip'], self.config['monitor']['extensions'])
+
+            # Local record of the processed samples
+            ledger = None
+            ledger_cfg = self.config['monitor'].get('ledger', {})
+            if ledger_cfg.get('enabled', False):
+                ledger = SampleLedger(ledger_path(self.config), ' '.join(MSCONVERT_ARGS))
+                logger.info(f'Using sample ledger {ledger.path} ({ledger.count()} samples)')
+
+            # Samples being converted or uploaded, a duplicate message of a sample in flight is dropped or deferred
+            dedup_cfg = self.config['monitor'].get('dedup', {})
+            if dedup_cfg.get('enabled', False):
+                inflight = InFlightRegistry(dedup_cfg.get('duplicates', 'drop'), dedup_cfg.get('max_age', MAX_AGE))
+                logger.info(f'Deduplicating samples in flight ({inflight.duplicates} duplicates)')
+
+            # Setup the settling worker, it waits for acquisitions to finish before conversion
+            settler = SettleWorker(self, self.queue_mgr, self.config, name='Settler0', traces=traces)
 
-            logger.info(f'Using {proc_cores} for processing')
-            logger.info(f'Using {upld_cores} for uploading')
-
-            threads = []
             # Setup the pwiz workers
-            [threads.append(
-                PwizWorker(self,
-                           self.backend_cli,
-                           self.queue_mgr,
-                           self.config,
-                           name=f'Converter{x}')
-            ) for x in range(0, proc_cores)]
-
-            # Setup the aws uploader worker
-            [threads.append(
-                BucketWorker(self,
-                             self.backend_cli,
-                             self.config,
-                             self.queue_mgr,
-                             name=f'Uploader{x}')
-            ) for x in range(0, upld_cores)]
+            conv_min, conv_max = pool_bounds(self.config, 'converters')
+            converters = WorkerPool('converters',
+                                    lambda x: PwizWorker(self,
+                                                         self.backend_cli,
+                                                         self.queue_mgr,
+                                                         self.config,
+                                                         name=f'Converter{x}',
+                                                         settler=settler,
+                                                         bucket=bucket,
+                                                         status_cli=self.status_cli,
+                                                         sample_filter=sample_filter,
+                                                         ledger=ledger,
+                                                         traces=traces,
+                                                         inflight=inflight),
+                                    settler.ready.qsize,
+                                    conv_min, conv_max, cpu_bound=True)
+
+            # Setup the aws uploader workers
+            upld_min, upld_max = pool_bounds(self.config, 'uploaders')
+            uploaders = WorkerPool('uploaders',
+                                   lambda x: BucketWorker(self,
+                                                          self.backend_cli,
+                                                          self.config,
+                                                          self.queue_mgr,
+                                                          name=f'Uploader{x}',
+                                                          bucket=bucket,
+                                                          status_cli=self.status_cli,
+                                                          ledger=ledger,
+                                                          traces=traces,
+                                                          inflight=inflight),
+                                   lambda: self.queue_mgr.depth('upload'),
+                                   upld_min, upld_max, cpu_bound=False)
+
+            logger.info(f'Using {conv_min} to {conv_max} threads for processing')
+            logger.info(f'Using {upld_min} to {upld_max} threads for uploading')
+
+            # Cached queue depths for the workers, the pool supervisor and the metrics
+            sampler = QueueDepthSampler(self.queue_mgr,
+                                        self.config['aws'].get('queue', {}).get('depth_interval', DEPTH_INTERVAL))
+
+            self.threads = [sampler, settler, PoolSupervisor(self.config, [converters, uploaders])]
+
+            # Keep the messages of the samples in progress hidden from other workers until they are acked
+            if self.queue_mgr.leases:
+                self.threads.append(LeaseHeartbeat(self.queue_mgr, self.config['aws'].get('queue', {}).get(
+                    'heartbeat_interval', HEARTBEAT_INTERVAL)))
+
+            # Metrics endpoint, gauges that are cheap to compute are read when scraped
+            metrics = self.config['monitor'].get('metrics', {})
+            if metrics.get('enabled', False):
+                ACTIVE_WORKERS.labels('converters').set_function(converters.size)
+                ACTIVE_WORKERS.labels('uploaders').set_function(uploaders.size)
+                QUEUE_DEPTH.labels('settling').set_function(settler.pending)
+                QUEUE_DEPTH.labels('ready').set_function(settler.ready.qsize)
+                QUEUE_DEPTH.labels('status').set_function(self.status_cli.pending)
+                if hasattr(self.backend_cli, 'pool_stats'):
+                    for kind in ['connections', 'requests', 'reused']:
+                        STASIS_POOL.labels(kind).set_function(lambda k=kind: self.backend_cli.pool_stats()[k])
+                self.threads.append(MetricsServer(metrics.get('port', METRICS_PORT),
+                                                  metrics.get('address', METRICS_ADDRESS)))
 
             logger.info(f'Starting threads')
-            for t in threads:
+            for t in self.threads:
                 t.start()
 
             event_handler = RawDataEventHandler(
@@ -99,6 +189,9 @@ class Monitor(Thread):
                 self.queue_mgr,
                 self.config['monitor']['extensions'],
                 test=self.config['test'],
+                quiet_window=self.config['monitor'].get('quiet_window', QUIET_WINDOW),
+                sample_filter=sample_filter,
+                traces=traces,
             )
 
             for p in self.config['monitor']['paths']:
@@ -108,6 +201,14 @@ class Monitor(Thread):
                 else:
                     logger.error(f'Cannot find raw data folder {p}. It will NOT be monitored.')
 
+            # Queue the samples acquired while the monitor was down, after scheduling so none are missed
+            if self.config['monitor'].get('scan_on_start', False):
+                scanner = StartupScanner(self.queue_mgr, self.config['monitor']['paths'], sample_filter,
+                                         workers=self.config['monitor'].get('scan_workers', SCAN_WORKERS),
+                                         ledger=ledger, traces=traces, checkpoint=checkpoint_path(self.config))
+                self.threads.append(scanner)
+                scanner.start()
+
             if self.running:
                 observer.start()
                 logger.info(f'Monitor "{self.name}" started')
@@ -124,7 +225,14 @@ class Monitor(Thread):
             observer.unschedule_all()
             observer.stop()
             observer.join(THREAD_TIMEOUT) if observer.is_alive() else None
+            event_handler.stop() if event_handler else None
+            logger.info(f'\tSample filter counters: {event_handler.filter.stats()}') if event_handler else None
+            logger.info(f'\tStasis connection pool: {self.backend_cli.pool_stats()}') \
+                if hasattr(self.backend_cli, 'pool_stats') else None
             self.join_threads()
+            logger.info(f'\tIn-flight counters: {inflight.stats()}') if inflight else None
+            self.queue_mgr.release_leases() if self.queue_mgr.leases else None
+            self.status_cli.stop() if self.status_cli else None
             self.join(THREAD_TIMEOUT) if self.is_alive() else None
 
     def join_threads(self):
@@ -7,7 +7,8 @@ import sys
 
 from watchdog.observers import Observer
 from watchdog.observers.api import BaseObserver
-from watchdog.observers.polling import PollingObserver
+
+from monitor.RemoteObserver import RemoteObserver, POLL_INTERVAL, POLL_WORKERS
 
 logger = logging.getLogger('ObserverFactory')
 if not logger.handlers:
@@ -19,13 +20,17 @@ class ObserverFactory:
     def __init__(self):
         self.platform = platform.node()
 
-    def getObserver(self, mode) -> BaseObserver:
+    def getObserver(self, mode, config=None) -> BaseObserver:
         if mode == 'local':
             logger.info(f'Creating regular Observer for local monitoring')
             return Observer()
         elif mode == 'remote':
-            logger.info(f'Creating PollingObserver for remote folder monitoring')
-            return PollingObserver()
+            logger.info(f'Creating RemoteObserver for remote folder monitoring')
+            remote = (config or {}).get('monitor', {}).get('remote', {})
+            return RemoteObserver(timeout=remote.get('interval', POLL_INTERVAL),
+                                  max_depth=remote.get('depth'),
+                                  intervals=remote.get('intervals'),
+                                  workers=remote.get('workers', POLL_WORKERS))
         else:
             logger.info(f'Invalid mode, check your configuration')
             quit()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import math
+import os
+import platform
+import time
+from collections import deque
+from threading import Thread
+
+import psutil
+import watchtower
+
+THREAD_TIMEOUT = 5
+SUPERVISOR_INTERVAL = 30  # seconds between pool size evaluations
+RATE_WINDOW = 900  # seconds of completions the throughput is measured over, several conversions long
+CPU_HIGH = 85  # host cpu percentage above which converters are not added
+MEMORY_HIGH = 90  # host memory percentage above which no workers are added
+
+logger = logging.getLogger('PoolSupervisor')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+class WorkerPool:
+    """
+    A resizable group of worker threads of the same stage
+    """
+
+    def __init__(self, name, factory, backlog, min_size: int, max_size: int, cpu_bound: bool,
+                 rate_window: float = RATE_WINDOW):
+        """
+
+        Args:
+            name: str
+                Name of the stage, used in the logs
+            factory:
+                A callable receiving the worker index and returning a new (not started) worker
+            backlog:
+                A callable returning the number of items waiting for this stage
+            min_size: int
+                Minimum number of workers
+            max_size: int
+                Maximum number of workers
+            cpu_bound: bool
+                If True, workers are not added while the host cpu is busy
+            rate_window: float (Optional. Default: 900)
+                Seconds of completions the throughput is measured over
+        """
+        self.name = name
+        self.factory = factory
+        self.backlog = backlog
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.cpu_bound = cpu_bound
+        self.rate_window = rate_window
+        self.workers = []
+
+        self._count = 0
+        self._retired = 0  # items processed by workers already removed from the pool
+        # (time, items processed) of each evaluation within the rate window, plus the one before it
+        self._history = deque([(time.monotonic(), 0)])
+        self._rate_at_grow = None
+        self._grown_at = 0
+
+    def size(self) -> int:
+        return len(self.workers)
+
+    def grow(self):
+        worker = self.factory(self._count)
+        self._count += 1
+        self.workers.append(worker)
+        worker.start()
+        logger.info(f'\tStarted {worker.name}, {self.name} pool size: {self.size()}')
+
+    def shrink(self):
+        worker = self.workers.pop()
+        worker.running = False
+        self._retired += worker.processed
+        logger.info(f'\tStopping {worker.name}, {self.name} pool size: {self.size()}')
+
+    def throughput(self) -> tuple:
+        """
+        Items processed per minute by the whole pool over the last rate window
+        Returns:
+            A tuple (rate, items processed in the window)
+        """
+        now = time.monotonic()
+        processed = self._retired + sum(w.processed for w in self.workers)
+        self._history.append((now, processed))
+        while len(self._history) > 2 and self._history[1][0] <= now - self.rate_window:
+            self._history.popleft()
+
+        start, start_processed = self._history[0]
+        completed = max(0, processed - start_processed)
+        return completed * 60 / max(now - start, 1e-6), completed
+
+    def resize(self, cpu: float, memory: float, cpu_high: float, memory_high: float):
+        """Adds or removes one worker based on the stage's backlog, its throughput and the host load"""
+        # remove workers that stopped by themselves
+        self._retired += sum(w.processed for w in self.workers if not w.is_alive())
+        self.workers = [w for w in self.workers if w.is_alive()]
+
+        rate, completed = self.throughput()
+        backlog = self.backlog()
+        overloaded = memory >= memory_high or (self.cpu_bound and cpu >= cpu_high)
+        logger.debug(f'{self.name}: {self.size()} workers, backlog: {backlog}, rate: {rate:.1f}/min, '
+                     f'cpu: {cpu}%, memory: {memory}%')
+
+        if self.size() < self.min_size:
+            self.grow()
+        elif self.size() > self.max_size or (self.size() > self.min_size and (overloaded or backlog == 0)):
+            self._rate_at_grow = None
+            self.shrink()
+        elif backlog > self.size() and self.size() < self.max_size and not overloaded:
+            # the throughput can only be judged once items complete, and a new worker shows in it after a window
+            if self._rate_at_grow is not None and completed:
+                if time.monotonic() - self._grown_at < self.rate_window:
+                    logger.debug(f'{self.name}: waiting for the last worker to show in the throughput')
+                    return
+                if rate <= self._rate_at_grow:
+                    # the last worker added didn't improve throughput, the bottleneck is elsewhere
+                    logger.debug(f'{self.name}: throughput not improving, keeping {self.size()} workers')
+                    return
+            self._rate_at_grow = rate if completed else None
+            self._grown_at = time.monotonic()
+            self.grow()
+
+    def stop(self):
+        for w in self.workers:
+            w.running = False
+        for w in self.workers:
+            w.join(THREAD_TIMEOUT)
+        self.workers = []
+
+
+class PoolSupervisor(Thread):
+    """
+    Thread that grows and shrinks the converter and uploader pools at runtime
+    """
+
+    def __init__(self, config, pools: list, name='Supervisor', daemon=True):
+        """
+
+        Args:
+            config:
+                An object containing config settings
+            pools: list
+                The WorkerPool objects to supervise
+            name: str (Optional. Default: Supervisor)
+                Name of the supervisor thread
+            daemon:
+                Run the supervisor as daemon. (Optional. Default: True)
+        """
+        super().__init__(name=name, daemon=daemon)
+
+        if config['debug']:
+            logger.setLevel(level='DEBUG')
+
+        pool_config = config['monitor'].get('pool', {})
+        self.interval = pool_config.get('interval', SUPERVISOR_INTERVAL)
+        self.cpu_high = pool_config.get('cpu_high', CPU_HIGH)
+        self.memory_high = pool_config.get('memory_high', MEMORY_HIGH)
+        self.pools = pools
+        for pool in pools:
+            pool.rate_window = pool_config.get('rate_window', pool.rate_window)
+        self.running = False
+
+    def run(self):
+        self.running = True
+        psutil.cpu_percent()  # first call only sets the baseline
+
+        for pool in self.pools:
+            while pool.size() < pool.min_size:
+                pool.grow()
+
+        last = time.monotonic()
+        while self.running:
+            time.sleep(0.5)
+            if time.monotonic() - last < self.interval:
+                continue
+            last = time.monotonic()
+
+            try:
+                cpu = psutil.cpu_percent()
+                memory = psutil.virtual_memory().percent
+                for pool in self.pools:
+                    pool.resize(cpu, memory, self.cpu_high, self.memory_high)
+            except Exception as ex:
+                logger.error(f'Error resizing worker pools: {str(ex)}')
+
+        logger.info(f'\tStopping {self.name}')
+        for pool in self.pools:
+            pool.stop()
+
+
+def pool_bounds(config, stage: str) -> tuple:
+    """
+    Reads the min and max size of a worker pool from the 'monitor.pool' config section.
+    The defaults are based on the number of cpus of the host
+    Args:
+        config: An object containing config settings
+        stage: name of the pool section ('converters' or 'uploaders')
+
+    Returns:
+        A tuple (min, max)
+    """
+    cpus = os.cpu_count() or 1
+    converters = max(1, math.floor(cpus / 3))
+    defaults = {'converters': (converters, max(converters, cpus - 1)),
+                'uploaders': (max(1, math.ceil(converters / 3)), max(2, converters))}
+
+    bounds = config['monitor'].get('pool', {}).get(stage, {})
+    min_size = max(1, bounds.get('min', defaults[stage][0]))
+    return min_size, max(min_size, bounds.get('max', defaults[stage][1]))
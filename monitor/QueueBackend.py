@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+import json
+import logging
+import os
+import platform
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Condition, Lock
+from typing import Optional
+
+import boto3
+import watchtower
+from botocore.exceptions import ClientError
+
+LOCAL_PREFIX = 'local://'
+DEFAULT_VISIBILITY = 30  # SQS default visibility timeout (seconds)
+COMPACT_AFTER = 100000  # journal records written before rewriting it with only the live messages
+
+logger = logging.getLogger('QueueBackend')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+class QueueBackend(ABC):
+    """
+    Subset of the boto3 SQS client used by QueueManager. Methods take and return the same arguments and dicts as
+    boto3, so a boto3 'sqs' client is the SQS backend and other backends can replace it transparently.
+    Missing queues raise botocore's ClientError with a 'AWS.SimpleQueueService.NonExistentQueue' code
+    """
+
+    @abstractmethod
+    def list_queues(self, **kwargs) -> dict:
+        pass
+
+    @abstractmethod
+    def create_queue(self, QueueName: str, **kwargs) -> dict:
+        pass
+
+    @abstractmethod
+    def get_queue_url(self, QueueName: str) -> dict:
+        pass
+
+    @abstractmethod
+    def send_message(self, QueueUrl: str, MessageBody: str, **kwargs) -> dict:
+        pass
+
+    @abstractmethod
+    def send_message_batch(self, QueueUrl: str, Entries: list) -> dict:
+        pass
+
+    @abstractmethod
+    def receive_message(self, QueueUrl: str, **kwargs) -> dict:
+        pass
+
+    @abstractmethod
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str) -> dict:
+        pass
+
+    @abstractmethod
+    def delete_message_batch(self, QueueUrl: str, Entries: list) -> dict:
+        pass
+
+    @abstractmethod
+    def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: int) -> dict:
+        pass
+
+    @abstractmethod
+    def change_message_visibility_batch(self, QueueUrl: str, Entries: list) -> dict:
+        pass
+
+    @abstractmethod
+    def get_queue_attributes(self, QueueUrl: str, AttributeNames: list) -> dict:
+        pass
+
+    @abstractmethod
+    def purge_queue(self, QueueUrl: str) -> dict:
+        pass
+
+
+class _LocalQueue:
+    """Messages of a local queue. 'ready' keeps the visible messages in order, 'inflight' the received ones"""
+
+    def __init__(self, name: str, attributes: Optional[dict] = None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.ready = OrderedDict()  # id -> message
+        self.inflight = {}  # id -> message
+        self.expiry = []  # heap of (visible again at, id, receive count)
+
+    def restore_expired(self, now: float):
+        """Makes received messages whose visibility timeout expired visible again, in front of the rest"""
+        while self.expiry and self.expiry[0][0] <= now:
+            _, msg_id, count = heapq.heappop(self.expiry)
+            msg = self.inflight.get(msg_id)
+            if msg is not None and msg['count'] == count and msg['visible_at'] <= now:
+                del self.inflight[msg_id]
+                self.ready[msg_id] = msg
+                if count:
+                    # received before, delayed messages keep their place at the end
+                    self.ready.move_to_end(msg_id, last=False)
+
+    def next_expiry(self) -> Optional[float]:
+        return self.expiry[0][0] if self.expiry else None
+
+
+class LocalQueueBackend(QueueBackend):
+    """
+    In-process queue backend for single host deployments, messages are handed between stages in memory.
+    Every change is appended to a journal file that is replayed on startup, messages that were received but not
+    deleted before a crash become visible again, like in SQS after their visibility timeout. Delayed messages keep
+    their delay and received ones their receive count
+    """
+
+    def __init__(self, journal: Optional[str] = None, sync: bool = False):
+        """
+
+        Args:
+            journal: str (Optional. Default: None)
+                Append-only file where the queue operations are recorded. Messages are lost on exit if missing
+            sync: bool (Optional. Default: False)
+                fsync the journal on every write, survives power losses at the cost of latency
+        """
+        self.journal = journal
+        self.sync = sync
+        self._queues = {}
+        self._cond = Condition()
+        self._journal_lock = Lock()
+        self._file = None
+        self._records = 0
+
+        if self.journal:
+            self._replay()
+            self._file = open(self.journal, 'a', encoding='utf-8')
+
+    # journal
+
+    def _replay(self):
+        """Loads the journal and compacts it"""
+        if os.path.exists(self.journal):
+            with open(self.journal, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # torn write at the end of the file
+                        logger.warning(f'Skipping corrupted journal record in {self.journal}')
+                        continue
+                    self._apply(rec)
+
+        self._compact()
+
+        messages = sum(len(q.ready) for q in self._queues.values())
+        if messages:
+            logger.info(f'Recovered {messages} messages from {self.journal}')
+
+    def _compact(self):
+        """Rewrites the journal with only the queues and messages still alive. Called holding _journal_lock or on startup"""
+        tmp = f'{self.journal}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for q in self._queues.values():
+                f.write(json.dumps({'op': 'create', 'q': q.name, 'attributes': q.attributes}) + '\n')
+                for msg_id, msg in list(q.ready.items()) + list(q.inflight.items()):
+                    f.write(json.dumps(self._send_record(q, msg_id, msg)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp, self.journal)
+        if self._file is not None:
+            self._file = open(self.journal, 'a', encoding='utf-8')
+        self._records = 0
+
+    def _apply(self, rec: dict):
+        if rec['op'] == 'create':
+            self._queues.setdefault(rec['q'], _LocalQueue(rec['q'], rec.get('attributes')))
+            return
+
+        q = self._queues.get(rec['q'])
+        if q is None:
+            return
+        if rec['op'] == 'send':
+            msg = {'body': rec['body'], 'count': rec.get('count', 0), 'visible_at': rec.get('visible_at', 0),
+                   'sent': rec.get('sent', time.time())}
+            if msg['visible_at'] > time.time():
+                # still delayed
+                q.inflight[rec['id']] = msg
+                heapq.heappush(q.expiry, (msg['visible_at'], rec['id'], msg['count']))
+            else:
+                msg['visible_at'] = 0
+                q.ready[rec['id']] = msg
+        elif rec['op'] == 'receive':
+            # received but not deleted, visible again in front of the rest like after a visibility timeout
+            msg = q.ready.pop(rec['id'], None) or q.inflight.pop(rec['id'], None)
+            if msg is not None:
+                msg['count'] = rec['count']
+                msg['visible_at'] = 0
+                q.ready[rec['id']] = msg
+                q.ready.move_to_end(rec['id'], last=False)
+        elif rec['op'] == 'delete':
+            q.ready.pop(rec['id'], None)
+            q.inflight.pop(rec['id'], None)
+        elif rec['op'] == 'purge':
+            q.ready.clear()
+            q.inflight.clear()
+            q.expiry.clear()
+
+    @staticmethod
+    def _send_record(q: _LocalQueue, msg_id: str, msg: dict) -> dict:
+        """Journal record recreating a message, with its delay if it wasn't received yet and its receive count"""
+        rec = {'op': 'send', 'q': q.name, 'id': msg_id, 'body': msg['body'], 'sent': msg['sent']}
+        if msg['count']:
+            rec['count'] = msg['count']
+        elif msg['visible_at']:
+            rec['visible_at'] = msg['visible_at']
+        return rec
+
+    def _log(self, *records):
+        """Appends records to the journal. Called holding _cond, so the journal follows the order of changes"""
+        if self._file is None or not records:
+            return
+        with self._journal_lock:
+            self._file.writelines(json.dumps(r) + '\n' for r in records)
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+
+            self._records += len(records)
+            if self._records >= COMPACT_AFTER:
+                self._compact()
+
+    # queues
+
+    def _queue(self, url: str, operation: str) -> _LocalQueue:
+        q = self._queues.get(url[len(LOCAL_PREFIX):]) if url.startswith(LOCAL_PREFIX) else None
+        if q is None:
+            raise ClientError({'Error': {'Code': 'AWS.SimpleQueueService.NonExistentQueue',
+                                         'Message': f'The specified queue does not exist: {url}'}}, operation)
+        return q
+
+    def list_queues(self, QueueNamePrefix: str = '', **kwargs) -> dict:
+        with self._cond:
+            urls = [f'{LOCAL_PREFIX}{n}' for n in self._queues if n.startswith(QueueNamePrefix)]
+        return {'QueueUrls': urls} if urls else {}
+
+    def create_queue(self, QueueName: str, Attributes: Optional[dict] = None, **kwargs) -> dict:
+        with self._cond:
+            if QueueName not in self._queues:
+                self._queues[QueueName] = _LocalQueue(QueueName, Attributes)
+                self._log({'op': 'create', 'q': QueueName, 'attributes': Attributes or {}})
+        return {'QueueUrl': f'{LOCAL_PREFIX}{QueueName}'}
+
+    def get_queue_url(self, QueueName: str, **kwargs) -> dict:
+        url = f'{LOCAL_PREFIX}{QueueName}'
+        with self._cond:
+            self._queue(url, 'GetQueueUrl')
+        return {'QueueUrl': url}
+
+    # messages
+
+    def send_message(self, QueueUrl: str, MessageBody: str, DelaySeconds: int = 0, **kwargs) -> dict:
+        response = self.send_message_batch(QueueUrl, [{'Id': '0', 'MessageBody': MessageBody,
+                                                       'DelaySeconds': DelaySeconds}])
+        return {'MessageId': response['Successful'][0]['MessageId']}
+
+    def send_message_batch(self, QueueUrl: str, Entries: list, **kwargs) -> dict:
+        with self._cond:
+            q = self._queue(QueueUrl, 'SendMessageBatch')
+            successful = []
+            records = []
+            now = time.time()
+            for entry in Entries:
+                msg_id = uuid.uuid4().hex
+                msg = {'body': entry['MessageBody'], 'count': 0, 'visible_at': 0, 'sent': now}
+                if entry.get('DelaySeconds'):
+                    # delayed messages wait in flight until their delay expires
+                    msg['visible_at'] = now + entry['DelaySeconds']
+                    q.inflight[msg_id] = msg
+                    heapq.heappush(q.expiry, (msg['visible_at'], msg_id, 0))
+                else:
+                    q.ready[msg_id] = msg
+                records.append(self._send_record(q, msg_id, msg))
+                successful.append({'Id': entry['Id'], 'MessageId': msg_id})
+            self._log(*records)
+            self._cond.notify_all()
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl: str, MaxNumberOfMessages: int = 1, WaitTimeSeconds: int = 0,
+                        VisibilityTimeout: Optional[int] = None, **kwargs) -> dict:
+        end = time.monotonic() + (WaitTimeSeconds or 0)
+        with self._cond:
+            q = self._queue(QueueUrl, 'ReceiveMessage')
+            visibility = VisibilityTimeout if VisibilityTimeout is not None else \
+                int(q.attributes.get('VisibilityTimeout', DEFAULT_VISIBILITY))
+
+            while True:
+                now = time.time()
+                q.restore_expired(now)
+                if q.ready:
+                    break
+
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return {}
+                expiry = q.next_expiry()
+                self._cond.wait(min(remaining, expiry - now) if expiry else remaining)
+
+            messages = []
+            records = []
+            while q.ready and len(messages) < MaxNumberOfMessages:
+                msg_id, msg = q.ready.popitem(last=False)
+                msg['count'] += 1
+                msg['visible_at'] = now + visibility
+                q.inflight[msg_id] = msg
+                heapq.heappush(q.expiry, (msg['visible_at'], msg_id, msg['count']))
+                records.append({'op': 'receive', 'q': q.name, 'id': msg_id, 'count': msg['count']})
+                messages.append({'MessageId': msg_id,
+                                 'ReceiptHandle': f'{msg_id}:{msg["count"]}',
+                                 'Body': msg['body'],
+                                 'Attributes': {'ApproximateReceiveCount': str(msg['count']),
+                                                'SentTimestamp': str(int(msg['sent'] * 1000))}})
+            self._log(*records)
+
+        return {'Messages': messages}
+
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str, **kwargs) -> dict:
+        self.delete_message_batch(QueueUrl, [{'Id': '0', 'ReceiptHandle': ReceiptHandle}])
+        return {}
+
+    def delete_message_batch(self, QueueUrl: str, Entries: list, **kwargs) -> dict:
+        with self._cond:
+            q = self._queue(QueueUrl, 'DeleteMessageBatch')
+            successful = []
+            records = []
+            for entry in Entries:
+                msg_id = entry['ReceiptHandle'].split(':', 1)[0]
+                if q.inflight.pop(msg_id, None) is not None or q.ready.pop(msg_id, None) is not None:
+                    records.append({'op': 'delete', 'q': q.name, 'id': msg_id})
+                # like SQS, deleting a message that's already gone succeeds
+                successful.append({'Id': entry['Id']})
+            self._log(*records)
+        return {'Successful': successful, 'Failed': []}
+
+    def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: int,
+                                  **kwargs) -> dict:
+        msg_id, count = ReceiptHandle.split(':', 1)
+        with self._cond:
+            q = self._queue(QueueUrl, 'ChangeMessageVisibility')
+            msg = q.inflight.get(msg_id)
+            if msg is None or msg['count'] != int(count):
+                raise ClientError({'Error': {'Code': 'InvalidParameterValue',
+                                             'Message': f'Message {msg_id} is not in flight'}},
+                                  'ChangeMessageVisibility')
+            msg['visible_at'] = time.time() + VisibilityTimeout
+            heapq.heappush(q.expiry, (msg['visible_at'], msg_id, msg['count']))
+            self._cond.notify_all()
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl: str, Entries: list, **kwargs) -> dict:
+        successful = []
+        failed = []
+        for entry in Entries:
+            try:
+                self.change_message_visibility(QueueUrl, entry['ReceiptHandle'], entry['VisibilityTimeout'])
+                successful.append({'Id': entry['Id']})
+            except ClientError as ce:
+                if ce.response['Error']['Code'] in ['AWS.SimpleQueueService.NonExistentQueue']:
+                    raise
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': ce.response['Error']['Code'],
+                               'Message': ce.response['Error']['Message']})
+        return {'Successful': successful, 'Failed': failed}
+
+    def get_queue_attributes(self, QueueUrl: str, AttributeNames: list = None, **kwargs) -> dict:
+        with self._cond:
+            q = self._queue(QueueUrl, 'GetQueueAttributes')
+            q.restore_expired(time.time())
+            attributes = dict(q.attributes)
+            attributes.update({'ApproximateNumberOfMessages': str(len(q.ready)),
+                               'ApproximateNumberOfMessagesNotVisible': str(len(q.inflight)),
+                               'ApproximateNumberOfMessagesDelayed': '0'})
+        if AttributeNames and 'All' not in AttributeNames:
+            attributes = {k: v for k, v in attributes.items() if k in AttributeNames}
+        return {'Attributes': attributes}
+
+    def purge_queue(self, QueueUrl: str, **kwargs) -> dict:
+        with self._cond:
+            q = self._queue(QueueUrl, 'PurgeQueue')
+            q.ready.clear()
+            q.inflight.clear()
+            q.expiry.clear()
+            self._log({'op': 'purge', 'q': q.name})
+        return {}
+
+    def close(self):
+        with self._journal_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def create_backend(config: Optional[dict] = None):
+    """
+    Creates the queue backend selected in 'aws.queue.backend': 'sqs' (default) or 'local'
+    """
+    queue = (config or {}).get('aws', {}).get('queue', {})
+    backend = queue.get('backend', 'sqs')
+
+    if backend == 'local':
+        logger.info(f'Using local queues, journal: {queue.get("journal")}')
+        return LocalQueueBackend(queue.get('journal'), sync=queue.get('sync', False))
+    elif backend == 'sqs':
+        return boto3.client('sqs')
+    else:
+        raise ValueError(f'Invalid queue backend "{backend}", check your configuration')
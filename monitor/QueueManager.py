@@ -1,15 +1,36 @@
 import logging
 import platform
 import time
+import uuid
+from collections import deque
+from threading import Lock, Thread, Event
+from typing import Optional
 
 import boto3
 import watchtower
 from botocore.exceptions import ClientError
 
+from monitor.InFlightRegistry import sample_key, DEFER_DELAY
+from monitor.Metrics import QUEUE_DEPTH, QUEUE_INFLIGHT
+from monitor.QueueBackend import QueueBackend
+from monitor.exceptions import QueueClientException
+
 QUEUES = [{'type': 'conversion', 'name': 'MonitorConversionQueue'},
           {'type': 'upload', 'name': 'MonitorUploadQueue'},
           {'type': 'preprocess', 'name': 'MonitorPreprocessingQueue'}]
 
+MAX_BATCH = 10  # SQS limit for receive, send and delete batches
+WAIT_TIME = 20  # SQS long-polling limit (seconds)
+VISIBILITY_TIMEOUT = 400
+HEARTBEAT_INTERVAL = VISIBILITY_TIMEOUT // 3  # seconds between visibility extensions of leased messages
+MAX_RECEIVES = 5  # deliveries of a leased message before it's dropped
+BACKOFF = 30  # seconds a failed message stays hidden, doubled on every delivery
+MAX_BACKOFF = 3600
+MAX_DELAY = 900  # SQS limit for message delays (seconds)
+FIFO_ATTRIBUTES = {'FifoQueue': 'true', 'ContentBasedDeduplication': 'true'}
+QUEUE_NOT_FOUND = ['AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist']
+DEPTH_INTERVAL = 15  # seconds between samples of the queue depths
+
 logger = logging.getLogger('QueueManager')
 # if not logger.handlers:
 #     h = watchtower.CloudWatchLogHandler(
@@ -22,76 +43,545 @@ logger.setLevel(logging.INFO)
 
 class QueueManager:
 
-    def __init__(self, stage: str, host: str = platform.node()):
+    def __init__(self, stage: str, host: str = platform.node(), wait_time: int = WAIT_TIME,
+                 backend: Optional[QueueBackend] = None, leases: bool = False, max_receives: int = MAX_RECEIVES,
+                 fifo: bool = False):
+        """
+
+        Args:
+            stage: str
+                Stage suffix of the queue names ('prod' or 'test')
+            host: str (Optional. Default: platform.node())
+                Host name used in the queue names
+            wait_time: int (Optional. Default: 20)
+                Seconds to long-poll a queue when there are no messages available
+            backend: QueueBackend (Optional. Default: None)
+                Queue backend, a boto3 SQS client if missing (see QueueBackend.create_backend)
+            leases: bool (Optional. Default: False)
+                When True, next_message leaves the messages in the queue until the workers ack them
+            max_receives: int (Optional. Default: 5)
+                Deliveries of a leased message before a failed sample is dropped instead of retried
+            fifo: bool (Optional. Default: False)
+                Use SQS FIFO queues with content-based deduplication. Messages are grouped by sample, so the
+                messages of a sample are never in flight at the same time, even on different hosts
+        """
         self.stage = stage
-        self.sqs = boto3.client('sqs')
+        self.sqs = backend or boto3.client('sqs')
         self.host = host
+        self.wait_time = wait_time
+        self.fifo = fifo
+
+        self._buffers = {}
+        self._buffers_lock = Lock()
+
+        # queue type -> queue url, shared by all worker threads
+        self._urls = {}
+        self._urls_lock = Lock()
+
+        # queue type -> (visible messages, in-flight messages), refreshed by a QueueDepthSampler
+        self._depths = {}
+
+        # (queue url, message body) -> list of {'ReceiptHandle', 'count', 'extended'}, messages received but not
+        # acked. Workers only know the sample, so every message of the same sample shares its fate
+        self.leases = leases
+        self.max_receives = max_receives
+        self._leases = {}
+        self._leases_lock = Lock()
+
         self.init_queues()
 
     def conversion_q(self):
-        q = list(filter(lambda x: x['type'] == 'conversion', QUEUES))[0]
-        queue = self.__get_queue(f"{q['name']}-{self.host}-{self.stage}")
-        if not queue:
-            time.sleep(5)
-            queue = self.__get_queue(f"{q['name']}-{self.host}-{self.stage}")
-            if not queue:
-                raise QueueClientException(f'Failed to get queue url twice')
-                return None
-        return queue['QueueUrl']
+        return self.__get_queue_url('conversion')
 
     def upload_q(self):
-        q = list(filter(lambda x: x['type'] == 'upload', QUEUES))[0]
-        return self.__get_queue(f"{q['name']}-{self.host}-{self.stage}")['QueueUrl']
+        return self.__get_queue_url('upload')
+
+    def process_q(self):
+        return self.__get_queue_url('preprocess')
+
+    def queue_name(self, queue_type: str) -> str:
+        """Returns the fully qualified name of the queue of the given type"""
+        q = list(filter(lambda x: x['type'] == queue_type, QUEUES))[0]
+        return f"{q['name']}-{self.host}-{self.stage}{'.fifo' if self.fifo else ''}"
+
+    def receive_messages(self, queue_url: str, max_messages: int = MAX_BATCH, wait_time: int = None) -> list:
+        """
+        Long-polls a queue for up to max_messages and removes them from the queue with a single batch call
+        Args:
+            queue_url: url of the queue to read
+            max_messages: maximum number of messages to receive (1 to 10)
+            wait_time: seconds to wait for messages to arrive (Optional. Default: self.wait_time)
 
-    def get_next_message(self, queue_url: str):
-        data = self.sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1, VisibilityTimeout=400)
-        msg = {}
+        Returns:
+            A list with the bodies of the received messages, empty if the wait time expired
+        """
+        data = self.__call(self.sqs.receive_message, queue_url,
+                           MaxNumberOfMessages=max(1, min(max_messages, MAX_BATCH)),
+                           WaitTimeSeconds=self.wait_time if wait_time is None else wait_time,
+                           VisibilityTimeout=VISIBILITY_TIMEOUT)
+        messages = data.get('Messages', [])
 
-        if data.get('Messages', []):
-            msg = data['Messages'][0]
-            self.sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=msg['ReceiptHandle'])
+        if messages:
+            self.__delete_messages(queue_url, messages)
 
-        return msg.get('Body', '')
+        return [msg['Body'] for msg in messages]
 
-    def put_message(self, queue_url, message: str):
-        self.sqs.send_message(
-            QueueUrl=queue_url,
-            DelaySeconds=0,
-            MessageBody=message
-        )
+    def get_next_message(self, queue_url: str, wait_time: int = None):
+        """
+        Returns the next message of a queue, served from a local buffer that is refilled in batches
+        Args:
+            queue_url: url of the queue to read
+            wait_time: seconds to wait for messages to arrive (Optional. Default: self.wait_time)
+
+        Returns:
+            The body of the message or an empty string if the queue is empty
+        """
+        buffer = self.__get_buffer(queue_url)
+
+        if not buffer:
+            buffer.extend(self.receive_messages(queue_url, wait_time=wait_time))
+
+        try:
+            return buffer.popleft()
+        except IndexError:
+            # another worker emptied the buffer first
+            return ''
+
+    def next_message(self, queue_url: str, wait_time: int = None):
+        """
+        Returns the next message of a queue. With leases enabled the message stays in the queue, hidden, until
+        it's acked or nacked, otherwise it's deleted as soon as it's received (see get_next_message)
+        Args:
+            queue_url: url of the queue to read
+            wait_time: seconds to wait for messages to arrive (Optional. Default: self.wait_time)
+
+        Returns:
+            The body of the message or an empty string if the queue is empty
+        """
+        if not self.leases:
+            return self.get_next_message(queue_url, wait_time)
+
+        buffer = self.__get_buffer(queue_url, leased=True)
+
+        if not buffer:
+            buffer.extend(self.lease_messages(queue_url, wait_time=wait_time))
 
-    def __get_queue(self, name: str):
         try:
-            return self.sqs.get_queue_url(QueueName=name)
+            return buffer.popleft()
+        except IndexError:
+            return ''
+
+    def lease_messages(self, queue_url: str, max_messages: int = MAX_BATCH, wait_time: int = None) -> list:
+        """
+        Long-polls a queue for up to max_messages and keeps them hidden in the queue until they are acked
+        Returns:
+            A list with the bodies of the received messages, empty if the wait time expired
+        """
+        data = self.__call(self.sqs.receive_message, queue_url,
+                           MaxNumberOfMessages=max(1, min(max_messages, MAX_BATCH)),
+                           WaitTimeSeconds=self.wait_time if wait_time is None else wait_time,
+                           VisibilityTimeout=VISIBILITY_TIMEOUT,
+                           AttributeNames=['ApproximateReceiveCount'])
+        messages = data.get('Messages', [])
+
+        now = time.monotonic()
+        with self._leases_lock:
+            for msg in messages:
+                self._leases.setdefault((queue_url, msg['Body']), []).append(
+                    {'ReceiptHandle': msg['ReceiptHandle'],
+                     'count': int(msg.get('Attributes', {}).get('ApproximateReceiveCount', 1)),
+                     'extended': now})
+
+        return [msg['Body'] for msg in messages]
+
+    def ack(self, queue_url: str, body: str) -> int:
+        """
+        Deletes the leased messages with the given body, once their stage succeeded. Does nothing for messages
+        that weren't leased
+        Returns:
+            The number of messages deleted
+        """
+        with self._leases_lock:
+            leases = self._leases.pop((queue_url, body), [])
+
+        if leases:
+            self.__delete_messages(queue_url, leases)
+        return len(leases)
+
+    def nack(self, queue_url: str, body: str, delay: int = None) -> bool:
+        """
+        Returns the leased messages with the given body to the queue after a backoff that doubles on every
+        delivery. Messages delivered max_receives times are deleted instead
+        Args:
+            queue_url: url of the queue
+            body: message body
+            delay: seconds before the messages are visible again (Optional. Default: exponential backoff)
+
+        Returns:
+            True if a message will be delivered again
+        """
+        with self._leases_lock:
+            leases = self._leases.pop((queue_url, body), [])
+
+        retried = False
+        for lease in leases:
+            if lease['count'] >= self.max_receives:
+                logger.error(f'Giving up on "{body}" after {lease["count"]} deliveries, removing it from the queue')
+                self.__delete_messages(queue_url, [lease])
+                continue
+
+            backoff = delay if delay is not None else min(BACKOFF * 2 ** (lease['count'] - 1), MAX_BACKOFF)
+            try:
+                self.__call(self.sqs.change_message_visibility, queue_url,
+                            ReceiptHandle=lease['ReceiptHandle'], VisibilityTimeout=int(backoff))
+                logger.info(f'\t"{body}" will be retried in {backoff} seconds (delivery {lease["count"]})')
+                retried = True
+            except ClientError as ce:
+                # the lease expired, the message is already visible again
+                logger.warning(f'Can\'t delay "{body}": {str(ce)}')
+                retried = True
+
+        return retried
+
+    def leased(self) -> int:
+        """Number of messages received and not acked yet"""
+        with self._leases_lock:
+            return sum(len(leases) for leases in self._leases.values())
+
+    def extend_leases(self, older_than: float = HEARTBEAT_INTERVAL) -> int:
+        """
+        Resets the visibility timeout of the leased messages last extended more than 'older_than' seconds ago.
+        Messages whose lease can't be extended are forgotten, they were already delivered again
+        Returns:
+            The number of messages extended
+        """
+        now = time.monotonic()
+        # queue url -> [(body, lease)]
+        due = {}
+        with self._leases_lock:
+            for (url, body), leases in self._leases.items():
+                due.setdefault(url, []).extend((body, lease) for lease in leases
+                                               if now - lease['extended'] >= older_than)
+
+        extended = 0
+        for url, items in due.items():
+            for i in range(0, len(items), MAX_BATCH):
+                batch = items[i:i + MAX_BATCH]
+                entries = [{'Id': str(idx), 'ReceiptHandle': lease['ReceiptHandle'],
+                            'VisibilityTimeout': VISIBILITY_TIMEOUT} for idx, (_, lease) in enumerate(batch)]
+                try:
+                    response = self.__call(self.sqs.change_message_visibility_batch, url, Entries=entries)
+                except ClientError as ce:
+                    logger.error(f'Can\'t extend the leases of {url}: {str(ce)}')
+                    continue
+
+                failed = {int(f['Id']) for f in response.get('Failed', [])}
+                with self._leases_lock:
+                    for idx, (body, lease) in enumerate(batch):
+                        if idx not in failed:
+                            lease['extended'] = now
+                            extended += 1
+                            continue
+
+                        logger.warning(f'Lost the lease of "{body}", it will be delivered again')
+                        leases = self._leases.get((url, body), [])
+                        if lease in leases:
+                            leases.remove(lease)
+                        if not leases:
+                            self._leases.pop((url, body), None)
+
+        return extended
+
+    def release_leases(self) -> int:
+        """Makes every leased message visible again at once, ie: on shutdown, so no work waits for a timeout"""
+        with self._buffers_lock:
+            for (url, leased), buffer in self._buffers.items():
+                buffer.clear() if leased else None
+        with self._leases_lock:
+            leases = list(self._leases.items())
+            self._leases.clear()
+
+        released = 0
+        for (url, body), items in leases:
+            for lease in items:
+                try:
+                    self.__call(self.sqs.change_message_visibility, url,
+                                ReceiptHandle=lease['ReceiptHandle'], VisibilityTimeout=0)
+                    released += 1
+                except ClientError as ce:
+                    logger.warning(f'Can\'t release "{body}": {str(ce)}')
+
+        logger.info(f'Released {released} leased messages')
+        return released
+
+    def put_message(self, queue_url, message: str, delay: int = 0):
+        self.__call(self.sqs.send_message, queue_url,
+                    MessageBody=message,
+                    **self.__send_args(message, delay))
+
+    def defer(self, queue_url: str, message: str, delay: int = DEFER_DELAY):
+        """
+        Delivers a message again after 'delay' seconds, ie: a duplicate of a sample still in flight.
+        A leased message is hidden for the delay and the delivery counts towards max_receives, otherwise the
+        message is sent again
+        """
+        with self._leases_lock:
+            leased = (queue_url, message) in self._leases
+
+        if leased:
+            self.nack(queue_url, message, delay)
+        elif self.fifo:
+            # FIFO queues don't delay single messages, and would drop a copy sent within 5 minutes
+            self.__call(self.sqs.send_message, queue_url, MessageBody=message,
+                        MessageDeduplicationId=uuid.uuid4().hex, **self.__send_args(message))
+        else:
+            self.put_message(queue_url, message, delay)
+
+    def __send_args(self, message: str, delay: int = 0) -> dict:
+        """Per message arguments of send_message and send_message_batch entries"""
+        if self.fifo:
+            return {'MessageGroupId': sample_key(message)}
+        return {'DelaySeconds': max(0, min(int(delay), MAX_DELAY))}
+
+    def put_messages(self, queue_url, messages: list) -> int:
+        """
+        Sends several messages to a queue using batches of up to 10 messages
+        Args:
+            queue_url: url of the destination queue
+            messages: list of message bodies
+
+        Returns:
+            The number of messages sent
+        """
+        sent = 0
+        for i in range(0, len(messages), MAX_BATCH):
+            batch = messages[i:i + MAX_BATCH]
+            entries = [{'Id': str(idx), 'MessageBody': msg, **self.__send_args(msg)}
+                       for idx, msg in enumerate(batch)]
+            response = self.__call(self.sqs.send_message_batch, queue_url, Entries=entries)
+            sent += len(response.get('Successful', []))
+
+            for failed in response.get('Failed', []):
+                logger.warning(f'Failed to send message in batch ({failed.get("Message")}), sending it alone')
+                self.put_message(queue_url, batch[int(failed['Id'])])
+                sent += 1
+
+        return sent
+
+    def __get_buffer(self, queue_url: str, leased: bool = False) -> deque:
+        with self._buffers_lock:
+            return self._buffers.setdefault((queue_url, leased), deque())
+
+    def __delete_messages(self, queue_url: str, messages: list):
+        for i in range(0, len(messages), MAX_BATCH):
+            entries = [{'Id': str(idx), 'ReceiptHandle': msg['ReceiptHandle']}
+                       for idx, msg in enumerate(messages[i:i + MAX_BATCH])]
+            response = self.__call(self.sqs.delete_message_batch, queue_url, Entries=entries)
+
+            for failed in response.get('Failed', []):
+                logger.error(f'Failed to delete message {failed["Id"]} from {queue_url}: {failed.get("Message")}')
+
+    def __get_queue_url(self, queue_type: str) -> str:
+        url = self._urls.get(queue_type)
+        if url is None:
+            url = self.__refresh_queue_url(queue_type)
+        return url
+
+    def __refresh_queue_url(self, queue_type: str, stale_url: str = None) -> str:
+        """Resolves the url of a queue, recreating the queue if it doesn't exist anymore"""
+        with self._urls_lock:
+            url = self._urls.get(queue_type)
+            if url is not None and url != stale_url:
+                # already resolved by another thread
+                return url
+
+            name = self.queue_name(queue_type)
+            try:
+                url = self.sqs.get_queue_url(QueueName=name)['QueueUrl']
+            except ClientError as ce:
+                if ce.response['Error']['Code'] not in QUEUE_NOT_FOUND:
+                    raise QueueClientException(f'Failed to get url of queue "{name}": {str(ce)}')
+                logger.warning(f'Queue "{name}" does not exist, creating it')
+                try:
+                    url = self.sqs.create_queue(QueueName=name, **self.__create_args())['QueueUrl']
+                except ClientError as ex:
+                    raise QueueClientException(f'Failed to create queue "{name}": {str(ex)}')
+
+            self._urls[queue_type] = url
+            return url
+
+    def __call(self, operation, queue_url: str, **kwargs):
+        """Runs an SQS operation on a queue, refreshing the cached queue url once if SQS can't find the queue"""
+        try:
+            return operation(QueueUrl=queue_url, **kwargs)
         except ClientError as ce:
-            logger.error(f'Queue "{name}" does not exist.')
-            quit()
-        except Exception as ex:
-            print(f'Exception {type(ex)}')
+            queue_type = next((k for k, v in list(self._urls.items()) if v == queue_url), None)
+            if ce.response['Error']['Code'] not in QUEUE_NOT_FOUND or queue_type is None:
+                raise
+
+            logger.warning(f'Queue {queue_url} not found, refreshing its url')
+            return operation(QueueUrl=self.__refresh_queue_url(queue_type, queue_url), **kwargs)
+
+    def __create_args(self) -> dict:
+        return {'Attributes': dict(FIFO_ATTRIBUTES)} if self.fifo else {}
 
     def get_size(self, queue_url: str):
-        return int(self.sqs.get_queue_attributes(
-            QueueUrl=queue_url,
-            AttributeNames=["ApproximateNumberOfMessages"]
-        )["Attributes"]["ApproximateNumberOfMessages"])
+        return int(self.__call(self.sqs.get_queue_attributes, queue_url,
+                               AttributeNames=["ApproximateNumberOfMessages"]
+                               )["Attributes"]["ApproximateNumberOfMessages"])
+
+    def sample_depths(self) -> dict:
+        """
+        Reads the number of visible and in-flight messages of every queue, a queue that can't be read keeps its
+        last known depth
+        Returns:
+            A dict queue type -> (visible, in-flight)
+        """
+        for q in QUEUES:
+            try:
+                attributes = self.__call(self.sqs.get_queue_attributes, self.__get_queue_url(q['type']),
+                                         AttributeNames=['ApproximateNumberOfMessages',
+                                                         'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+            except Exception as ex:
+                logger.warning(f'Can\'t read the depth of the {q["type"]} queue: {str(ex)}')
+                continue
+
+            depth = (int(attributes.get('ApproximateNumberOfMessages', 0)),
+                     int(attributes.get('ApproximateNumberOfMessagesNotVisible', 0)))
+            self._depths[q['type']] = depth
+            QUEUE_DEPTH.labels(q['type']).set(depth[0])
+            QUEUE_INFLIGHT.labels(q['type']).set(depth[1])
+
+        return dict(self._depths)
+
+    def depth(self, queue_type: str, inflight: bool = True) -> int:
+        """
+        Last sampled depth of a queue, without calling the queue service. The queues are sampled once if no
+        sampler ran yet
+        Args:
+            queue_type: 'conversion', 'upload' or 'preprocess'
+            inflight: include the messages received but not deleted yet
+
+        Returns:
+            The number of messages in the queue
+        """
+        if queue_type not in self._depths:
+            self.sample_depths()
+
+        visible, received = self._depths.get(queue_type, (0, 0))
+        return visible + received if inflight else visible
 
     def clean(self, queue_url):
-        self.sqs.purge_queue(QueueUrl=queue_url)
+        self.__get_buffer(queue_url).clear()
+        self.__get_buffer(queue_url, leased=True).clear()
+        with self._leases_lock:
+            for key in [k for k in self._leases if k[0] == queue_url]:
+                del self._leases[key]
+        self.__call(self.sqs.purge_queue, queue_url)
 
     def init_queues(self):
         qs = self.sqs.list_queues()
-        queues = [item.rsplit('/')[-1] for item in qs.get('QueueUrls',[])]
+        queues = {item.rsplit('/')[-1]: item for item in qs.get('QueueUrls', [])}
 
         for q in QUEUES:
-            fqqn = f"{q['name']}-{self.host}-{self.stage}"
+            fqqn = self.queue_name(q['type'])
             logger.info(f'Checking queue {fqqn}')
 
             try:
                 if fqqn not in queues:
-                    self.sqs.create_queue(QueueName=fqqn)
+                    url = self.sqs.create_queue(QueueName=fqqn, **self.__create_args())['QueueUrl']
                     logger.info(f'\tQueue {fqqn} created')
                 else:
+                    url = queues[fqqn]
                     logger.info(f'\tQueue {fqqn} already exists')
+
+                with self._urls_lock:
+                    self._urls[q['type']] = url
             except ClientError as ex:
                 logger.error(f'Error creating queue', ex.args)
                 pass
+
+
+class QueueDepthSampler(Thread):
+    """
+    Samples the depth of all the queues of a QueueManager on an interval, so workers, the pool supervisor and the
+    metrics read a cached value instead of calling the queue service for every item
+    """
+
+    def __init__(self, queue_mgr: QueueManager, interval: float = DEPTH_INTERVAL, name='QueueSampler',
+                 daemon=True):
+        """
+
+        Args:
+            queue_mgr: QueueManager
+                The QueueManager whose queues are sampled
+            interval: float (Optional. Default: 15)
+                Seconds between samples
+            name: str (Optional. Default: QueueSampler)
+                Name of the thread
+            daemon:
+                Run the sampler as daemon. (Optional. Default: True)
+        """
+        super().__init__(name=name, daemon=daemon)
+        self.queue_mgr = queue_mgr
+        self.interval = interval
+        # set here so a join before the thread starts stops it for good
+        self.running = True
+        self._wake = Event()
+
+    def run(self):
+        while self.running:
+            start = time.monotonic()
+            depths = self.queue_mgr.sample_depths()
+            logger.debug(f'Queue depths (visible, in-flight): {depths}, '
+                         f'sampled in {time.monotonic() - start:.2f}s')
+            if self._wake.wait(self.interval):
+                break
+
+    def join(self, timeout=None):
+        # Monitor.join_threads sets running to False, don't wait for the interval to end
+        self.running = False
+        self._wake.set()
+        if self.ident is not None:
+            super().join(timeout)
+
+
+class LeaseHeartbeat(Thread):
+    """
+    Extends the visibility timeout of the messages leased by a QueueManager while their samples are being settled,
+    converted or uploaded, so long stages don't make them visible to other workers
+    """
+
+    def __init__(self, queue_mgr: QueueManager, interval: float = HEARTBEAT_INTERVAL, name='LeaseHeartbeat',
+                 daemon=True):
+        """
+
+        Args:
+            queue_mgr: QueueManager
+                The QueueManager holding the leases
+            interval: float (Optional. Default: 133)
+                Seconds between extensions, must be shorter than the visibility timeout
+            name: str (Optional. Default: LeaseHeartbeat)
+                Name of the thread
+            daemon:
+                Run the heartbeat as daemon. (Optional. Default: True)
+        """
+        super().__init__(name=name, daemon=daemon)
+        self.queue_mgr = queue_mgr
+        self.interval = min(interval, VISIBILITY_TIMEOUT / 2)
+        self.running = True
+        self._wake = Event()
+
+    def run(self):
+        while not self._wake.wait(self.interval / 2) and self.running:
+            try:
+                extended = self.queue_mgr.extend_leases(self.interval)
+                logger.debug(f'Extended {extended} of {self.queue_mgr.leased()} leases')
+            except Exception as ex:
+                logger.error(f'Error extending leases: {str(ex)}')
+
+    def join(self, timeout=None):
+        self.running = False
+        self._wake.set()
+        if self.ident is not None:
+            super().join(timeout)
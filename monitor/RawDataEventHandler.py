@@ -1,17 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import logging
+import os
 import platform
+import time
+from threading import Thread, Lock, Event, Condition
 
-import boto3
 import watchtower
 from watchdog.events import RegexMatchingEventHandler
 
 from monitor.QueueManager import QueueManager
+from monitor.SampleFilter import SampleFilter, FOLDERS_RX, FILES_RX
+from monitor.TraceStore import TraceStore
 from monitor.client.BackendClient import BackendClient
 
-FOLDERS_RX = r'^.*?\.d$'
-FILES_RX = r'^.*?\.(?:raw|wiff|mzml)$'
+QUIET_WINDOW = 30  # seconds without events before a sample is sent to the conversion queue
 
 logger = logging.getLogger('RawDataEventHandler')
 # if not logger.handlers:
@@ -24,10 +27,13 @@ logger = logging.getLogger('RawDataEventHandler')
 
 class RawDataEventHandler(RegexMatchingEventHandler):
     """
-    A custom file event handler for watchdog
+    A custom file event handler for watchdog.
+    Events are coalesced by sample path and a sample is queued for conversion only once it had no new events
+    for a 'quiet window'. Paths rejected by the sample filter are dropped at event time, before reaching the queue
     """
 
-    def __init__(self, backend_cli: BackendClient, queue_mgr: QueueManager, extensions, test: bool = False):
+    def __init__(self, backend_cli: BackendClient, queue_mgr: QueueManager, extensions, test: bool = False,
+                 quiet_window: float = QUIET_WINDOW, sample_filter: SampleFilter = None, traces: TraceStore = None):
         """
         Args:
             st_cli: StasisClient
@@ -38,21 +44,115 @@ class RawDataEventHandler(RegexMatchingEventHandler):
                 An array of valid lower cased file extensions (['.d', '.raw', '.wiff', '.mzml])
             test: Boolean
                 A boolean indicating test run when True
+            quiet_window: float (Optional. Default: 30)
+                Seconds without events on a sample before it is sent to the conversion queue
+            sample_filter: SampleFilter (Optional. Default: None)
+                Filter rejecting invalid samples, a filter checking only the extensions is used if missing
+            traces: TraceStore (Optional. Default: None)
+                Store of the sample spans, queued samples are saved as 'enqueue' events
         """
 
         super().__init__(regexes=[FOLDERS_RX, FILES_RX])
 
-        self.sqs = boto3.client('sqs')
-
         self.backend_cli = backend_cli
         self.queue_mgr = queue_mgr
         self.extensions = extensions
         self.test = test
+        self.quiet_window = quiet_window
+        self.filter = sample_filter or SampleFilter(extensions=extensions)
+        self.traces = traces
+
+        # normalized sample path -> [sample path, time of last event]
+        self._pending = {}
+        self._lock = Lock()
+        # wakes the flusher when a sample is added, so its quiet window starts from its first event
+        self._added = Condition(self._lock)
+        self._stopped = Event()
+
+        self._flusher = Thread(target=self._flush_loop, name='EventCoalescer', daemon=True)
+        self._flusher.start()
 
     def on_created(self, event):
         logger.debug(f'file created: {event.src_path}')
-        self.queue_mgr.put_message(self.queue_mgr.conversion_q(), event.src_path)
+        self.add_sample(event.src_path)
 
     def on_moved(self, event):
         logger.debug(f'file moved: {event.dest_path}')
-        self.queue_mgr.put_message(self.queue_mgr.conversion_q(), event.dest_path)
+        with self._lock:
+            self._pending.pop(os.path.normcase(event.src_path), None)
+        self.add_sample(event.dest_path)
+
+    def add_sample(self, path: str):
+        """Registers an event for a sample, restarting its quiet window"""
+        rule = self.filter.check(path)
+        if rule:
+            logger.debug(f'Ignoring {path}, rejected by rule {rule}')
+            return
+
+        key = os.path.normcase(path)
+        with self._lock:
+            new = key not in self._pending
+            self._pending[key] = [path, time.monotonic()]
+            if new:
+                self._added.notify()
+
+    def flush(self, force: bool = False) -> int:
+        """
+        Sends the samples whose quiet window has expired to the conversion queue
+        Args:
+            force: send all pending samples regardless of their quiet window
+
+        Returns:
+            The number of samples sent
+        """
+        now = time.monotonic()
+        with self._lock:
+            ready = [k for k, (_, last) in self._pending.items() if force or now - last >= self.quiet_window]
+            samples = [self._pending.pop(k)[0] for k in ready]
+
+        if not samples:
+            return 0
+
+        logger.info(f'Adding {len(samples)} sample(s) to the conversion queue')
+        try:
+            if len(samples) == 1:
+                self.queue_mgr.put_message(self.queue_mgr.conversion_q(), samples[0])
+            else:
+                self.queue_mgr.put_messages(self.queue_mgr.conversion_q(), samples)
+        except Exception:
+            # keep the samples for the next flush
+            with self._lock:
+                for sample in samples:
+                    self._pending.setdefault(os.path.normcase(sample), [sample, now])
+            raise
+
+        self.traces.events(samples, 'enqueue') if self.traces else None
+        return len(samples)
+
+    def stop(self):
+        """Stops the coalescing thread and sends any pending samples"""
+        with self._lock:
+            self._stopped.set()
+            self._added.notify()
+        self._flusher.join()
+        self.flush(force=True)
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                if not self._stopped.is_set():
+                    self._added.wait(self._next_wait())
+                if self._stopped.is_set():
+                    return
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error(f'Error adding samples to the conversion queue: {str(ex)}')
+
+    def _next_wait(self) -> float:
+        """Seconds until the oldest pending sample is due, None to wait for a new sample. Call it holding _lock"""
+        if not self._pending:
+            return None
+        oldest = min(last for _, last in self._pending.values())
+
+        return max(0.0, oldest + self.quiet_window - time.monotonic())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import os
+import platform
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import watchtower
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, FileCreatedEvent, FileDeletedEvent
+from watchdog.observers.api import BaseObserver, EventEmitter
+
+POLL_INTERVAL = 5  # seconds between polls of a monitored path
+POLL_WORKERS = 8  # folders stat'ed or listed concurrently, shared by all the monitored paths
+MTIME_SLACK = 2  # seconds, folders modified this close to a poll are listed again on the next one
+
+logger = logging.getLogger('RemoteObserver')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+def is_bundle(name: str) -> bool:
+    """'.d' folders are samples, their content is never watched"""
+    return name.lower().endswith('.d')
+
+
+class RemoteEmitter(EventEmitter):
+    """
+    Polling emitter for network shares.
+    Keeps the modification time and entries of each folder and on every poll only lists again the folders whose
+    modification time changed, so a poll costs one stat per folder instead of one per file. '.d' folders are
+    treated as files. Emits created and deleted events
+    """
+
+    def __init__(self, event_queue, watch, timeout: float = POLL_INTERVAL, event_filter=None,
+                 max_depth: Optional[int] = None, pool: Optional[ThreadPoolExecutor] = None):
+        """
+
+        Args:
+            event_queue:
+                The observer's event queue
+            watch: ObservedWatch
+                The watched path
+            timeout: float (Optional. Default: 5)
+                Seconds between polls
+            event_filter: (Optional. Default: None)
+                Event types to emit, all if missing
+            max_depth: int (Optional. Default: None)
+                Deepest level of subfolders watched, unlimited if missing. 0 watches only the path itself
+            pool: ThreadPoolExecutor (Optional. Default: None)
+                Executor used to stat and list folders in parallel, a private one is created if missing
+        """
+        super().__init__(event_queue, watch, timeout=timeout, event_filter=event_filter)
+
+        self.max_depth = max_depth if watch.is_recursive else 0
+        self._pool = pool or ThreadPoolExecutor(POLL_WORKERS, thread_name_prefix='RemotePoll')
+
+        # folder -> [mtime in ns, depth, {entry name: is folder}]
+        self._dirs = {}
+        self._recent = set()
+
+    def on_thread_start(self):
+        start = time.monotonic()
+        self._crawl([(self.watch.path, 0)])
+        logger.info(f'Watching {len(self._dirs)} folders in {self.watch.path}, '
+                    f'initial scan took {time.monotonic() - start:.1f}s')
+
+    def queue_events(self, timeout: float):
+        # timeout works as the polling interval
+        if self.stopped_event.wait(timeout):
+            return
+
+        try:
+            for event in self.poll():
+                self.queue_event(event)
+        except FileNotFoundError:
+            self.queue_event(DirDeletedEvent(self.watch.path))
+            self.stop()
+
+    def poll(self) -> list:
+        """
+        Checks the watched folders once
+        Returns:
+            The events found, in order
+        """
+        if not self._dirs:
+            # the path couldn't be listed before
+            self._crawl([(self.watch.path, 0)])
+            if not self._dirs:
+                raise FileNotFoundError(self.watch.path)
+
+        poll_time = time.time()
+        folders = list(self._dirs)  # the watched path is always first
+        stats = list(self._pool.map(self._stat, folders))
+
+        if stats[0] is None:
+            raise FileNotFoundError(self.watch.path)
+
+        changed = [f for f, st in zip(folders, stats)
+                   if st is not None and (st.st_mtime_ns != self._dirs[f][0] or f in self._recent)]
+        # a change within the mtime resolution of this poll may not update the mtime again, check them next time
+        self._recent = {f for f, st in zip(folders, stats)
+                        if st is not None and st.st_mtime_ns >= (poll_time - MTIME_SLACK) * 1e9}
+
+        events = []
+        new_dirs = []
+        for folder, listing in zip(changed, self._pool.map(self._list, changed)):
+            if listing is None or folder not in self._dirs:
+                # gone, the parent's listing reports it
+                continue
+
+            _, depth, old = self._dirs[folder]
+            st, entries = listing
+            self._dirs[folder] = [st.st_mtime_ns, depth, entries]
+
+            for name in old.keys() - entries.keys():
+                path = os.path.join(folder, name)
+                if old[name]:
+                    self._forget(path)
+                events.append(DirDeletedEvent(path) if old[name] else FileDeletedEvent(path))
+
+            for name in sorted(entries.keys() - old.keys()):
+                path = os.path.join(folder, name)
+                events.append(DirCreatedEvent(path) if entries[name] else FileCreatedEvent(path))
+                if self._trackable(name, entries[name], depth + 1):
+                    new_dirs.append((path, depth + 1))
+
+        # report the content of new folders, ie: a plate folder copied to the share
+        for folder in self._crawl(new_dirs):
+            _, _, entries = self._dirs[folder]
+            events.extend(DirCreatedEvent(os.path.join(folder, n)) if d else FileCreatedEvent(os.path.join(folder, n))
+                          for n, d in sorted(entries.items()))
+
+        return events
+
+    def _trackable(self, name: str, is_dir: bool, depth: int) -> bool:
+        return is_dir and not is_bundle(name) and (self.max_depth is None or depth <= self.max_depth)
+
+    def _crawl(self, roots: list) -> list:
+        """
+        Lists folders and their trackable subfolders, level by level, in parallel
+        Returns:
+            The folders added
+        """
+        added = []
+        level = roots
+        while level:
+            listings = list(self._pool.map(self._list, [f for f, _ in level]))
+            next_level = []
+            for (folder, depth), listing in zip(level, listings):
+                if listing is None:
+                    continue
+                st, entries = listing
+                self._dirs[folder] = [st.st_mtime_ns, depth, entries]
+                added.append(folder)
+                next_level.extend((os.path.join(folder, n), depth + 1) for n, d in entries.items()
+                                  if self._trackable(n, d, depth + 1))
+            level = next_level
+        return added
+
+    def _forget(self, folder: str):
+        """Stops tracking a folder and its subfolders"""
+        prefix = folder + os.sep
+        for f in [f for f in self._dirs if f == folder or f.startswith(prefix)]:
+            del self._dirs[f]
+            self._recent.discard(f)
+
+    @staticmethod
+    def _stat(folder: str) -> Optional[os.stat_result]:
+        try:
+            return os.stat(folder)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _list(folder: str) -> Optional[tuple]:
+        """Returns a tuple (stat of the folder, {entry name: is folder}) or None if it can't be listed"""
+        try:
+            # stat before listing, a change during the listing shows up on the next poll
+            st = os.stat(folder)
+            with os.scandir(folder) as it:
+                return st, {e.name: e.is_dir(follow_symlinks=False) for e in it}
+        except OSError as ex:
+            logger.debug(f'Can\'t list {folder}: {str(ex)}')
+            return None
+
+
+class RemoteObserver(BaseObserver):
+    """
+    Observer for network shares using RemoteEmitter. All the watched paths share one pool of folder listers,
+    each path can have its own polling interval
+    """
+
+    def __init__(self, timeout: float = POLL_INTERVAL, max_depth: Optional[int] = None,
+                 intervals: Optional[dict] = None, workers: int = POLL_WORKERS):
+        """
+
+        Args:
+            timeout: float (Optional. Default: 5)
+                Default seconds between polls
+            max_depth: int (Optional. Default: None)
+                Deepest level of subfolders watched, unlimited if missing
+            intervals: dict (Optional. Default: None)
+                Seconds between polls of specific paths, overriding timeout
+            workers: int (Optional. Default: 8)
+                Number of folders stat'ed or listed concurrently
+        """
+        super().__init__(self._create_emitter, timeout=timeout)
+        self.max_depth = max_depth
+        self.intervals = {os.path.normcase(os.path.normpath(p)): t for p, t in (intervals or {}).items()}
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='RemotePoll')
+
+    def _create_emitter(self, event_queue, watch, timeout, event_filter=None) -> RemoteEmitter:
+        interval = self.intervals.get(os.path.normcase(os.path.normpath(watch.path)), timeout)
+        return RemoteEmitter(event_queue, watch, timeout=interval, event_filter=event_filter,
+                             max_depth=self.max_depth, pool=self._pool)
+
+    def stop(self):
+        super().stop()
+        self._pool.shutdown(wait=False)
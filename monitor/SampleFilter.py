@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import os
+import re
+from collections import Counter
+from threading import Lock
+from typing import Optional
+
+FOLDERS_RX = r'^.*?\.d$'
+FILES_RX = r'^.*?\.(?:raw|wiff|mzml)$'
+
+logger = logging.getLogger('SampleFilter')
+
+
+class SampleFilter:
+    """
+    Precompiled filter deciding which raw data paths are samples to convert.
+    A path is rejected if it isn't a raw data folder/file (FOLDERS_RX, FILES_RX), if its extension is not in the
+    configured extensions or if it matches any of the 'skip' patterns. Rejections are counted per rule
+    """
+
+    def __init__(self, skip: list = None, extensions: list = None):
+        """
+
+        Args:
+            skip: list (Optional)
+                Regex patterns of samples to skip (config 'monitor.skip')
+            extensions: list (Optional)
+                Valid lower cased file extensions (config 'monitor.extensions'). All extensions pass if missing
+        """
+        self.skip = list(skip or [])
+        self.extensions = {e.lower() for e in extensions} if extensions else None
+        self._kind_rx = re.compile(f'{FOLDERS_RX}|{FILES_RX}', re.IGNORECASE)
+
+        # one alternation for all the skip patterns, the named group tells which pattern matched
+        try:
+            self._skip_rx = re.compile('|'.join(f'(?P<skip{i}>{rx})' for i, rx in enumerate(self.skip))) \
+                if self.skip else None
+            self._skip_list = None
+        except re.error:
+            # patterns that can't be combined (ie: inline flags) are tested one by one
+            self._skip_rx = None
+            self._skip_list = [re.compile(rx) for rx in self.skip]
+
+        self._counters = Counter()
+        self._lock = Lock()
+
+    def check(self, path: str) -> Optional[str]:
+        """
+        Returns the name of the rule rejecting a path ('type', 'extension' or 'skip:<pattern>'),
+        or None if the path is a valid sample
+        """
+        rule = self._match(path)
+
+        with self._lock:
+            self._counters[rule or 'accepted'] += 1
+
+        return rule
+
+    def accepts(self, path: str) -> bool:
+        return self.check(path) is None
+
+    def stats(self) -> dict:
+        """Number of paths accepted and rejected by each rule"""
+        with self._lock:
+            return dict(self._counters)
+
+    def _match(self, path: str) -> Optional[str]:
+        if not self._kind_rx.match(path):
+            return 'type'
+
+        if self.extensions is not None and os.path.splitext(path)[1].lower() not in self.extensions:
+            return 'extension'
+
+        if self._skip_rx:
+            found = self._skip_rx.search(path)
+            if found:
+                return f'skip:{self.skip[int(found.lastgroup[4:])]}'
+        elif self._skip_list:
+            for idx, rx in enumerate(self._skip_list):
+                if rx.search(path):
+                    return f'skip:{self.skip[idx]}'
+
+        return None
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import csv
+import hashlib
+import json
+import logging
+import os
+import platform
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import watchtower
+
+BUSY_TIMEOUT = 10000  # milliseconds a writer waits for the database lock
+SAMPLE_BYTES = 65536  # bytes read from the start and end of a file for its fingerprint
+QUICK_FOLDERS = ['AcqData']  # subfolders of a '.d' bundle listed by quick_stat, where the acquisition data is written
+DONE = 'uploaded'
+
+logger = logging.getLogger('SampleLedger')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    path TEXT PRIMARY KEY,
+    sample TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    fingerprint TEXT,
+    args TEXT,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL,
+    quick TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_sample ON samples (sample);
+"""
+
+COLUMNS = ['path', 'sample', 'size', 'mtime_ns', 'fingerprint', 'args', 'state', 'updated', 'quick']
+
+
+def sample_name(path: str) -> str:
+    """File name of a sample without extension"""
+    return os.path.basename(path.rstrip('/\\').replace('\\', '/')).rsplit('.', 1)[0]
+
+
+def ledger_path(config) -> str:
+    """Database file of the ledger, from 'monitor.ledger.path' or in the temp folder"""
+    return config['monitor'].get('ledger', {}).get('path', os.path.join(tempfile.gettempdir(), 'monitor-ledger.db'))
+
+
+def stat_sample(path: str) -> tuple:
+    """
+    Stats a sample file or folder
+    Returns:
+        A tuple (total size, newest modification time in ns)
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    size = newest = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            st = os.stat(os.path.join(root, f))
+            size += st.st_size
+            newest = max(newest, st.st_mtime_ns)
+    return size, newest
+
+
+def quick_stat(path: str) -> str:
+    """
+    Cheap signature of a sample. Files use their size and modification time, folders the stat of the folder and
+    of the entries directly in it and in QUICK_FOLDERS, without walking the whole tree
+    """
+    st = os.stat(path)
+    if not os.path.isdir(path):
+        return f'{st.st_size}:{st.st_mtime_ns}'
+
+    parts = [str(st.st_mtime_ns)]
+    for folder in [path] + [os.path.join(path, f) for f in QUICK_FOLDERS]:
+        try:
+            with os.scandir(folder) as entries:
+                for entry in sorted(entries, key=lambda e: e.name):
+                    est = entry.stat(follow_symlinks=False)
+                    parts.append(f'{entry.name}:{est.st_size}:{est.st_mtime_ns}')
+        except FileNotFoundError:
+            if folder == path:
+                raise
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def fingerprint(path: str) -> str:
+    """
+    Content fingerprint of a sample. Files hash their size and first and last bytes, folders hash the name and
+    size of each file
+    """
+    digest = hashlib.sha1()
+    if not os.path.isdir(path):
+        size = os.path.getsize(path)
+        digest.update(str(size).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read(SAMPLE_BYTES))
+            if size > 2 * SAMPLE_BYTES:
+                f.seek(-SAMPLE_BYTES, os.SEEK_END)
+                digest.update(f.read(SAMPLE_BYTES))
+        return digest.hexdigest()
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            full = os.path.join(root, f)
+            digest.update(f'{os.path.relpath(full, path)}:{os.path.getsize(full)}\n'.encode())
+    return digest.hexdigest()
+
+
+class SampleLedger:
+    """
+    Local record of the samples handled by this monitor, kept in an SQLite database in WAL mode.
+    A sample is done when it was uploaded with the current msconvert arguments and hasn't changed since, which is
+    checked with a stat (and a fingerprint if the stat differs) instead of asking the bucket or stasis.
+    Each thread uses its own connection, WAL lets readers run while a writer commits
+    """
+
+    def __init__(self, path: str, args: Optional[str] = None):
+        """
+
+        Args:
+            path: str
+                Database file
+            args: str (Optional. Default: None)
+                Current msconvert arguments, samples converted with different arguments are not done
+        """
+        self.path = path
+        self.args = args
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000, isolation_level=None)
+            conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT}')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.normcase(path)
+
+    def get(self, path: str) -> Optional[dict]:
+        """Returns the entry of a sample or None"""
+        row = self._conn().execute('SELECT * FROM samples WHERE path = ?', (self._key(path),)).fetchone()
+        return dict(row) if row else None
+
+    def is_done(self, path: str, args: Optional[str] = None) -> bool:
+        """
+        Returns True if a sample was uploaded with the same msconvert arguments and hasn't changed since
+        Args:
+            path: sample file or folder
+            args: msconvert arguments, the ledger's arguments are used if missing
+        """
+        entry = self.get(path)
+        args = args or self.args
+        if not entry or entry['state'] != DONE or (args and entry['args'] != args):
+            return False
+
+        try:
+            # a folder is only walked when its quick signature changed
+            if entry['quick'] and quick_stat(path) == entry['quick']:
+                return True
+            size, mtime_ns = stat_sample(path)
+            if (size, mtime_ns) == (entry['size'], entry['mtime_ns']):
+                return True
+            # touched or copied, the content may still be the same
+            return size == entry['size'] and fingerprint(path) == entry['fingerprint']
+        except OSError:
+            return False
+
+    def record(self, path: str, state: str, args: Optional[str] = None):
+        """
+        Saves the state of a sample along with its current size, modification time and fingerprint
+        """
+        try:
+            quick = quick_stat(path)
+            size, mtime_ns = stat_sample(path)
+            digest = fingerprint(path)
+        except OSError as ex:
+            logger.warning(f'Can\'t stat {path}: {str(ex)}')
+            size = mtime_ns = digest = quick = None
+
+        self._conn().execute(f'INSERT OR REPLACE INTO samples ({", ".join(COLUMNS)}) '
+                             f'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (self._key(path), sample_name(path), size, mtime_ns, digest, args or self.args,
+                              state, time.time(), quick))
+
+    def mark(self, sample: str, state: str) -> int:
+        """
+        Updates the state of the entries of a sample by name, for workers that only know the converted file
+        Returns:
+            The number of entries updated
+        """
+        return self._conn().execute('UPDATE samples SET state = ?, updated = ? WHERE sample = ?',
+                                    (state, time.time(), sample)).rowcount
+
+    def count(self) -> int:
+        return self._conn().execute('SELECT COUNT(*) FROM samples').fetchone()[0]
+
+    def compact(self, older_than: Optional[float] = None, drop_missing: bool = True) -> int:
+        """
+        Removes entries of samples not done, older than 'older_than' days or whose files are gone,
+        then checkpoints the WAL and shrinks the database file
+        Returns:
+            The number of entries removed
+        """
+        conn = self._conn()
+        removed = conn.execute('DELETE FROM samples WHERE state != ?', (DONE,)).rowcount
+
+        if older_than is not None:
+            removed += conn.execute('DELETE FROM samples WHERE updated < ?',
+                                    (time.time() - older_than * 86400,)).rowcount
+
+        if drop_missing:
+            missing = [(r[0],) for r in conn.execute('SELECT path FROM samples') if not os.path.exists(r[0])]
+            conn.executemany('DELETE FROM samples WHERE path = ?', missing)
+            removed += len(missing)
+
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('VACUUM')
+        logger.info(f'Removed {removed} entries from {self.path}, {self.count()} left')
+        return removed
+
+    def export(self, filename: str) -> int:
+        """
+        Writes all the entries to a csv file, or json lines if the file ends with .json/.jsonl
+        Returns:
+            The number of entries written
+        """
+        rows = self._conn().execute(f'SELECT {", ".join(COLUMNS)} FROM samples ORDER BY updated').fetchall()
+
+        with open(filename, 'w', newline='') as out:
+            if filename.endswith(('.json', '.jsonl')):
+                for row in rows:
+                    out.write(json.dumps(dict(row)) + '\n')
+            else:
+                writer = csv.writer(out)
+                writer.writerow(COLUMNS)
+                writer.writerows(rows)
+
+        return len(rows)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import os
+import platform
+import tempfile
+import time
+from queue import Queue, Empty
+from threading import Thread, Lock
+from typing import Optional
+
+import watchtower
+
+from monitor.QueueManager import QueueManager, MAX_BATCH
+from monitor.SampleFilter import SampleFilter
+from monitor.SampleLedger import SampleLedger, QUICK_FOLDERS
+from monitor.TraceStore import TraceStore
+
+SCAN_WORKERS = 8  # directories listed concurrently, mostly waiting on network shares
+REPORT_INTERVAL = 30  # seconds between progress reports
+CHECKPOINT_SKEW = 300  # seconds taken off the checkpoint, for clock differences with the shares and slow writes
+
+logger = logging.getLogger('StartupScanner')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+def checkpoint_path(config) -> str:
+    """File keeping the start time of the last complete scan, from 'monitor.scan_checkpoint' or in the temp folder"""
+    return config['monitor'].get('scan_checkpoint', os.path.join(tempfile.gettempdir(), 'monitor-last-scan'))
+
+
+class StartupScanner(Thread):
+    """
+    Crawls the monitored folders once and sends every valid sample to the conversion queue, so samples acquired
+    while the monitor was down are converted too.
+    Folders are listed in parallel with os.scandir, '.d' folders are samples and are never descended into.
+    With a checkpoint file only the samples changed since the start of the last complete scan are queued, the
+    others were seen by the file watcher while the monitor was running. '.d' folders count as changed when any
+    entry at their top level or in QUICK_FOLDERS is newer than the checkpoint
+    """
+
+    def __init__(self, queue_mgr: QueueManager, paths: list, sample_filter: SampleFilter,
+                 workers: int = SCAN_WORKERS, name='Scanner', daemon=True, ledger: SampleLedger = None,
+                 traces: TraceStore = None, checkpoint: Optional[str] = None):
+        """
+
+        Args:
+            queue_mgr: QueueManager
+                A QueueManager object that handles setting up queues and sending/receiving messages
+            paths: list
+                Folders to crawl
+            sample_filter: SampleFilter
+                Filter rejecting invalid samples
+            workers: int (Optional. Default: 8)
+                Number of folders listed concurrently
+            name: str (Optional. Default: Scanner)
+                Name of the thread
+            daemon:
+                Run the scanner as daemon. (Optional. Default: True)
+            ledger: SampleLedger (Optional. Default: None)
+                Local record of the processed samples, samples already done are not queued
+            traces: TraceStore (Optional. Default: None)
+                Store of the sample spans, queued samples are saved as 'enqueue' events
+            checkpoint: str (Optional. Default: None)
+                File keeping the start time of the last complete scan. Without it, or if the file is missing, every
+                sample is queued
+        """
+        super().__init__(name=name, daemon=daemon)
+
+        self.queue_mgr = queue_mgr
+        self.paths = paths
+        self.filter = sample_filter
+        self.workers = workers
+        self.ledger = ledger
+        self.traces = traces
+        self.checkpoint = checkpoint
+        last = self.last_scan()
+        self.cutoff = last - CHECKPOINT_SKEW if last else None
+        self.running = False
+
+        self._folders = Queue()
+        self._lock = Lock()
+        self._counters = {'dirs': 0, 'files': 0, 'samples': 0, 'done': 0, 'old': 0, 'errors': 0}
+        self._start_time = None
+        self._end_time = None
+
+    def run(self):
+        """Crawls all the paths, returns when every folder has been listed"""
+        self.running = True
+        self._start_time = time.monotonic()
+        started = time.time()
+        if self.cutoff:
+            logger.info(f'Queueing the samples changed since the last scan ({time.ctime(self.cutoff)})')
+
+        for p in self.paths:
+            if os.path.isdir(p):
+                logger.info(f'Scanning {p} for samples')
+                self._folders.put(p)
+            else:
+                logger.error(f'Cannot find raw data folder {p}. It will NOT be scanned.')
+
+        walkers = [Thread(target=self._walk, name=f'{self.name}Walker{x}', daemon=True)
+                   for x in range(self.workers)]
+        for w in walkers:
+            w.start()
+
+        next_report = self._start_time + REPORT_INTERVAL
+        while self.running and self._folders.unfinished_tasks:
+            time.sleep(1)
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report += REPORT_INTERVAL
+
+        complete = self.running
+        self.running = False
+        for w in walkers:
+            w.join()
+
+        self._end_time = time.monotonic()
+        self.report()
+
+        # a folder that couldn't be listed is scanned in full next time
+        if complete and not self.stats()['errors']:
+            self.save_checkpoint(started)
+
+    def last_scan(self) -> Optional[float]:
+        """Start time of the last complete scan, None if unknown"""
+        if not self.checkpoint:
+            return None
+        try:
+            with open(self.checkpoint, 'r') as f:
+                return float(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def save_checkpoint(self, started: float):
+        try:
+            with open(self.checkpoint + '.tmp', 'w') as f:
+                f.write(str(started))
+            os.replace(self.checkpoint + '.tmp', self.checkpoint)
+        except (OSError, TypeError) as ex:
+            logger.warning(f'Can\'t save the scan checkpoint to {self.checkpoint}: {str(ex)}')
+
+    def elapsed(self) -> float:
+        if self._start_time is None:
+            return 0.0
+        return (self._end_time or time.monotonic()) - self._start_time
+
+    def stats(self) -> dict:
+        """Number of folders listed, files seen, samples queued or already done, errors and the dirs/sec rate"""
+        with self._lock:
+            stats = dict(self._counters)
+        elapsed = self.elapsed()
+        stats['dirs_per_sec'] = stats['dirs'] / elapsed if elapsed else 0.0
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        logger.info(f'Scanned {stats["dirs"]} folders ({stats["dirs_per_sec"]:.1f} dirs/sec) and '
+                    f'{stats["files"]} files in {self.elapsed():.0f}s, queued {stats["samples"]} samples '
+                    f'({stats["done"]} already done, {stats["old"]} unchanged since the last scan), '
+                    f'{stats["errors"]} errors')
+
+    def _walk(self):
+        """Lists folders from the work queue, pushing subfolders back and sending samples in batches"""
+        batch = []
+
+        while self.running:
+            try:
+                folder = self._folders.get(timeout=0.5)
+            except Empty:
+                # nothing to list right now, don't hold samples back
+                if batch:
+                    self._send(batch)
+                    batch = []
+                continue
+
+            try:
+                dirs, files = self._list(folder, batch)
+                with self._lock:
+                    self._counters['dirs'] += 1
+                    self._counters['files'] += files
+                for d in dirs:
+                    self._folders.put(d)
+
+                if len(batch) >= MAX_BATCH:
+                    self._send(batch)
+                    batch = []
+
+            except OSError as ex:
+                logger.warning(f'Can\'t scan {folder}: {str(ex)}')
+                with self._lock:
+                    self._counters['errors'] += 1
+            finally:
+                self._folders.task_done()
+
+        if batch:
+            self._send(batch)
+
+    def _list(self, folder: str, batch: list) -> tuple:
+        """
+        Lists a folder, adding its samples to batch
+        Returns:
+            A tuple (subfolders to crawl, number of files)
+        """
+        dirs = []
+        files = 0
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_dir and not entry.name.endswith('.d'):
+                    dirs.append(entry.path)
+                    continue
+
+                files += 0 if is_dir else 1
+                if not self.filter.accepts(entry.path):
+                    continue
+
+                if self.cutoff and self._changed(entry) < self.cutoff:
+                    with self._lock:
+                        self._counters['old'] += 1
+                elif self.ledger and self.ledger.is_done(entry.path):
+                    with self._lock:
+                        self._counters['done'] += 1
+                else:
+                    batch.append(entry.path)
+
+        return dirs, files
+
+    @staticmethod
+    def _changed(entry: os.DirEntry) -> float:
+        """
+        Last change of a sample, copies keep the original modification time so their creation time counts too
+        (st_ctime is the creation time on Windows). Writes inside a '.d' folder don't update the folder itself, so
+        the newest modification time of its top level and QUICK_FOLDERS entries is used as well
+        """
+        st = entry.stat(follow_symlinks=False)
+        changed = max(st.st_mtime, st.st_ctime)
+        if not entry.is_dir(follow_symlinks=False):
+            return changed
+
+        for folder in [entry.path] + [os.path.join(entry.path, f) for f in QUICK_FOLDERS]:
+            try:
+                with os.scandir(folder) as entries:
+                    for e in entries:
+                        changed = max(changed, e.stat(follow_symlinks=False).st_mtime)
+            except FileNotFoundError:
+                if folder == entry.path:
+                    raise
+        return changed
+
+    def _send(self, batch: list):
+        try:
+            sent = self.queue_mgr.put_messages(self.queue_mgr.conversion_q(), batch)
+            self.traces.events(batch, 'enqueue') if self.traces else None
+        except Exception as ex:
+            logger.error(f'Can\'t add {len(batch)} scanned samples to the conversion queue: {str(ex)}')
+            sent = 0
+
+        with self._lock:
+            self._counters['samples'] += sent
+            self._counters['errors'] += len(batch) - sent
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import math
+import os
+import platform
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+import watchtower
+
+from monitor.SampleLedger import sample_name, BUSY_TIMEOUT
+
+RETENTION = 30  # days of spans kept
+STAGES = ['enqueue', 'dequeue', 'settle', 'msconvert', 'upload', 'verify', 'status']
+PERCENTILES = [50, 95, 99]
+
+logger = logging.getLogger('TraceStore')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spans (
+    id INTEGER PRIMARY KEY,
+    sample TEXT NOT NULL,
+    instrument TEXT,
+    stage TEXT NOT NULL,
+    detail TEXT,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS spans_sample ON spans (sample, start);
+CREATE INDEX IF NOT EXISTS spans_start ON spans (start);
+"""
+
+
+def traces_path(config) -> str:
+    """Database file of the traces, from 'monitor.traces.path' or in the temp folder"""
+    return config['monitor'].get('traces', {}).get('path', os.path.join(tempfile.gettempdir(), 'monitor-traces.db'))
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return math.nan
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class TraceStore:
+    """
+    Local store of the lifecycle of each sample, one timestamped span per stage (enqueue, dequeue, settle,
+    msconvert, upload, verify and each status update), kept in an SQLite database in WAL mode.
+    Spans are keyed by sample name, so the stages working on the converted file are joined to the raw data file.
+    Recording never raises, a span that can't be saved is logged and dropped
+    """
+
+    def __init__(self, path: str, roots: Optional[list] = None):
+        """
+
+        Args:
+            path: str
+                Database file
+            roots: list (Optional. Default: None)
+                Monitored folders, a sample's instrument is the folder it was found in. Samples outside of them use
+                their parent folder
+        """
+        self.path = path
+        self.roots = sorted((os.path.normcase(os.path.normpath(r)) for r in roots or []), key=len, reverse=True)
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT / 1000, isolation_level=None)
+            conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT}')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def instrument(self, path: str) -> Optional[str]:
+        """Monitored folder containing a sample, None for bare names (ie: object keys)"""
+        if os.sep not in path and '/' not in path:
+            return None
+
+        norm = os.path.normcase(os.path.normpath(path))
+        return next((r for r in self.roots if norm.startswith(r + os.sep)), os.path.dirname(norm))
+
+    def add(self, path: str, stage: str, start: float, end: Optional[float] = None, outcome: str = 'ok',
+            detail: Optional[str] = None):
+        """
+        Saves a span
+        Args:
+            path: sample path or file name
+            stage: one of STAGES
+            start: epoch seconds
+            end: epoch seconds, same as start for point events
+            outcome: 'ok' or the reason it failed
+            detail: extra information, ie: the state sent in a status update
+        """
+        self._insert([(sample_name(path), self.instrument(path), stage, detail, start,
+                       start if end is None else end, outcome)])
+
+    def event(self, path: str, stage: str, since: Optional[str] = None):
+        """
+        Saves a point event, or a span starting at the sample's latest 'since' stage (ie: the time a sample
+        waited in the queue when dequeued since its enqueue)
+        """
+        now = time.time()
+        start = now
+        if since:
+            try:
+                row = self._conn().execute('SELECT MAX(start) FROM spans WHERE sample = ? AND stage = ?',
+                                           (sample_name(path), since)).fetchone()
+                start = row[0] or now
+            except sqlite3.Error as ex:
+                logger.warning(f'Can\'t read the traces of {path}: {str(ex)}')
+        self.add(path, stage, start, now)
+
+    def events(self, paths: list, stage: str):
+        """Saves a point event for several samples at once"""
+        now = time.time()
+        self._insert([(sample_name(p), self.instrument(p), stage, None, now, now, 'ok') for p in paths])
+
+    @contextmanager
+    def span(self, path: str, stage: str, detail: Optional[str] = None):
+        """Context manager saving a span for its block, the outcome is the exception's name if it raises"""
+        start = time.time()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException as ex:
+            outcome = type(ex).__name__
+            raise
+        finally:
+            self.add(path, stage, start, time.time(), outcome, detail)
+
+    def _insert(self, rows: list):
+        try:
+            self._conn().executemany('INSERT INTO spans (sample, instrument, stage, detail, start, end, outcome) '
+                                     'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error as ex:
+            logger.warning(f'Can\'t save {len(rows)} spans to {self.path}: {str(ex)}')
+
+    def lifecycle(self, sample: str) -> list:
+        """Spans of a sample in time order"""
+        rows = self._conn().execute('SELECT * FROM spans WHERE sample = ? ORDER BY start, id',
+                                    (sample_name(sample),)).fetchall()
+        return [dict(r) for r in rows]
+
+    def report(self, since: Optional[float] = None, until: Optional[float] = None,
+               by_instrument: bool = True) -> list:
+        """
+        Duration percentiles per stage, and per instrument, of the spans started in a time window.
+        'total' is the time from the end of the acquisition (end of settle) to the end of the last upload
+        Args:
+            since: epoch seconds (Optional. Default: everything)
+            until: epoch seconds (Optional. Default: now)
+
+        Returns:
+            A list of dicts with stage, instrument, count, failed, p50, p95, p99 and max, in stage order
+        """
+        conn = self._conn()
+        window = (since or 0, until or time.time())
+        spans = conn.execute('SELECT sample, instrument, stage, start, end, outcome FROM spans '
+                             'WHERE start >= ? AND start < ?', window).fetchall()
+
+        # stages working on converted files only know the sample name, use the instrument of its other spans
+        instruments = dict(conn.execute('SELECT sample, MAX(instrument) FROM spans WHERE instrument IS NOT NULL '
+                                        'AND sample IN (SELECT sample FROM spans WHERE start >= ? AND start < ?) '
+                                        'GROUP BY sample', window).fetchall())
+
+        groups = {}
+        acquired = {}
+        uploaded = {}
+        for s in spans:
+            instrument = (s['instrument'] or instruments.get(s['sample'])) if by_instrument else None
+            group = groups.setdefault((s['stage'], instrument), [[], 0])
+            group[0].append(s['end'] - s['start'])
+            group[1] += s['outcome'] != 'ok'
+
+            if s['outcome'] == 'ok' and s['stage'] == 'settle':
+                acquired[s['sample']] = min(acquired.get(s['sample'], s['end']), s['end'])
+            elif s['outcome'] == 'ok' and s['stage'] == 'upload':
+                uploaded[s['sample']] = max(uploaded.get(s['sample'], s['end']), s['end'])
+
+        for sample in acquired.keys() & uploaded.keys():
+            instrument = instruments.get(sample) if by_instrument else None
+            groups.setdefault(('total', instrument), [[], 0])[0].append(uploaded[sample] - acquired[sample])
+
+        order = STAGES + ['total']
+        report = []
+        for (stage, instrument), (durations, failed) in sorted(
+                groups.items(), key=lambda g: (order.index(g[0][0]) if g[0][0] in order else len(order),
+                                               g[0][0], g[0][1] or '')):
+            durations.sort()
+            row = {'stage': stage, 'instrument': instrument, 'count': len(durations), 'failed': failed}
+            row.update({f'p{p}': percentile(durations, p) for p in PERCENTILES})
+            row['max'] = durations[-1]
+            report.append(row)
+
+        return report
+
+    def compact(self, older_than: float = RETENTION) -> int:
+        """
+        Removes the spans older than 'older_than' days
+        Returns:
+            The number of spans removed
+        """
+        conn = self._conn()
+        removed = conn.execute('DELETE FROM spans WHERE start < ?', (time.time() - older_than * 86400,)).rowcount
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        logger.info(f'Removed {removed} spans older than {older_than} days from {self.path}')
+        return removed
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def traced(traces: Optional[TraceStore], path: str, stage: str, detail: Optional[str] = None):
+    """Span of a stage, or a no-op context when tracing is disabled"""
+    return traces.span(path, stage, detail) if traces else nullcontext()
+
+
+def format_report(report: list) -> str:
+    """Renders a report as a text table, durations in seconds"""
+    header = ['stage', 'instrument', 'count', 'failed'] + [f'p{p}' for p in PERCENTILES] + ['max']
+    rows = [[r['stage'], r['instrument'] or '-', str(r['count']), str(r['failed'])] +
+            [f'{r[k]:.2f}' for k in header[4:]] for r in report]
+    widths = [max(len(str(c)) for c in col) for col in zip(header, *rows)]
+    return '\n'.join('  '.join(c.ljust(w) if i < 2 else c.rjust(w) for i, (c, w) in enumerate(zip(line, widths)))
+                     for line in [header] + rows)
+
+
+def format_lifecycle(spans: list) -> str:
+    """Renders the spans of a sample as offsets from its first span, in seconds"""
+    if not spans:
+        return 'No spans found'
+    origin = spans[0]['start']
+    return '\n'.join(f'{s["start"] - origin:>10.2f}s  {s["end"] - s["start"]:>10.2f}s  {s["stage"]:<10} '
+                     f'{s["outcome"]:<10} {s["detail"] or ""}'.rstrip() for s in spans)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import os
+import urllib.parse
+from threading import Thread
+from typing import Optional
+
+import aiohttp
+
+from monitor.client.MetadataCache import MetadataCache, MISSING, CACHE_TTL, NEGATIVE_TTL, CACHE_SIZE
+
+logger = logging.getLogger('AsyncBackendClient')
+
+RETRY_COUNT = 3
+RETRY_STATUS = [429, 500, 502, 503, 504]
+BACKOFF = 1  # seconds, doubled on every retry
+CONCURRENCY = 100  # requests in flight at the same time
+TIMEOUT = 30
+
+
+class AsyncBackendClient:
+    """
+    asyncio version of BackendClient for high fan-out work (backfills, reconciliation).
+    All the requests share one connection pool, at most 'concurrency' are in flight at the same time and
+    retries wait cooperatively without blocking other requests
+    """
+
+    def __init__(self, config, url: Optional[str] = None, token: Optional[str] = None,
+                 concurrency: int = CONCURRENCY):
+        """
+        the client requires an url where to connect against and the related token.
+        """
+        self.logger = logger
+
+        if config['debug']:
+            self.logger.setLevel(level='DEBUG')
+
+        self._url = url
+        self._token = token
+
+        if self._token is None:
+            # utilize env
+            self._token = os.getenv('STASIS_API_TOKEN', os.getenv('PROD_STASIS_API_TOKEN'))
+        if self._url is None:
+            self._url = os.getenv('STASIS_API_URL', 'https://api.metabolomics.us')
+
+        if self._token is None:
+            raise Exception("you need to to provide a stasis api token in the env variable 'STASIS_API_TOKEN'")
+
+        self._header = {
+            'Content-type': 'application/json',
+            'Accept': 'application/json',
+            'x-api-key': f'{self._token}'
+        }
+
+        cache = config.get('backend', {}).get('cache', {})
+        self.cache = MetadataCache(ttl=cache.get('ttl', CACHE_TTL),
+                                   negative_ttl=cache.get('negative_ttl', NEGATIVE_TTL),
+                                   max_size=cache.get('size', CACHE_SIZE))
+
+        self.concurrency = concurrency
+        self._session = None
+        self._slots = None
+
+    async def _request(self, method: str, path: str, data: Optional[dict] = None) -> tuple:
+        """
+        Sends a request retrying connection errors and throttling/server errors with exponential backoff
+        Returns:
+            A tuple (status code, json body or None, reason)
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers=self._header,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60))
+            self._slots = asyncio.Semaphore(self.concurrency)
+
+        for attempt in range(RETRY_COUNT + 1):
+            # the slot is given back while backing off, so other requests can use it
+            async with self._slots:
+                try:
+                    async with self._session.request(method, f'{self._url}{path}', json=data) as result:
+                        if result.status in RETRY_STATUS and attempt < RETRY_COUNT:
+                            self.logger.debug("retrying %s %s, status %s", method, path, result.status)
+                        else:
+                            body = await result.json(content_type=None) if result.status == 200 else None
+                            return result.status, body, result.reason
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                    if attempt == RETRY_COUNT:
+                        raise
+                    self.logger.debug("retrying %s %s, error %s", method, path, str(ex))
+
+            await asyncio.sleep(BACKOFF * 2 ** attempt)
+
+    async def sample_acquisition_exists(self, sample_name) -> bool:
+        """
+        returns True if there is acquisition data for this sample
+        """
+        cached = self.cache.get(sample_name)
+        if cached is not MISSING:
+            return cached is not None
+
+        status, body, _ = await self._request('GET', f'/samples/metadata/{sample_name}')
+        if status == 200:
+            self.cache.put(sample_name, body)
+            return True
+        elif status == 404:
+            self.cache.put(sample_name, None)
+        return False
+
+    async def sample_acquisition_get(self, sample_name) -> dict:
+        """
+        returns the acquisition data of this sample
+        """
+        cached = self.cache.get(sample_name)
+        if cached is None:
+            raise Exception("acquisition data not found")
+        elif cached is not MISSING:
+            return cached
+
+        status, body, reason = await self._request('GET', f'/samples/metadata/{sample_name}')
+        if status == 200:
+            self.cache.put(sample_name, body)
+            return body
+        elif status == 404:
+            self.cache.put(sample_name, None)
+            raise Exception("acquisition data not found")
+        else:
+            raise Exception(f"we observed an error. Status code was {status} "
+                            f"and error was {reason} for sample {sample_name}")
+
+    async def sample_state_update(self, sample_name: str, state, file_handle: Optional[str] = None,
+                                  reason: Optional[str] = None):
+        """
+        updates a sample state in the remote system
+        """
+        data = {
+            "sample": sample_name,
+            "status": state,
+        }
+
+        if file_handle is not None:
+            data['fileHandle'] = file_handle
+        if reason is not None:
+            data['reason'] = reason
+
+        status, body, error = await self._request('POST', '/samples/status', data)
+        self.cache.invalidate(sample_name)
+        if status != 200:
+            raise Exception(f"we observed an error. Status code was {status} and error was {error} and "
+                            f"{sample_name} in {state} with {file_handle}")
+        return body
+
+    async def get_method_last_version(self, method: str):
+        """
+        Get the latest or newest version label for a method/library from the compound table
+        """
+        status, body, reason = await self._request('GET', f'/methods/last_version/{urllib.parse.quote(method)}')
+
+        if status == 200:
+            return body
+        elif status == 404:
+            return []
+        else:
+            raise Exception(f'Status code: {status}, {reason}')
+
+    async def get_unique_method_profiles(self, method: str, version: str = 'fixed'):
+        """
+        Get the list of unique profiles for a specific method and version from CIS-Server
+        :param method: method name
+        :param version: method version
+        :return: a list of profile names, or empty if a method or version is missing
+        """
+        if not method:
+            raise Exception('parameter "method" cannot be null or empty')
+
+        clib = urllib.parse.quote(method)
+        cver = urllib.parse.quote(version)
+        status, body, reason = await self._request('GET', f'/methods/unique_profiles/{clib}/{cver}')
+
+        if status == 200:
+            return body
+        elif status == 404:
+            return []
+        else:
+            raise Exception(f'Status code: {status}, {reason}')
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class SyncBackendClient:
+    """
+    Blocking facade of AsyncBackendClient for worker threads.
+    The async client runs in its own event loop thread, so calls from many threads share its connection pool
+    and concurrency limit. The 'many' methods run a whole batch of calls concurrently
+    """
+
+    def __init__(self, config, url: Optional[str] = None, token: Optional[str] = None,
+                 concurrency: int = CONCURRENCY):
+        self.client = AsyncBackendClient(config, url, token, concurrency)
+        self._url = self.client._url
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, name='AsyncBackendClient', daemon=True)
+        self._thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _run_many(self, coroutines) -> list:
+        """Runs coroutines concurrently, returning their results or exceptions in order"""
+
+        async def gather():
+            return await asyncio.gather(*coroutines, return_exceptions=True)
+
+        return self._run(gather())
+
+    def sample_acquisition_exists(self, sample_name) -> bool:
+        return self._run(self.client.sample_acquisition_exists(sample_name))
+
+    def sample_acquisition_get(self, sample_name) -> dict:
+        return self._run(self.client.sample_acquisition_get(sample_name))
+
+    def sample_state_update(self, sample_name: str, state, file_handle: Optional[str] = None,
+                            reason: Optional[str] = None):
+        return self._run(self.client.sample_state_update(sample_name, state, file_handle, reason))
+
+    def get_method_last_version(self, method: str):
+        return self._run(self.client.get_method_last_version(method))
+
+    def get_unique_method_profiles(self, method: str, version: str = 'fixed'):
+        return self._run(self.client.get_unique_method_profiles(method, version))
+
+    def samples_acquisition_exist(self, sample_names: list) -> dict:
+        """Checks many samples concurrently, returns a dict sample -> bool (False on errors)"""
+        results = self._run_many([self.client.sample_acquisition_exists(s) for s in sample_names])
+        return {s: r is True for s, r in zip(sample_names, results)}
+
+    def samples_state_update(self, updates: list) -> list:
+        """
+        Sends many state updates concurrently
+        Args:
+            updates: list of dicts with the arguments of sample_state_update
+
+        Returns:
+            The results of each update, exceptions are returned instead of raised
+        """
+        return self._run_many([self.client.sample_state_update(**u) for u in updates])
+
+    def close(self):
+        self._run(self.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -3,15 +3,19 @@
 import logging
 import os
 import platform
+import time
 import urllib.parse
+from threading import local
 from typing import Optional
 
 import requests
 import watchtower
 from requests.adapters import HTTPAdapter
-from retry import retry
 from urllib3 import Retry
 
+from monitor.Metrics import STASIS_SECONDS, RETRIES
+from monitor.client.MetadataCache import MetadataCache, MISSING, CACHE_TTL, NEGATIVE_TTL, CACHE_SIZE
+
 logger = logging.getLogger('BackendClient')
 # if not logger.handlers:
 #     h = watchtower.CloudWatchLogHandler(
@@ -21,13 +25,49 @@ logger = logging.getLogger('BackendClient')
 #     logger.addHandler(h)
 
 RETRY_COUNT = 3
+POOL_SIZE = 10  # connections kept open to stasis
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that reports how many requests reused an open connection of its pools and records the latency
+    and retries of every call
+    """
+
+    def send(self, request, *args, **kwargs):
+        start = time.monotonic()
+        response = super().send(request, *args, **kwargs)
+
+        # label by method and resource, ie: 'GET /samples/metadata', without the sample names
+        path = urllib.parse.urlsplit(request.url).path.strip('/').split('/')
+        STASIS_SECONDS.labels(f'{request.method} /{"/".join(path[:2])}').observe(time.monotonic() - start)
+
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            RETRIES.labels('stasis').inc(len(retries.history))
+
+        return response
+
+    def stats(self) -> dict:
+        pools = self.poolmanager.pools
+        connections = requests_sent = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+
+        return {'connections': connections, 'requests': requests_sent, 'reused': requests_sent - connections}
 
 
 class BackendClient:
 
-    def __init__(self, config, url: Optional[str] = None, token: Optional[str] = None):
+    def __init__(self, config, url: Optional[str] = None, token: Optional[str] = None,
+                 pool_size: Optional[int] = None):
         """
         the client requires an url where to connect against and the related token.
+        pool_size is the number of connections kept open, one per thread calling the api at the same time
+        ('backend.pool_size' if missing)
         """
         self.logger = logger
 
@@ -55,45 +95,83 @@ class BackendClient:
             'x-api-key': f'{self._token}'
         }
 
+        cache = config.get('backend', {}).get('cache', {})
+        self.cache = MetadataCache(ttl=cache.get('ttl', CACHE_TTL),
+                                   negative_ttl=cache.get('negative_ttl', NEGATIVE_TTL),
+                                   max_size=cache.get('size', CACHE_SIZE))
+
+        # the only retry layer, covers connection errors and throttling/server errors
         retry_strategy = Retry(
-            total=500,
+            total=RETRY_COUNT,
             status_forcelist=[429, 500, 502, 503, 504],
-            method_whitelist=["HEAD", "GET", "OPTIONS", "POST"],
-            backoff_factor=1
+            allowed_methods=["HEAD", "GET", "OPTIONS", "POST"],
+            backoff_factor=1,
+            raise_on_status=False
         )
 
+        pool_size = pool_size or config.get('backend', {}).get('pool_size', POOL_SIZE)
+
         logging.debug("configuring http client")
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.http = requests.Session()
+        # shared by the per-thread sessions, so connections are kept alive and reused across threads
+        self.adapter = PooledHTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True,
+                                         max_retries=retry_strategy)
+        self._sessions = local()
         self.logger.debug("utilizing url %s", self._url)
 
-    @retry(exceptions=Exception, tries=RETRY_COUNT, delay=1, backoff=2)
+    @property
+    def http(self) -> requests.Session:
+        """The calling thread's session, all sessions share the same connection pool"""
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self._sessions.session = session
+        return session
+
+    def pool_stats(self) -> dict:
+        """Number of connections opened and requests sent through the connection pool"""
+        return self.adapter.stats()
+
     def sample_acquisition_exists(self, sample_name) -> bool:
         """
-        returns the acquisition data of this sample
+        returns True if there is acquisition data for this sample
         """
+        cached = self.cache.get(sample_name)
+        if cached is not MISSING:
+            return cached is not None
+
         self.logger.debug("getting acquisition data for sample %s", sample_name)
         result = self.http.get(f'{self._url}/samples/metadata/{sample_name}', headers=self._header)
-        if result.status_code != 200:
-            return False
-        return True
+        if result.status_code == 200:
+            self.cache.put(sample_name, result.json())
+            return True
+        elif result.status_code == 404:
+            self.cache.put(sample_name, None)
+        return False
 
-    @retry(exceptions=Exception, tries=RETRY_COUNT, delay=1, backoff=2)
     def sample_acquisition_get(self, sample_name) -> dict:
         """
         returns the acquisition data of this sample
         """
+        cached = self.cache.get(sample_name)
+        if cached is None:
+            raise Exception("acquisition data not found")
+        elif cached is not MISSING:
+            return cached
+
         self.logger.debug("getting acquisition data for sample %s", sample_name)
         result = self.http.get(f'{self._url}/samples/metadata/{sample_name}', headers=self._header)
         if result.status_code == 200:
+            self.cache.put(sample_name, result.json())
             return result.json()
         elif result.status_code == 404:
+            self.cache.put(sample_name, None)
             raise Exception("acquisition data not found")
         else:
             raise Exception(f"we observed an error. Status code was {result.status_code} "
                             f"and error was {result.reason} for sample {sample_name}")
 
-    @retry(exceptions=Exception, tries=RETRY_COUNT, delay=1, backoff=2)
     def sample_state_update(self, sample_name: str, state, file_handle: Optional[str] = None, reason: Optional[str] = None):
         """
         updates a sample state in the remote system
@@ -110,6 +188,7 @@ class BackendClient:
             data['reason'] = reason
 
         result = self.http.post(f'{self._url}/samples/status', json=data, headers=self._header)
+        self.cache.invalidate(sample_name)
         if result.status_code != 200: raise Exception(
             f"we observed an error. Status code was {result.status_code} and error was {result.reason} and {sample_name} in {state} with {file_handle}")
         return result
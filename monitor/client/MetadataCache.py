@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from threading import Lock
+
+CACHE_TTL = 300  # seconds a found document is kept
+NEGATIVE_TTL = 30  # seconds a 'not found' answer is kept
+CACHE_SIZE = 10000
+
+# returned by get when there is no valid entry for a key
+MISSING = object()
+
+
+class MetadataCache:
+    """
+    Thread-safe LRU cache with expiration for Stasis documents.
+    A None value records that the document doesn't exist and uses the (shorter) negative TTL
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, negative_ttl: float = NEGATIVE_TTL, max_size: int = CACHE_SIZE):
+        """
+
+        Args:
+            ttl: float (Optional. Default: 300)
+                Seconds an existing document is cached
+            negative_ttl: float (Optional. Default: 30)
+                Seconds a missing document is cached
+            max_size: int (Optional. Default: 10000)
+                Maximum number of entries, the least recently used are evicted first
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Returns the cached value of a key (None for missing documents) or MISSING if it isn't cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            ttl = self.ttl if value is not None else self.negative_ttl
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
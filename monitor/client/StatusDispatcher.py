@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+from typing import Optional
+
+from monitor.Metrics import RETRIES, FAILURES
+from monitor.TraceStore import TraceStore, traced
+from monitor.client.BackendClient import BackendClient
+
+QUEUE_SIZE = 1000  # transitions kept in memory, the rest are spilled to disk
+SENDERS = 4  # samples updated concurrently
+SEND_ATTEMPTS = 5
+RETRY_DELAY = 5  # seconds before sending again the transitions of a sample that failed
+
+logger = logging.getLogger('StatusDispatcher')
+
+
+class StatusDispatcher:
+    """
+    Write-behind dispatcher of sample state updates.
+    Workers queue transitions and return at once, sender threads post them to Stasis. Transitions of the same
+    sample are sent in order by a single sender, different samples are sent concurrently. Transitions that
+    don't fit in memory or are still pending on shutdown are kept in a spill file and sent later
+    """
+
+    def __init__(self, backend_cli: BackendClient, spill_file: Optional[str] = None, max_size: int = QUEUE_SIZE,
+                 senders: int = SENDERS, traces: Optional[TraceStore] = None):
+        """
+
+        Args:
+            backend_cli: BackendClient
+                The client used to send the updates
+            spill_file: str (Optional. Default: None)
+                File keeping the transitions that don't fit in memory or weren't sent before stopping
+            max_size: int (Optional. Default: 1000)
+                Maximum number of transitions kept in memory
+            senders: int (Optional. Default: 4)
+                Number of sender threads
+            traces: TraceStore (Optional. Default: None)
+                Store of the sample spans, each update sent is saved as a 'status' span
+        """
+        self.backend_cli = backend_cli
+        self.spill_file = spill_file
+        self.max_size = max_size
+        self.traces = traces
+
+        # sample -> list of transitions, in arrival order
+        self._pending = OrderedDict()
+        self._size = 0
+        self._sending = set()
+        self._spilled = 0
+        self._cond = Condition()
+        self._spill_lock = Lock()
+        self.running = True
+
+        if self.spill_file and os.path.exists(self.spill_file):
+            with open(self.spill_file, 'r') as file:
+                self._spilled = sum(1 for line in file if line.strip())
+            logger.info(f'Found {self._spilled} unsent state updates in {self.spill_file}')
+
+        self._senders = [Thread(target=self._send_loop, name=f'StatusSender{x}', daemon=True)
+                         for x in range(senders)]
+        for t in self._senders:
+            t.start()
+
+    def sample_state_update(self, sample_name: str, state, file_handle: Optional[str] = None,
+                            reason: Optional[str] = None):
+        """
+        Queues a state update, same signature as BackendClient.sample_state_update
+        """
+        transition = {'sample': sample_name, 'state': state, 'file_handle': file_handle, 'reason': reason,
+                      'attempts': 0}
+
+        with self._cond:
+            if self._spilled or self._size >= self.max_size:
+                # keep the order: once spilling, everything goes to disk until it's read back
+                self._spill([transition])
+                return
+
+            transitions = self._pending.setdefault(sample_name, [])
+            if transitions and self._same(transitions[-1], transition):
+                logger.debug(f'Skipping duplicated "{state}" update for sample {sample_name}')
+                return
+
+            transitions.append(transition)
+            self._size += 1
+            self._cond.notify()
+
+    def pending(self) -> int:
+        """Number of transitions not sent yet, in memory and on disk"""
+        with self._cond:
+            return self._size + self._spilled
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until every queued transition has been sent
+        Returns:
+            True if everything was sent before the timeout
+        """
+        end = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while self._size or self._sending or self._spilled:
+                remaining = end - time.monotonic() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = 10):
+        """Sends the queued transitions for up to 'timeout' seconds and saves the rest to the spill file"""
+        self.flush(timeout)
+
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+
+        for t in self._senders:
+            t.join(timeout)
+
+        with self._cond:
+            remaining = [t for transitions in self._pending.values() for t in transitions]
+            if remaining:
+                logger.warning(f'Saving {len(remaining)} unsent state updates to {self.spill_file}')
+                self._spill(remaining, front=True)
+            self._pending.clear()
+            self._size = 0
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                if not self.running:
+                    return
+
+                sample = self._next_sample()
+                while sample is None and self.running:
+                    self._cond.wait(1)
+                    sample = self._next_sample()
+
+                if sample is None:
+                    return
+
+                transitions = self._pending.pop(sample)
+                self._size -= len(transitions)
+                self._sending.add(sample)
+
+            failed = self._send(transitions)
+
+            with self._cond:
+                self._sending.discard(sample)
+                if failed:
+                    # put the unsent transitions back in front of any newer ones
+                    newer = self._pending.pop(sample, [])
+                    self._pending[sample] = failed + newer
+                    self._size += len(failed)
+                self._cond.notify_all()
+
+            if failed:
+                time.sleep(RETRY_DELAY)
+
+    def _next_sample(self):
+        """Returns the oldest sample with pending transitions not being sent by another thread"""
+        if not self._pending and self._spilled:
+            self._unspill()
+
+        return next((s for s in self._pending if s not in self._sending), None)
+
+    def _send(self, transitions: list) -> list:
+        """Sends transitions in order, returns the ones that couldn't be sent"""
+        for idx, t in enumerate(transitions):
+            try:
+                with traced(self.traces, t['sample'], 'status', t['state']):
+                    self.backend_cli.sample_state_update(t['sample'], t['state'], t['file_handle'],
+                                                         reason=t['reason'])
+            except Exception as ex:
+                t['attempts'] += 1
+                if t['attempts'] < SEND_ATTEMPTS:
+                    logger.warning(f'Can\'t send "{t["state"]}" status for sample "{t["sample"]}", will retry. '
+                                   f'Response: {str(ex)}')
+                    RETRIES.labels('status').inc()
+                    return transitions[idx:]
+
+                logger.error(f'Giving up sending "{t["state"]}" status for sample "{t["sample"]}" after '
+                             f'{t["attempts"]} attempts. Response: {str(ex)}')
+                FAILURES.labels('status', 'gave_up').inc()
+        return []
+
+    @staticmethod
+    def _same(a: dict, b: dict) -> bool:
+        return all(a[k] == b[k] for k in ['state', 'file_handle', 'reason'])
+
+    def _spill(self, transitions: list, front: bool = False):
+        """Appends transitions to the spill file, or prepends them when 'front' is True. Called holding _cond"""
+        if not self.spill_file:
+            logger.error(f'No spill file configured, dropping {len(transitions)} state updates')
+            return
+
+        with self._spill_lock:
+            lines = [json.dumps(t) + '\n' for t in transitions]
+            if front and os.path.exists(self.spill_file):
+                with open(self.spill_file, 'r') as file:
+                    lines += file.readlines()
+                with open(self.spill_file, 'w') as file:
+                    file.writelines(lines)
+            else:
+                with open(self.spill_file, 'a') as file:
+                    file.writelines(lines)
+
+        self._spilled += len(transitions)
+
+    def _unspill(self):
+        """Reads back up to max_size transitions from the spill file. Called holding _cond"""
+        with self._spill_lock:
+            try:
+                with open(self.spill_file, 'r') as file:
+                    lines = [line for line in file.readlines() if line.strip()]
+            except OSError as ex:
+                logger.error(f'Can\'t read spill file {self.spill_file}: {str(ex)}')
+                self._spilled = 0
+                return
+
+            loaded, rest = lines[:self.max_size], lines[self.max_size:]
+            with open(self.spill_file, 'w') as file:
+                file.writelines(rest)
+
+        for line in loaded:
+            t = json.loads(line)
+            self._pending.setdefault(t['sample'], []).append(t)
+        self._size += len(loaded)
+        self._spilled = len(rest)
+        logger.info(f'Loaded {len(loaded)} state updates from {self.spill_file}, {len(rest)} left')
@@ -39,5 +39,18 @@ class JobDataStoreException(Exception):
 
 
 class QueueClientException(Exception):
-    def __init__(self):
-        super().__init__(self.message)
\ No newline at end of file
+    def __init__(self, message: Optional[str] = None):
+        self.message = f'\t{message}' if message else f'\tQueue client error'
+
+        super().__init__(self.message)
+
+
+class UploadVerificationException(Exception):
+    def __init__(self, key: Optional[str] = None, expected: Optional[str] = None, received: Optional[str] = None):
+        if key:
+            self.key = key
+            self.message = f"\tChecksum mismatch uploading '{self.key}'. Expected '{expected}', S3 returned '{received}'"
+        else:
+            self.message = f'\tChecksum mismatch uploading file'
+
+        super().__init__(self.message)
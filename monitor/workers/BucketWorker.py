@@ -7,13 +7,20 @@ import platform
 import tempfile
 import time
 from threading import Thread
+from typing import Optional
 
 import boto3
 import watchtower
 
 from monitor.Bucket import Bucket
+from monitor.InFlightRegistry import InFlightRegistry
+from monitor.Metrics import SAMPLES, FAILURES
 from monitor.QueueManager import QueueManager
+from monitor.SampleLedger import SampleLedger, DONE
+from monitor.TraceStore import TraceStore, traced
 from monitor.client.BackendClient import BackendClient
+from monitor.client.StatusDispatcher import StatusDispatcher
+from monitor.exceptions import UploadVerificationException
 
 logger = logging.getLogger('BucketWorker')
 # if not logger.handlers:
@@ -30,7 +37,11 @@ class BucketWorker(Thread):
     """
 
     def __init__(self, parent, backend_cli: BackendClient, config, queue_mgr: QueueManager, name='Uploader0',
-                 daemon=True):
+                 daemon=True, bucket: Optional[Bucket] = None,
+                 status_cli: Optional[StatusDispatcher] = None,
+                 ledger: Optional[SampleLedger] = None,
+                 traces: Optional[TraceStore] = None,
+                 inflight: Optional[InFlightRegistry] = None):
         """
 
         Args:
@@ -46,6 +57,16 @@ class BucketWorker(Thread):
                 Name of the worker instance
             daemon:
                 Run the worker as daemon. (Optional. Default: True)
+            bucket: Bucket (Optional. Default: None)
+                A Bucket shared by all the uploaders, a new one is created if missing
+            status_cli: StatusDispatcher (Optional. Default: None)
+                Write-behind dispatcher for the sample state updates, backend_cli is used directly if missing
+            ledger: SampleLedger (Optional. Default: None)
+                Local record of the processed samples, updated once a sample is uploaded
+            traces: TraceStore (Optional. Default: None)
+                Store of the sample spans, saves 'upload' spans
+            inflight: InFlightRegistry (Optional. Default: None)
+                Samples being converted or uploaded, a sample is released once its upload is done
         """
         super().__init__(name=name, daemon=daemon)
         if config['debug']:
@@ -55,9 +76,15 @@ class BucketWorker(Thread):
 
         self.parent = parent
         self.running = False
+        self.processed = 0  # number of items handled, used to measure throughput
         self.queue_mgr = queue_mgr
-        self.bucket = Bucket(config['aws']['bucket_name'])
+        self.bucket = bucket or Bucket(config['aws']['bucket_name'], config['aws'].get('transfer'),
+                                       config['aws'].get('index'))
         self.backend_cli = backend_cli
+        self.status_cli = status_cli or backend_cli
+        self.ledger = ledger
+        self.traces = traces
+        self.inflight = inflight
         self.storage = tempfile.tempdir
         self.test = config['test']
 
@@ -70,95 +97,113 @@ class BucketWorker(Thread):
         extension = None
 
         while self.running:
+            item = None
+            failed = False  # None leaves the upload message leased, it's released on shutdown
             try:
-                item = self.queue_mgr.get_next_message(self.queue_mgr.upload_q())
+                item = self.queue_mgr.next_message(self.queue_mgr.upload_q())
                 if not item:
-                    # logger.debug('\twaiting...')
-                    time.sleep(1.7)
                     continue
 
                 file_basename, extension = str(item.split(os.path.sep)[-1]).rsplit('.', 1)
                 logger.debug(f'base: {file_basename}\titem: {item}')
 
                 logger.info(f'Uploading {item} ({os.path.getsize(item)} bytes) to {self.bucket.bucket_name}')
-                remote_name = self.bucket.save(item)
-
-                time.sleep(1)  # giving time to S3 to finish uploading the sample
-
+                # converted files are in the temp folder, trace them by name to keep the instrument of the sample
+                with traced(self.traces, os.path.basename(item), 'upload'):
+                    remote_name = self.bucket.save(item)
 
                 if remote_name:
+                    # the upload was verified against the checksums computed while uploading
                     logger.info(f'\tFile {remote_name} saved to {self.bucket.bucket_name}')
-
-                    # paranoid checking if sample is still in the bucket
-                    try:
-                        self.re_check_file(file_basename, extension)
-                    except Exception as ex:
-                        logger.error(f'Failed checking if file was uploaded correctly, trying again.')
-                        time.sleep(5)
-                        try:
-                            self.re_check_file(file_basename, extension)
-                        except Exception as ex:
-                            logger.error(f'Failed checking if file was uploaded correctly.')
-                            self.fail_sample(file_basename, 'mzml', reason='Couldn\'t check if file was uploaded successfully')
-
+                    SAMPLES.labels('upload', 'uploaded').inc()
+                    self.pass_sample(file_basename, extension)
                 else:
                     self.fail_sample(file_basename, 'mzml',
                                      reason='some unknown error happened while uploading the file')
+                    failed = True
 
-                logger.info(f'Uploader queue size: {self.queue_mgr.get_size(self.queue_mgr.upload_q())}')
+                logger.info(f'Uploader queue size: {self.queue_mgr.depth("upload")}')
+                self.processed += 1
+
+            except UploadVerificationException as uve:
+                logger.error(f'\tUpload of {item} is corrupted: {uve.message}')
+                self.fail_sample(file_basename, 'mzml', reason=uve.message, kind='verification')
+                failed = True
 
             except ConnectionResetError as cre:
                 logger.error(f'\tConnection Reset: {cre.strerror} uploading {cre.filename}')
-                self.fail_sample(file_basename, 'mzml', reason=str(cre))
+                self.fail_sample(file_basename, 'mzml', reason=str(cre), kind='connection')
+                failed = True
 
             except KeyboardInterrupt:
                 logger.warning(f'\tStopping {self.name} due to Control+C')
+                failed = None
                 self.running = False
                 self.parent.join_threads()
 
             except IndexError:
+                failed = True
                 time.sleep(1)
 
             except Exception as ex:
                 logger.error(f'\tError uploading sample {item}: {str(ex)}')
-                self.fail_sample(file_basename, 'mzml', reason=str(ex))
+                self.fail_sample(file_basename, 'mzml', reason=str(ex), kind=type(ex).__name__)
+                failed = True
 
             finally:
+                # keep the converted file while its message can be delivered again
+                if failed is None:
+                    retried = self.queue_mgr.leases
+                else:
+                    retried = bool(item) and self.finish_message(item, failed)
+
                 # delete converted file silently in case of errors
                 try:
-                    os.remove(item)
+                    os.remove(item) if not retried else None
                 except:
                     pass
 
+                if item and self.inflight and not retried:
+                    self.inflight.release(item)
+
         logger.info(f'\tStopping {self.name}')
-        self.join()
+
+    def finish_message(self, item, failed: bool) -> bool:
+        """
+        Acks the upload message of a file once it's uploaded, or returns it to the queue to be retried after a
+        backoff if the upload failed
+        Returns:
+            True if the message will be delivered again
+        """
+        queue = self.queue_mgr.upload_q()
+        try:
+            if failed:
+                return self.queue_mgr.nack(queue, item)
+            self.queue_mgr.ack(queue, item)
+            return False
+        except Exception as ex:
+            logger.error(f'\tCan\'t {"nack" if failed else "ack"} the upload message of {item}: {str(ex)}')
+            return False
 
     def pass_sample(self, file_basename, extension="mzml"):
         try:
             logger.info(f'\tAdd "uploaded_raw" status to stasis for sample "{file_basename}.{extension}"')
-            self.backend_cli.sample_state_update(file_basename, 'uploaded_raw', f'{file_basename}.mzml',
+            self.status_cli.sample_state_update(file_basename, 'uploaded_raw', f'{file_basename}.mzml',
                                                  reason=f'File uploaded by Monitor running on {platform.node()}')
+            self.ledger.mark(file_basename, DONE) if self.ledger else None
         except Exception as ex:
             logger.error(f'\tStasis client can\'t send "uploaded_raw" status for sample "{file_basename}". '
                          f'\tResponse: {str(ex)}')
 
-    def fail_sample(self, file_basename, extension, reason):
+    def fail_sample(self, file_basename, extension, reason, kind: str = 'error'):
+        FAILURES.labels('upload', kind).inc()
         try:
             logger.error(f'\tAdd "failed" upload status to stasis for sample "{file_basename}.{extension}"')
-            self.backend_cli.sample_state_update(file_basename, 'failed', reason=reason)
+            self.status_cli.sample_state_update(file_basename, 'failed', reason=reason)
+            self.ledger.mark(file_basename, 'failed') if self.ledger else None
         except Exception as ex:
             logger.error(f'\tStasis client can\'t send "failed" status for sample "{file_basename}.{extension}". '
                          f'\tResponse: {str(ex)}')
 
     def exists(self, filename):
         return self.bucket.exists(filename)
-
-
-    def re_check_file(self, file_basename, extension):
-        key = f'{file_basename}.{extension}'
-        exists = self.bucket.object_head(key)
-        logger.info(f'\tFile {key} upload correctly? {exists}')
-        if exists:
-            self.pass_sample(file_basename, extension)
-        else:
-            self.fail_sample(file_basename, 'mzml', reason=f'After successful upload the file {key} was not found on S3')
\ No newline at end of file
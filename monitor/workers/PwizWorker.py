@@ -7,17 +7,34 @@ import re
 import subprocess
 import tempfile
 import time
-from botocore.exceptions import EndpointConnectionError
+from botocore.exceptions import EndpointConnectionError, BotoCoreError, ClientError
 from os.path import getsize, join
 from pathlib import Path
 from threading import Thread, Lock, local
+from typing import Optional
 
 import simplejson as json
 import watchtower
 
-from monitor.Bucket import Bucket
+from monitor.Bucket import Bucket, TransferProgress
+from monitor.InFlightRegistry import InFlightRegistry, DEFER_DELAY
+from monitor.Metrics import MSCONVERT_SECONDS, CONVERTED_BYTES, SAMPLES, FAILURES
 from monitor.QueueManager import QueueManager
+from monitor.SampleFilter import SampleFilter
+from monitor.SampleLedger import SampleLedger, DONE
+from monitor.TraceStore import TraceStore, traced
 from monitor.client.BackendClient import BackendClient
+from monitor.client.StatusDispatcher import StatusDispatcher
+from monitor.exceptions import UploadVerificationException
+from monitor.workers.SettleWorker import SettleWorker
+
+MSCONVERT_ARGS = ['--mzML', '-e', '.mzml', '--zlib',
+                  '--filter', '"peakPicking true 1-"',
+                  '--filter', '"zeroSamples removeExtra"',
+                  '-o']
+
+# errors worth converting the sample again (I/O, S3 and network), any other failure is acked
+TRANSIENT_ERRORS = (OSError, BotoCoreError, ClientError, UploadVerificationException)
 
 logger = logging.getLogger('PwizWorker')
 # if not logger.handlers:
@@ -34,7 +51,13 @@ class PwizWorker(Thread):
     """
 
     def __init__(self, parent, backend_cli: BackendClient, queue_mgr: QueueManager, config,
-                 name='Converter0', daemon=True):
+                 name='Converter0', daemon=True, settler: Optional[SettleWorker] = None,
+                 bucket: Optional[Bucket] = None,
+                 status_cli: Optional[StatusDispatcher] = None,
+                 sample_filter: Optional[SampleFilter] = None,
+                 ledger: Optional[SampleLedger] = None,
+                 traces: Optional[TraceStore] = None,
+                 inflight: Optional[InFlightRegistry] = None):
         """
 
         Args:
@@ -50,6 +73,21 @@ class PwizWorker(Thread):
                 Name of the worker instance
             daemon:
                 Run the worker as daemon. (Optional. Default: True)
+            settler: SettleWorker (Optional. Default: None)
+                Worker providing the samples that finished acquiring. When missing, samples are read from the
+                conversion queue and the converter waits for the acquisition to finish
+            bucket: Bucket (Optional. Default: None)
+                A Bucket shared by all the workers, a new one is created if missing
+            status_cli: StatusDispatcher (Optional. Default: None)
+                Write-behind dispatcher for the sample state updates, backend_cli is used directly if missing
+            sample_filter: SampleFilter (Optional. Default: None)
+                Filter shared with the event handler, a new one is created from the config if missing
+            ledger: SampleLedger (Optional. Default: None)
+                Local record of the processed samples, checked before any remote call
+            traces: TraceStore (Optional. Default: None)
+                Store of the sample spans, saves 'msconvert' spans (and 'upload' when streaming)
+            inflight: InFlightRegistry (Optional. Default: None)
+                Samples being converted or uploaded, duplicates of a sample in flight are dropped or deferred
 
         """
         super().__init__(name=name, daemon=daemon)
@@ -59,39 +97,52 @@ class PwizWorker(Thread):
 
         self.parent = parent
         self.running = False
+        self.processed = 0  # number of items handled, used to measure throughput
         self.queue_mgr = queue_mgr
         self.backend_cli = backend_cli
+        self.status_cli = status_cli or backend_cli
         self.config = config
         self.storage = config['monitor']['storage'] if config['monitor']['storage'].endswith(os.path.sep) else \
             config['monitor']['storage'] + os.path.sep
         self.test = config['test']
-        self.bucket = Bucket(config['aws']['bucket_name'])
+        self.bucket = bucket or Bucket(config['aws']['bucket_name'], config['aws'].get('transfer'),
+                                       config['aws'].get('index'))
+        self.settler = settler
+        self.filter = sample_filter or SampleFilter(config['monitor']['skip'], config['monitor']['extensions'])
+        self.ledger = ledger
+        self.traces = traces
+        self.inflight = inflight
+        self.defer_delay = config['monitor'].get('dedup', {}).get('defer_delay', DEFER_DELAY)
 
         self._lock = Lock()
 
+        self.stream_upload = config['monitor'].get('stream_upload', False)
+
         self.runner = config['monitor']['msconvert']
-        self.args = ['--mzML', '-e', '.mzml', '--zlib',
-                     '--filter', '"peakPicking true 1-"',
-                     '--filter', '"zeroSamples removeExtra"',
-                     '-o']
+        self.args = list(MSCONVERT_ARGS)
 
     def run(self):
         """Starts the processing of elements in the conversion queue"""
         self.running = True
 
-        item = local()
-
         while self.running:
+            item = ''
+            failed = False  # None leaves the conversion message leased, it's released on shutdown
+            claimed = False
             try:
                 queue = self.queue_mgr.conversion_q()
                 if not queue:
                     logger.warn('Failed to get queue url, skipping for now...')
                     continue
 
-                item = self.queue_mgr.get_next_message(queue)
+                if self.settler:
+                    item = self.settler.get_ready()
+                else:
+                    item = self.queue_mgr.next_message(queue)
+                    if item and self.traces:
+                        self.traces.event(item, 'dequeue', since='enqueue')
+
                 if not item:
-                    # logger.debug('\twaiting...')
-                    time.sleep(1.7)
                     file_basename = None
                     ext = None
                     continue
@@ -100,26 +151,30 @@ class PwizWorker(Thread):
                 file_basename = splits[0]
                 extension = splits[1] if len(splits) == 2 else ''
 
-                # result = [re.search(x, item) is not None for x in self.config['monitor']['skip']]
-                result = []
-                matched = ""
-                for x in self.config['monitor']['skip']:
-                    if re.search(x, item) is not None:
-                        result.append(True)
-                        matched=x
-                        break
-                    else:
-                        result.append(False)
-
-                if any(result):
-                    logger.info(f'\tSkipping conversion of invalid sample: {item}. Matched pattern: {matched}')
+                rule = self.filter.check(item)
+                if rule:
+                    logger.info(f'\tSkipping conversion of invalid sample: {item}. Matched rule: {rule}')
+                    SAMPLES.labels('conversion', 'invalid').inc()
                     continue
 
+                if self.ledger and self.ledger.is_done(item):
+                    logger.info(f'\tSample {item} already converted and uploaded, skipping.')
+                    SAMPLES.labels('conversion', 'done').inc()
+                    continue
+
+                # another worker is converting or uploading the same sample
+                if self.inflight:
+                    claimed = self.inflight.acquire(item, 'converting')
+                    if not claimed:
+                        self.skip_duplicate(item)
+                        continue
+
                 # check if sample exists in stasis first
                 if self.config['monitor']['exists']:
                     in_stasis = self.backend_cli.sample_acquisition_exists(file_basename)
                     if not in_stasis:
                         logger.info(f'Sample {file_basename} not in stasis, skipping.')
+                        SAMPLES.labels('conversion', 'not_in_stasis').inc()
                         continue
 
                 # check if sample has been converted and uploaded already
@@ -127,21 +182,28 @@ class PwizWorker(Thread):
 
                 if converted and self.config['monitor']['update_new']:
                     logger.info(f'Sample {file_basename} converted, uploaded and newer than 30 days, skipping.')
+                    SAMPLES.labels('conversion', 'done').inc()
                     continue
 
                 logger.info(f'Starting conversion of {item}')
 
-                self.wait_for_item(item)
+                if not self.settler:
+                    self.wait_for_item(item)
 
                 if item.endswith('.mzml'):
                     self.queue_mgr.put_message(self.queue_mgr.upload_q(), item)
+                    if self.inflight:
+                        self.inflight.move(item, 'uploading')
                 else:
                     # add acquired status
                     self.pass_sample('acquired', file_basename, extension)
 
                     # try conversion and update status
                     try:
-                        self.convert(file_basename, extension, item)
+                        if self.stream_upload:
+                            self.convert_stream(file_basename, extension, item)
+                        else:
+                            self.convert(file_basename, extension, item)
 
                     except subprocess.CalledProcessError as cpe:
                         logger.warning(f'Conversion of {item} failed.')
@@ -158,13 +220,17 @@ class PwizWorker(Thread):
                         # logger.error("\n\n"+str(error)+"\n\n")
                         logger.error("\n" + str(error['stderr']) + "\n")
 
-                        self.fail_sample(file_basename, extension, reason=json.dumps(error, use_decimal=True))
+                        self.fail_sample(file_basename, extension, reason=json.dumps(error, use_decimal=True),
+                                         kind='msconvert')
+                        self.record(item, 'failed')
+                        # msconvert fails the same way every time, don't convert it again
 
-                size = self.queue_mgr.get_size(queue)
-                logger.info(f'Conversion queue size: {size}')
+                logger.info(f'Conversion queue size: {self.queue_mgr.depth("conversion")}')
+                self.processed += 1
 
             except KeyboardInterrupt:
                 logger.warning(f'Stopping {self.name} due to Control+C')
+                failed = None
                 self.running = False
                 self.parent.join_threads()
 
@@ -174,20 +240,23 @@ class PwizWorker(Thread):
 
             except EndpointConnectionError as ece:
                 logger.warn('Connection Error')
+                failed = True
 
             except Exception as ex:
                 logger.error(f'Exception: {type(ex)}')
                 logger.error(f'Skipping conversion of sample {item} -- Error: {ex.args}')
+                failed = isinstance(ex, TRANSIENT_ERRORS)
                 filename, ext = str(item.split(os.sep)[-1]).split('.')
-                self.fail_sample(filename, ext, reason=str(ex))
+                self.fail_sample(filename, ext, reason=str(ex), kind=type(ex).__name__)
 
             finally:
-                pass
-                # size = self.queue_mgr.get_size(self.queue_mgr.conversion_q())
-                # logger.info(f'Conversion queue size: {size}')
+                if item and failed is not None:
+                    self.finish_message(item, failed)
+                # claims handed to the uploaders are released by them
+                if claimed and self.inflight.stage(item) == 'converting':
+                    self.inflight.release(item)
 
         logger.info(f'\tStopping {self.name}')
-        self.join()
 
     def convert(self, file_basename, extension, item):
         """
@@ -206,7 +275,8 @@ class PwizWorker(Thread):
         pw_args = [self.runner, item, *self.args, storage.lower()]
 
         logger.info(f'\tRunning ProteoWizard: {pw_args}')
-        result = subprocess.run(pw_args, capture_output=True, check=True)
+        with MSCONVERT_SECONDS.time(), traced(self.traces, item, 'msconvert'):
+            result = subprocess.run(pw_args, capture_output=True, check=True)
 
         if result.returncode == 0:
             resout = re.search(r'writing output file: (.*?)\n', result.stdout.decode('ascii')).group(1).strip()
@@ -217,11 +287,7 @@ class PwizWorker(Thread):
                 logger.warning(f'Sample {file_basename} was acquired as {resout}. Forcing rename')
                 os.rename(resout, mzmlfile)
 
-            # update tracking status and upload to aws
-            self.pass_sample('converted', file_basename, extension)
-
-            logger.info(f'\tAdd {mzmlfile} to upload queue')
-            self.queue_mgr.put_message(self.queue_mgr.upload_q(), mzmlfile)
+            self.queue_upload(file_basename, extension, item, mzmlfile)
 
         else:
             # update tracking status
@@ -231,7 +297,74 @@ class PwizWorker(Thread):
                      'stderr': result.stderr.decode('utf-8')}
             logger.error(error)
 
-            self.fail_sample(file_basename, "mzml", reason=json.dumps(error, use_decimal=True))
+            self.fail_sample(file_basename, "mzml", reason=json.dumps(error, use_decimal=True), kind='msconvert')
+
+    def queue_upload(self, file_basename, extension, item, mzmlfile):
+        """Hands a converted file to the uploaders"""
+        CONVERTED_BYTES.inc(os.path.getsize(mzmlfile))
+        SAMPLES.labels('conversion', 'converted').inc()
+
+        # update tracking status and upload to aws
+        self.pass_sample('converted', file_basename, extension)
+        self.record(item, 'converted')
+
+        logger.info(f'\tAdd {mzmlfile} to upload queue')
+        self.queue_mgr.put_message(self.queue_mgr.upload_q(), mzmlfile)
+        if self.inflight:
+            self.inflight.move(item, 'uploading')
+
+    def convert_stream(self, file_basename, extension, item):
+        """
+        Converts a sample streaming msconvert's output directly to the bucket, nothing is written to local storage.
+        If the upload fails the sample is converted again to a local file and sent to the upload queue, the second
+        run is traced as its own 'msconvert' span
+        Args:
+            file_basename: sample's filename (no extension)
+            extension: sample's extension
+            item: full sample name
+
+        Returns:
+
+        """
+        key = f'{file_basename}.mzml'
+        pw_args = [self.runner, item, *self.args[:-1], '--stdout']
+
+        logger.info(f'\tRunning ProteoWizard: {pw_args}')
+        progress = TransferProgress(key, -1)
+        streamed = False
+        with tempfile.TemporaryFile() as errors, MSCONVERT_SECONDS.time(), traced(self.traces, item, 'msconvert'):
+            proc = subprocess.Popen(pw_args, stdout=subprocess.PIPE, stderr=errors)
+            try:
+                with traced(self.traces, item, 'upload'):
+                    self.bucket.save_stream(key, proc.stdout, progress)
+                streamed = True
+                proc.wait()
+            except Exception as ex:
+                logger.warning(f'\tStreaming {key} to {self.bucket.bucket_name} failed ({str(ex)}), '
+                               f'converting to local storage')
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+
+            errors.seek(0)
+            stderr = errors.read()
+
+        # after the streaming span ends, so the fallback run is traced on its own
+        if not streamed:
+            self.convert(file_basename, extension, item)
+            return
+
+        if proc.returncode != 0:
+            self.bucket.delete(key)
+            raise subprocess.CalledProcessError(proc.returncode, pw_args, output=b'', stderr=stderr)
+
+        CONVERTED_BYTES.inc(progress.sent)
+        SAMPLES.labels('conversion', 'converted').inc()
+        self.pass_sample('converted', file_basename, extension)
+        self.pass_sample('uploaded_raw', file_basename, 'mzml')
+        self.record(item, DONE)
 
     def get_file_size(self, path):
         return os.stat(path).st_size
@@ -279,6 +412,32 @@ class PwizWorker(Thread):
             elif c == 5:
                 break
 
+    def skip_duplicate(self, item):
+        """Drops a sample already in flight, or sends it back to the conversion queue to be checked later"""
+        SAMPLES.labels('conversion', 'duplicate').inc()
+        if self.inflight.duplicate(item) == 'defer':
+            self.queue_mgr.defer(self.queue_mgr.conversion_q(), item, self.defer_delay)
+
+    def finish_message(self, item, failed: bool):
+        """
+        Acks the conversion message of a sample once it's handled, or returns it to the queue to be retried after
+        a backoff if the conversion failed with a transient error. Does nothing when the queue manager doesn't
+        lease messages
+        """
+        queue = self.queue_mgr.conversion_q()
+        try:
+            self.queue_mgr.nack(queue, item) if failed else self.queue_mgr.ack(queue, item)
+        except Exception as ex:
+            logger.error(f'\tCan\'t {"nack" if failed else "ack"} the conversion message of {item}: {str(ex)}')
+
+    def record(self, item, state):
+        """Saves the state of a sample in the ledger, if there's one"""
+        if self.ledger:
+            try:
+                self.ledger.record(item, state)
+            except Exception as ex:
+                logger.error(f'\tCan\'t save "{state}" state of {item} to the ledger: {str(ex)}')
+
     def pass_sample(self, status, file_basename, extension):
         try:
             logger.info(f'\tAdd "{status}" status to stasis for sample "{file_basename}.{extension}"')
@@ -287,17 +446,20 @@ class PwizWorker(Thread):
                 reason = f'Raw data file discovered by Monitor running on {platform.node()}'
             elif status == 'converted':
                 reason = f'Raw data file {status} by Monitor running on {platform.node()}'
+            elif status == 'uploaded_raw':
+                reason = f'File uploaded by Monitor running on {platform.node()}'
 
-            self.backend_cli.sample_state_update(file_basename, status, f'{file_basename}.{extension}', reason=reason)
+            self.status_cli.sample_state_update(file_basename, status, f'{file_basename}.{extension}', reason=reason)
         except Exception as ex:
             logger.error(f'\tStasis client can\'t send "{status}" status for sample "{file_basename}". '
                          f'\tResponse: {str(ex)}')
             pass
 
-    def fail_sample(self, file_basename, extension, reason: str):
+    def fail_sample(self, file_basename, extension, reason: str, kind: str = 'error'):
+        FAILURES.labels('conversion', kind).inc()
         try:
             logger.error(f'\tAdd "failed" conversion status to stasis for sample "{file_basename}.{extension}"')
-            self.backend_cli.sample_state_update(file_basename, 'failed', reason=reason)
+            self.status_cli.sample_state_update(file_basename, 'failed', reason=reason)
         except Exception as ex:
             logger.error(f'\tStasis client can\'t send "failed" status for sample "{file_basename}". '
                          f'\tResponse: {str(ex)}')
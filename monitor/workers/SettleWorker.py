@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import logging
+import os
+import platform
+import time
+from queue import Empty
+from threading import Thread, Lock
+from typing import Optional
+
+import watchtower
+
+from monitor.ConversionScheduler import ConversionScheduler, AGING, MAX_WAIT
+from monitor.Metrics import SETTLE_SECONDS
+from monitor.QueueManager import QueueManager
+from monitor.TraceStore import TraceStore
+
+SETTLE_INTERVAL = 120  # seconds between checks of an acquisition in progress
+TEST_SETTLE_INTERVAL = 3
+SETTLE_CHECKS = 1  # consecutive unchanged snapshots needed to consider a sample complete
+SETTLE_CAPACITY = 20  # samples settling or ready at once, the rest wait in the conversion queue
+
+logger = logging.getLogger('SettleWorker')
+# if not logger.handlers:
+#     h = watchtower.CloudWatchLogHandler(
+#         log_group_name=f'/lcb/monitor/{platform.node()}',
+#         log_group_retention_days=3,
+#         send_interval=30)
+#     logger.addHandler(h)
+
+
+def take_snapshot(path, cache: Optional[dict] = None) -> tuple:
+    """
+    Takes a cheap stat snapshot of a file or folder using os.scandir.
+    With a cache (kept between snapshots of the same sample) only the folders whose modification time changed are
+    listed again, the files of the other folders are stat'ed from the cached listing. Every file is stat'ed on
+    every snapshot, appending to a file doesn't change its folder's modification time
+    Args:
+        path: file or folder to inspect
+        cache: dict (Optional. Default: None)
+            Listings of the previous snapshot, updated in place
+
+    Returns:
+        A tuple (total size, number of files, newest modification time in ns)
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, 1, st.st_mtime_ns
+
+    cache = {} if cache is None else cache
+    size = count = newest = 0
+    seen = set()
+    pending = [path]
+    while pending:
+        folder = pending.pop()
+        seen.add(folder)
+        mtime = os.stat(folder).st_mtime_ns
+        listing = cache.get(folder)
+
+        if listing is None or listing['mtime'] != mtime:
+            # folder -> {'mtime', 'dirs', 'files': {file path: (size, mtime)}}
+            listing = cache[folder] = {'mtime': mtime, 'dirs': [], 'files': {}}
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        listing['dirs'].append(entry.path)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        listing['files'][entry.path] = (st.st_size, st.st_mtime_ns)
+        else:
+            for file in listing['files']:
+                st = os.stat(file, follow_symlinks=False)
+                listing['files'][file] = (st.st_size, st.st_mtime_ns)
+
+        pending.extend(listing['dirs'])
+        for file_size, file_mtime in listing['files'].values():
+            size += file_size
+            count += 1
+            newest = max(newest, file_mtime)
+
+    for gone in cache.keys() - seen:
+        del cache[gone]
+
+    return size, count, newest
+
+
+class SettleWorker(Thread):
+    """
+    Worker class that tracks acquisitions in progress and hands them to the converters once they stop changing
+    """
+
+    def __init__(self, parent, queue_mgr: QueueManager, config, name='Settler0', daemon=True,
+                 traces: TraceStore = None):
+        """
+
+        Args:
+            parent:
+                Instance parent object
+            queue_mgr: QueueManager
+                A QueueManager object that handles setting up queues and sending/receiving messages
+            config:
+                An object containing config settings
+            name: str (Optional. Default: Settler0)
+                Name of the worker instance
+            daemon:
+                Run the worker as daemon. (Optional. Default: True)
+            traces: TraceStore (Optional. Default: None)
+                Store of the sample spans, saves 'dequeue' and 'settle' spans
+        """
+        super().__init__(name=name, daemon=daemon)
+
+        if config['debug']:
+            logger.setLevel(level='DEBUG')
+
+        self.parent = parent
+        self.running = False
+        self.queue_mgr = queue_mgr
+        self.config = config
+        self.interval = config['monitor'].get('settle_interval',
+                                              TEST_SETTLE_INTERVAL if config['test'] else SETTLE_INTERVAL)
+        self.checks = config['monitor'].get('settle_checks', SETTLE_CHECKS)
+        self.capacity = config['monitor'].get('settle_capacity', SETTLE_CAPACITY)
+        self.traces = traces
+
+        # heap of [next check time, sequence, sample path], one entry per tracked sample
+        self._heap = []
+        self._seq = itertools.count()
+        # sample path -> {'snapshot', 'cache', 'stable', 'since', 'started'}
+        self._tracked = {}
+        self._lock = Lock()
+
+        # samples ready to be converted, in the order given by the scheduling policy
+        scheduler = config['monitor'].get('scheduler', {})
+        self.ready = ConversionScheduler(policy=scheduler.get('policy', 'fifo'),
+                                         aging=scheduler.get('aging', AGING),
+                                         max_wait=scheduler.get('max_wait', MAX_WAIT),
+                                         priorities=scheduler.get('priorities'))
+
+    def run(self):
+        """Starts tracking the samples in the conversion queue"""
+        self.running = True
+
+        while self.running:
+            try:
+                wait = min(self.next_check_in(), self.queue_mgr.wait_time)
+                if self.has_room():
+                    item = self.queue_mgr.next_message(self.queue_mgr.conversion_q(), wait_time=int(wait))
+                    if item:
+                        self.traces.event(item, 'dequeue', since='enqueue') if self.traces else None
+                        self.track(item)
+                else:
+                    # leave the rest of the samples in the queue until the converters catch up
+                    time.sleep(min(wait, 1))
+
+                self.check_due()
+
+            except KeyboardInterrupt:
+                logger.warning(f'Stopping {self.name} due to Control+C')
+                self.running = False
+                self.parent.join_threads()
+
+            except Exception as ex:
+                logger.error(f'Error tracking samples: {str(ex)}')
+                time.sleep(1)
+
+        logger.info(f'\tStopping {self.name}')
+
+    def track(self, path):
+        """Starts tracking a sample, samples already tracked are ignored"""
+        with self._lock:
+            if path in self._tracked:
+                logger.debug(f'\tSample {path} already waiting for instrument')
+                return
+
+        cache = {}
+        try:
+            snapshot = take_snapshot(path, cache)
+        except OSError as ex:
+            logger.warning(f'\tCan\'t inspect {path}, skipping. {str(ex)}')
+            self.queue_mgr.ack(self.queue_mgr.conversion_q(), path)
+            return
+
+        # files that haven't changed for a whole interval (ie: copied or acquired while we were down) are ready
+        if time.time_ns() - snapshot[2] >= self.interval * 1e9:
+            logger.info(f'\tSample {path} is complete ({snapshot[0]} bytes)')
+            self.traces.event(path, 'settle') if self.traces else None
+            self.ready.put(path, snapshot[0], snapshot[2])
+            return
+
+        logger.info(f'\tSample {path} is still being acquired, checking again in {self.interval} seconds')
+        with self._lock:
+            self._tracked[path] = {'snapshot': snapshot, 'cache': cache, 'stable': 0, 'since': time.monotonic(),
+                                   'started': time.time()}
+            heapq.heappush(self._heap, [time.monotonic() + self.interval, next(self._seq), path])
+
+    def check_due(self):
+        """Takes a new snapshot of every sample whose next check time has passed"""
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return
+                _, _, path = heapq.heappop(self._heap)
+                entry = self._tracked[path]
+
+            try:
+                snapshot = take_snapshot(path, entry['cache'])
+            except OSError as ex:
+                logger.warning(f'\tSample {path} disappeared while waiting for instrument. {str(ex)}')
+                with self._lock:
+                    del self._tracked[path]
+                self.queue_mgr.ack(self.queue_mgr.conversion_q(), path)
+                self.traces.add(path, 'settle', entry['started'], time.time(), 'disappeared') if self.traces else None
+                continue
+
+            entry['stable'] = entry['stable'] + 1 if snapshot == entry['snapshot'] else 0
+            entry['snapshot'] = snapshot
+
+            with self._lock:
+                if entry['stable'] >= self.checks:
+                    del self._tracked[path]
+                    logger.info(f'\tSample {path} is complete ({snapshot[0]} bytes) after '
+                                f'{time.monotonic() - entry["since"]:.0f} seconds')
+                    SETTLE_SECONDS.observe(time.monotonic() - entry['since'])
+                    self.traces.add(path, 'settle', entry['started'], time.time()) if self.traces else None
+                    self.ready.put(path, snapshot[0], snapshot[2])
+                else:
+                    logger.debug(f'\t\twaiting for instrument ({path}, {snapshot[0]} bytes)...')
+                    heapq.heappush(self._heap, [now + self.interval, next(self._seq), path])
+
+    def next_check_in(self) -> float:
+        """Seconds until the next sample is due for a check"""
+        with self._lock:
+            if not self._heap:
+                return self.interval
+            return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def get_ready(self, timeout: float = 1) -> str:
+        """
+        Returns the next sample ready to be converted
+        Args:
+            timeout: seconds to wait for a sample
+
+        Returns:
+            The path of the sample or an empty string if no sample is ready
+        """
+        try:
+            return self.ready.get(timeout=timeout)
+        except Empty:
+            return ''
+
+    def has_room(self) -> bool:
+        """
+        True if the settler can take another sample. Without leases the messages of the samples held here are
+        already deleted from the queue, the capacity bounds what a crash can lose
+        """
+        return self.pending() + self.ready.qsize() < self.capacity
+
+    def pending(self) -> int:
+        """Number of samples still being acquired"""
+        with self._lock:
+            return len(self._tracked)
@@ -13,13 +13,14 @@ setup(name='Monitor',
       data_files=[('config', ['appconfig.yml'])],
       install_requires=[
           'requests',
+          'aiohttp',
           'simplejson',
           'yamlconf',
           'watchdog',
           'boto3',
           'botocore',
+          'psutil',
           'pywin32',
-          'retry',
           'watchtower',
       ],
       include_package_data=True,
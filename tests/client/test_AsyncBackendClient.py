@@ -0,0 +1,56 @@
+import pytest
+
+from monitor.client.AsyncBackendClient import SyncBackendClient
+from tests.conftest import StasisHandler
+
+
+@pytest.fixture
+def client(stasis):
+    client = SyncBackendClient({'debug': False}, stasis, 'token', concurrency=20)
+    yield client
+    client.close()
+
+
+def test_same_surface_as_backend_client(client):
+    assert client.sample_acquisition_exists('known1')
+    assert client.sample_acquisition_get('known1') == {'sample': 'known1'}
+    assert not client.sample_acquisition_exists('unknown1')
+    with pytest.raises(Exception):
+        client.sample_acquisition_get('unknown1')
+
+    client.sample_state_update('known1', 'converted', 'known1.mzml', reason='test')
+
+    assert StasisHandler.requests == ['/samples/metadata/known1', '/samples/metadata/unknown1', '/samples/status']
+
+
+def test_many_calls_run_concurrently(client):
+    samples = [f'known{x}' for x in range(100)] + [f'unknown{x}' for x in range(10)]
+
+    result = client.samples_acquisition_exist(samples)
+
+    assert sum(result.values()) == 100
+    assert not any(result[f'unknown{x}'] for x in range(10))
+
+    updates = [{'sample_name': f'known{x}', 'state': 'acquired'} for x in range(50)]
+    assert not any(isinstance(r, Exception) for r in client.samples_state_update(updates))
+
+
+def test_retries_server_errors(client):
+    StasisHandler.failures = 1
+
+    assert client.sample_acquisition_exists('known1')
+    assert len(StasisHandler.requests) == 2
+
+
+def test_backoff_releases_the_slot(stasis):
+    client = SyncBackendClient({'debug': False}, stasis, 'token', concurrency=1)
+    StasisHandler.failures = 1
+
+    # the second check runs while the first one backs off
+    result = client.samples_acquisition_exist(['known1', 'known2'])
+    client.close()
+
+    assert result == {'known1': True, 'known2': True}
+    assert StasisHandler.requests[:3] == ['/samples/metadata/known1', '/samples/metadata/known2',
+                                          '/samples/metadata/known1']
+    assert client._loop.is_closed()
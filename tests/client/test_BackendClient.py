@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from monitor.client.BackendClient import BackendClient, POOL_SIZE
+from tests.conftest import StasisHandler
+
+
+@pytest.fixture
+def client(stasis):
+    return BackendClient({'debug': False, 'backend': {'pool_size': 4}}, stasis, 'token')
+
+
+def test_acquisition_lookups_are_cached(client):
+    assert client.sample_acquisition_exists('known1')
+    assert client.sample_acquisition_get('known1') == {'sample': 'known1'}
+    assert not client.sample_acquisition_exists('unknown1')
+    assert not client.sample_acquisition_exists('unknown1')
+
+    assert len(StasisHandler.requests) == 2
+    assert client.cache.stats()['hits'] == 2
+
+
+def test_state_update_invalidates_cache(client):
+    assert client.sample_acquisition_exists('known1')
+    client.sample_state_update('known1', 'converted')
+    assert client.sample_acquisition_exists('known1')
+
+    assert StasisHandler.requests == ['/samples/metadata/known1', '/samples/status', '/samples/metadata/known1']
+
+
+def test_retries_server_errors(client):
+    StasisHandler.failures = 2
+
+    assert client.sample_acquisition_exists('known1')
+    assert len(StasisHandler.requests) == 3
+
+
+def test_connections_reused_across_threads(client):
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(client.sample_acquisition_exists, [f'known{x}' for x in range(40)]))
+
+    assert all(results)
+    stats = client.pool_stats()
+    assert stats['requests'] == 40
+    assert stats['connections'] <= 4
+    assert stats['reused'] >= 36
+
+
+def test_pool_size(stasis):
+    assert BackendClient({'debug': False}, stasis, 'token', pool_size=3).adapter._pool_maxsize == 3
+    assert BackendClient({'debug': False, 'backend': {'pool_size': 5}}, stasis, 'token').adapter._pool_maxsize == 5
+    assert BackendClient({'debug': False}, stasis, 'token').adapter._pool_maxsize == POOL_SIZE
@@ -0,0 +1,39 @@
+import time
+
+from monitor.client.MetadataCache import MetadataCache, MISSING
+
+
+def test_positive_and_negative_ttl():
+    cache = MetadataCache(ttl=10, negative_ttl=0.1)
+    cache.put('found', {'sample': 'found'})
+    cache.put('missing', None)
+
+    assert cache.get('found') == {'sample': 'found'}
+    assert cache.get('missing') is None
+    assert cache.get('unknown') is MISSING
+
+    time.sleep(0.2)
+    assert cache.get('found') == {'sample': 'found'}
+    assert cache.get('missing') is MISSING
+
+    assert cache.stats() == {'size': 1, 'hits': 3, 'misses': 2}
+
+
+def test_lru_eviction():
+    cache = MetadataCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_invalidate():
+    cache = MetadataCache()
+    cache.put('a', 1)
+    cache.invalidate('a')
+
+    assert cache.get('a') is MISSING
@@ -0,0 +1,61 @@
+import time
+from threading import Event
+
+from mock import MagicMock
+
+from monitor.client.StatusDispatcher import StatusDispatcher
+
+
+def test_updates_sent_in_order_per_sample():
+    sent = []
+    backend_cli = MagicMock()
+    backend_cli.sample_state_update.side_effect = lambda s, st, fh=None, reason=None: sent.append((s, st))
+    dispatcher = StatusDispatcher(backend_cli, senders=3)
+
+    for sample in ['s1', 's2', 's3']:
+        for state in ['acquired', 'converted', 'uploaded_raw']:
+            dispatcher.sample_state_update(sample, state, f'{sample}.mzml')
+    # duplicated transition is dropped
+    dispatcher.sample_state_update('s3', 'uploaded_raw', 's3.mzml')
+
+    assert dispatcher.flush(5)
+    dispatcher.stop()
+
+    assert len(sent) == 9
+    for sample in ['s1', 's2', 's3']:
+        assert [st for s, st in sent if s == sample] == ['acquired', 'converted', 'uploaded_raw']
+
+
+def test_queue_returns_while_backend_is_slow():
+    release = Event()
+    backend_cli = MagicMock()
+    backend_cli.sample_state_update.side_effect = lambda *args, **kwargs: release.wait(5)
+    dispatcher = StatusDispatcher(backend_cli, senders=1)
+
+    start = time.monotonic()
+    for x in range(10):
+        dispatcher.sample_state_update(f's{x}', 'acquired')
+    assert time.monotonic() - start < 0.5
+
+    release.set()
+    assert dispatcher.flush(5)
+    dispatcher.stop()
+
+
+def test_unsent_updates_spilled_and_reloaded(tmp_path):
+    spill = str(tmp_path / 'status.jsonl')
+    down = MagicMock()
+    down.sample_state_update.side_effect = Exception('stasis is down')
+    dispatcher = StatusDispatcher(down, spill_file=spill, max_size=2, senders=1)
+
+    for x in range(5):
+        dispatcher.sample_state_update(f's{x}', 'acquired')
+    dispatcher.stop(timeout=0.5)
+    assert dispatcher.pending() == 5
+
+    up = MagicMock()
+    dispatcher = StatusDispatcher(up, spill_file=spill, max_size=2, senders=2)
+    assert dispatcher.flush(5)
+    dispatcher.stop()
+
+    assert sorted(c.args[0] for c in up.sample_state_update.call_args_list) == [f's{x}' for x in range(5)]
@@ -1,6 +1,9 @@
+import json
 import logging
 import os
 import shutil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
 
 import boto3
 import moto
@@ -69,7 +72,7 @@ def raw(config):
 def test_qm(mocks):
     logging.getLogger().root.setLevel('DEBUG')
 
-    return QueueManager(stage='test')
+    return QueueManager(stage='test', wait_time=1)
 
 @pytest.fixture
 def observer_factory_eclipse():
@@ -82,3 +85,47 @@ def observer_factory_other():
     of = ObserverFactory()
     of.platform = 'other'
     return of
+
+
+class StasisHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    failures = 0
+
+    def do_GET(self):
+        StasisHandler.requests.append(self.path)
+        if StasisHandler.failures:
+            StasisHandler.failures -= 1
+            return self.reply(503, {})
+
+        sample = self.path.rsplit('/', 1)[-1]
+        if sample.startswith('known'):
+            self.reply(200, {'sample': sample})
+        else:
+            self.reply(404, {})
+
+    def do_POST(self):
+        StasisHandler.requests.append(self.path)
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.reply(200, {})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stasis():
+    StasisHandler.requests = []
+    StasisHandler.failures = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StasisHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
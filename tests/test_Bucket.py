@@ -0,0 +1,133 @@
+import io
+import os
+
+import boto3
+import pytest
+from mock import patch
+
+from monitor.Bucket import Bucket, MB
+from monitor.exceptions import UploadVerificationException
+
+BUCKET = 'datatest-carrot'
+
+
+@pytest.fixture
+def bucket(mocks):
+    return Bucket(BUCKET, {'chunk_size_mb': 5, 'max_concurrency': 2})
+
+
+@pytest.fixture
+def big_file(tmp_path):
+    path = tmp_path / 'big.mzml'
+    path.write_bytes(os.urandom(11 * MB))
+    return str(path)
+
+
+def test_save_small_file(bucket, tmp_path):
+    path = tmp_path / 'small.mzml'
+    path.write_bytes(b'x' * 100)
+    sent = []
+
+    assert bucket.save(str(path), callback=sent.append) == 'small.mzml'
+    assert sum(sent) == 100
+    assert bucket.object_head('small.mzml')
+
+
+def test_save_multipart(bucket, big_file):
+    sent = []
+
+    assert bucket.save(big_file, callback=sent.append) == 'big.mzml'
+
+    assert sum(sent) == 11 * MB
+    assert len(sent) == 3
+    obj = boto3.client('s3').head_object(Bucket=BUCKET, Key='big.mzml')
+    assert obj['ContentLength'] == 11 * MB
+
+
+def test_save_resumes_after_connection_reset(bucket, big_file):
+    upload_part = bucket.client.upload_part
+    calls = []
+
+    def flaky_upload_part(**kwargs):
+        calls.append(kwargs['PartNumber'])
+        if kwargs['PartNumber'] == 3:
+            raise ConnectionResetError('reset by peer')
+        return upload_part(**kwargs)
+
+    with patch.object(bucket.client, 'upload_part', side_effect=flaky_upload_part):
+        with pytest.raises(ConnectionResetError):
+            bucket.save(big_file)
+
+    # parts 1 and 2 were kept on S3, only part 3 is uploaded again
+    sent = []
+    assert bucket.save(big_file, callback=sent.append) == 'big.mzml'
+    assert calls.count(1) == 1 and calls.count(2) == 1
+    assert sum(sent) == 11 * MB
+    obj = boto3.client('s3').head_object(Bucket=BUCKET, Key='big.mzml')
+    assert obj['ContentLength'] == 11 * MB
+
+
+def test_resume_resends_stale_parts(bucket, big_file):
+    upload_part = bucket.client.upload_part
+    calls = []
+
+    def flaky_upload_part(**kwargs):
+        calls.append(kwargs['PartNumber'])
+        if kwargs['PartNumber'] == 3:
+            raise ConnectionResetError('reset by peer')
+        return upload_part(**kwargs)
+
+    with patch.object(bucket.client, 'upload_part', side_effect=flaky_upload_part):
+        with pytest.raises(ConnectionResetError):
+            bucket.save(big_file)
+
+    # the file is converted again with different content but the same size
+    with open(big_file, 'r+b') as f:
+        f.write(os.urandom(MB))
+
+    with patch.object(bucket.client, 'upload_part', wraps=upload_part) as resend:
+        assert bucket.save(big_file) == 'big.mzml'
+
+    assert sorted(c.kwargs['PartNumber'] for c in resend.call_args_list) == [1, 3]
+    with open(big_file, 'rb') as f:
+        assert boto3.client('s3').get_object(Bucket=BUCKET, Key='big.mzml')['Body'].read() == f.read()
+
+
+def test_save_detects_corrupted_upload(bucket, tmp_path):
+    path = tmp_path / 'small.mzml'
+    path.write_bytes(b'x' * 100)
+    put_object = bucket.client.put_object
+
+    def corrupting_put_object(**kwargs):
+        response = put_object(**kwargs)
+        response['ETag'] = '"00000000000000000000000000000000"'
+        return response
+
+    with patch.object(bucket.client, 'put_object', side_effect=corrupting_put_object):
+        with pytest.raises(UploadVerificationException):
+            bucket.save(str(path))
+
+
+def test_save_stream(bucket):
+    data = os.urandom(11 * MB)
+    sent = []
+
+    assert bucket.save_stream('stream.mzml', io.BytesIO(data), callback=sent.append) == 'stream.mzml'
+
+    assert len(sent) == 3
+    obj = boto3.client('s3').get_object(Bucket=BUCKET, Key='stream.mzml')
+    assert obj['Body'].read() == data
+
+
+def test_save_small_stream(bucket):
+    assert bucket.save_stream('small-stream.mzml', io.BytesIO(b'x' * 100)) == 'small-stream.mzml'
+    assert bucket.object_head('small-stream.mzml')
+
+
+def test_save_stream_aborts_on_failure(bucket):
+    with patch.object(bucket.client, 'upload_part', side_effect=ConnectionResetError('reset by peer')):
+        with pytest.raises(ConnectionResetError):
+            bucket.save_stream('broken.mzml', io.BytesIO(os.urandom(11 * MB)))
+
+    assert not bucket.client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+    assert not bucket.object_head('broken.mzml')
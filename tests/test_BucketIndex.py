@@ -0,0 +1,92 @@
+import os
+import time
+from threading import Thread
+
+import boto3
+import pytest
+
+from monitor.Bucket import Bucket
+from monitor.BucketIndex import BucketIndex
+
+BUCKET = 'datatest-carrot'
+KEYS = ['0001.mzml', '9z.mzml', 'A.mzml', 'Biorec_1.mzml', 'Z_last.mzml', '_under.mzml', 'a', 'lgvty_01.mzml',
+        'zz.mzml', '~tilde.mzml', 'ñandu.mzml']
+
+
+@pytest.fixture
+def s3(mocks):
+    client = boto3.client('s3')
+    for key in KEYS:
+        client.put_object(Bucket=BUCKET, Key=key, Body=key.encode())
+    return client
+
+
+def test_crawl_finds_every_key(s3):
+    index = BucketIndex(s3, BUCKET, workers=4)
+
+    entries = index.crawl()
+
+    assert sorted(entries.keys()) == sorted(KEYS)
+    assert entries['A.mzml'][0] == len('A.mzml')
+
+
+def test_index_persisted_to_disk(s3, tmp_path):
+    path = str(tmp_path / 'index.json')
+    index = BucketIndex(s3, BUCKET, path=path)
+    index.refresh()
+    assert os.path.exists(path)
+
+    loaded = BucketIndex(s3, BUCKET, path=path)
+    assert loaded.size() == len(KEYS)
+    assert loaded.get('lgvty_01.mzml') == index.get('lgvty_01.mzml')
+
+
+def test_bucket_exists_uses_index(s3, tmp_path):
+    bucket = Bucket(BUCKET, index={'enabled': True})
+    assert bucket.exists('Biorec_1.mzml')
+    assert not bucket.exists('missing.mzml')
+
+    path = tmp_path / 'new.mzml'
+    path.write_bytes(b'x' * 10)
+    bucket.save(str(path))
+    assert bucket.index.get('new.mzml')[0] == 10
+    assert bucket.exists('new.mzml')
+
+    bucket.delete('new.mzml')
+    assert not bucket.exists('new.mzml')
+
+
+def test_concurrent_first_calls_crawl_once(s3):
+    index = BucketIndex(s3, BUCKET, workers=2)
+    crawls = []
+    crawl = index.crawl
+
+    def slow_crawl():
+        crawls.append(1)
+        time.sleep(0.2)
+        return crawl()
+
+    index.crawl = slow_crawl
+    threads = [Thread(target=index.get, args=('A.mzml',)) for _ in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert len(crawls) == 1
+
+
+def test_uploads_during_crawl_are_kept(s3):
+    index = BucketIndex(s3, BUCKET, workers=2)
+    crawl = index.crawl
+
+    def crawl_with_upload():
+        entries = crawl()
+        # uploaded while the listing was running, too late to be listed
+        index.put('late.mzml', 10, 'etag')
+        index.remove('A.mzml')
+        return entries
+
+    index.crawl = crawl_with_upload
+    index.refresh()
+
+    assert index.get('late.mzml')[0] == 10
+    assert index.get('A.mzml') is None
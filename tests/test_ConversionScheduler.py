@@ -0,0 +1,70 @@
+import time
+from queue import Empty
+
+import pytest
+
+from monitor.ConversionScheduler import ConversionScheduler, MB
+
+
+def drain(scheduler):
+    return [scheduler.get(timeout=0) for _ in range(scheduler.qsize())]
+
+
+def test_fifo():
+    scheduler = ConversionScheduler()
+    for p in ['a.raw', 'b.raw', 'c.raw']:
+        scheduler.put(p, 100 * MB)
+
+    assert drain(scheduler) == ['a.raw', 'b.raw', 'c.raw']
+    with pytest.raises(Empty):
+        scheduler.get(timeout=0.1)
+
+
+def test_shortest_job_first():
+    scheduler = ConversionScheduler('sjf')
+    scheduler.put('dia.raw', 40000 * MB)
+    scheduler.put('qc1.raw', 200 * MB)
+    scheduler.put('qc2.raw', 100 * MB)
+
+    assert drain(scheduler) == ['qc2.raw', 'qc1.raw', 'dia.raw']
+
+
+def test_recency():
+    scheduler = ConversionScheduler('recency')
+    now = time.time_ns()
+    scheduler.put('old.raw', mtime_ns=now - 3600 * 10 ** 9)
+    scheduler.put('new.raw', mtime_ns=now)
+
+    assert drain(scheduler) == ['new.raw', 'old.raw']
+
+
+def test_pattern_priorities():
+    scheduler = ConversionScheduler('sjf', priorities=[{'pattern': '(?i)_qc_', 'boost': 3600}])
+    scheduler.put('sample.raw', 100 * MB)
+    scheduler.put('plate_QC_01.raw', 10000 * MB)
+
+    assert drain(scheduler) == ['plate_QC_01.raw', 'sample.raw']
+
+
+def test_aging_and_max_wait(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+
+    scheduler = ConversionScheduler('sjf', aging=1, max_wait=None)
+    scheduler.put('big.raw', 500 * MB)  # 5 seconds
+    clock[0] += 10
+    scheduler.put('small.raw', 100 * MB)  # 1 second, but arrived 10 seconds later
+    assert drain(scheduler) == ['big.raw', 'small.raw']
+
+    scheduler = ConversionScheduler('sjf', aging=0, max_wait=60)
+    scheduler.put('big.raw', 500 * MB)
+    scheduler.put('small1.raw', 100 * MB)
+    assert scheduler.get(timeout=0) == 'small1.raw'
+    clock[0] += 61
+    scheduler.put('small2.raw', 100 * MB)
+    assert drain(scheduler) == ['big.raw', 'small2.raw']
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        ConversionScheduler('lifo')
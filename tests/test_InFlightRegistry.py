@@ -0,0 +1,59 @@
+from threading import Thread
+
+import pytest
+
+from monitor.InFlightRegistry import InFlightRegistry, sample_key
+
+
+def test_sample_key():
+    assert sample_key('C:\\data\\Sample1.d') == sample_key('/tmp/sample1.mzml') == 'sample1'
+
+
+def test_duplicate_is_rejected_until_released():
+    registry = InFlightRegistry()
+
+    assert registry.acquire('/data/sample1.d')
+    assert not registry.acquire('/data/sample1.d')
+    assert not registry.acquire('/other/Sample1.raw')
+    assert registry.acquire('/data/sample2.d')
+    assert registry.size() == 2
+
+    assert registry.duplicate('/data/sample1.d') == 'drop'
+    assert registry.stats() == {'in_flight': 2, 'dropped': 1, 'deferred': 0}
+
+    assert registry.release('/tmp/sample1.mzml')
+    assert not registry.release('/tmp/sample1.mzml')
+    assert registry.acquire('/data/sample1.d')
+
+
+def test_claim_moves_to_upload():
+    registry = InFlightRegistry(duplicates='defer')
+    registry.acquire('/data/sample1.d')
+    registry.move('/tmp/sample1.mzml', 'uploading')
+
+    assert registry.stage('/data/sample1.d') == 'uploading'
+    assert not registry.acquire('/data/sample1.d')
+    assert registry.duplicate('/data/sample1.d') == 'defer'
+    assert registry.stats()['deferred'] == 1
+    assert registry.stage('/data/sample2.d') is None
+
+
+def test_abandoned_claim_expires():
+    registry = InFlightRegistry(max_age=0)
+    assert registry.acquire('/data/sample1.d')
+    assert registry.acquire('/data/sample1.d')
+
+
+def test_concurrent_acquire():
+    registry = InFlightRegistry()
+    claimed = []
+    threads = [Thread(target=lambda: claimed.append(registry.acquire('/data/sample1.d'))) for _ in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert claimed.count(True) == 1
+
+
+def test_invalid_option():
+    with pytest.raises(ValueError):
+        InFlightRegistry(duplicates='ignore')
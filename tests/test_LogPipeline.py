@@ -0,0 +1,95 @@
+import logging
+import threading
+
+from monitor.LogPipeline import DropOldestQueue, SamplingFilter, LogPipeline, install_pipeline
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+        self.threads.add(threading.current_thread().name)
+
+
+def test_drop_oldest_queue():
+    q = DropOldestQueue(3)
+    for i in range(5):
+        q.put_nowait(i)
+
+    assert q.dropped == 2
+    assert [q.get_nowait() for _ in range(3)] == [2, 3, 4]
+
+
+def test_sampling_filter():
+    sampler = SamplingFilter(interval=60, burst=2)
+
+    def record(level=logging.INFO, line=1):
+        return logging.LogRecord('test', level, 'worker.py', line, 'message', None, None)
+
+    assert [sampler.filter(record()) for _ in range(4)] == [True, True, False, False]
+    # other lines and warnings are not affected
+    assert sampler.filter(record(line=2))
+    assert sampler.filter(record(level=logging.ERROR))
+    assert sampler.suppressed == 2
+
+    # the first record of the next window reports the suppressed ones
+    sampler.interval = 0
+    r = record()
+    assert sampler.filter(r)
+    assert '[2 similar messages suppressed]' in r.getMessage()
+
+
+def test_pipeline_ships_from_one_thread():
+    handler = ListHandler()
+    handler.setFormatter(logging.Formatter('%(threadName)s %(message)s'))
+    logger = logging.getLogger('test_pipeline')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    pipeline = install_pipeline(logger, burst=None)
+    try:
+        assert logger.handlers == [pipeline.handler]
+
+        def work():
+            for i in range(10):
+                logger.info(f'sample {i}')
+            try:
+                raise ValueError('bad sample')
+            except ValueError:
+                logger.exception('failed')
+
+        workers = [threading.Thread(target=work, name=f'Converter{x}') for x in range(3)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+    finally:
+        pipeline.stop()
+
+    assert len(handler.records) == 33
+    # records keep the name of the thread that logged them but are formatted by the shipping thread
+    assert handler.records[0].startswith('Converter')
+    assert len(handler.threads) == 1
+    assert not any(name.startswith('Converter') for name in handler.threads)
+    assert any('ValueError: bad sample' in r for r in handler.records)
+
+
+def test_pipeline_stats():
+    pipeline = LogPipeline([ListHandler()], queue_size=2, burst=1)
+    logger = logging.getLogger('test_pipeline_stats')
+    logger.propagate = False
+    logger.addHandler(pipeline.handler)
+    logger.setLevel(logging.INFO)
+
+    # not started, the queue fills up
+    for i in range(5):
+        logger.warning(f'warning {i}')
+    for i in range(3):
+        logger.info('same line')
+
+    assert pipeline.stats() == {'queued': 2, 'dropped': 4, 'suppressed': 2}
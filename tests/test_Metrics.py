@@ -0,0 +1,56 @@
+import urllib.request
+
+import pytest
+
+from monitor.Metrics import Counter, Gauge, Histogram, MetricsServer, Registry
+
+
+def test_render():
+    registry = Registry()
+    samples = Counter('samples_total', 'Samples', ('stage',), registry=registry)
+    depth = Gauge('depth', 'Queue depth', registry=registry)
+    latency = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1), registry=registry)
+
+    samples.labels('conversion').inc()
+    samples.labels('conversion').inc(2)
+    depth.set_function(lambda: 7)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    text = registry.render()
+
+    assert '# TYPE samples_total counter\nsamples_total{stage="conversion"} 3\n' in text
+    assert 'depth 7\n' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1\n' in text
+    assert 'latency_seconds_bucket{le="1"} 2\n' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 3\n' in text
+    assert 'latency_seconds_sum 5.55\n' in text
+    assert 'latency_seconds_count 3\n' in text
+
+
+def test_labels_are_checked_and_escaped():
+    registry = Registry()
+    failures = Counter('failures_total', 'Failures', ('reason',), registry=registry)
+
+    with pytest.raises(ValueError):
+        failures.labels('a', 'b')
+
+    failures.labels('bad "value"').inc()
+    assert 'failures_total{reason="bad \\"value\\""} 1' in registry.render()
+
+
+def test_server():
+    registry = Registry()
+    Counter('requests_total', 'Requests', registry=registry).inc()
+
+    server = MetricsServer(port=0, registry=registry)
+    server.start()
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics') as response:
+            assert response.status == 200
+            assert 'requests_total 1' in response.read().decode()
+    finally:
+        server.join(5)
+
+    assert not server.is_alive()
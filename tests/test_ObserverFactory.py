@@ -4,26 +4,28 @@ import logging
 import sys
 
 from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver
+
+from monitor.RemoteObserver import RemoteObserver
 
 logger = logging.getLogger('test_ObserverFactory')
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
 def test_get_observer_eclipse(observer_factory_eclipse):
-    obs = observer_factory_eclipse.getObserver()
+    obs = observer_factory_eclipse.getObserver('local')
 
     assert obs != None
     logger.info(type(obs))
 
     assert isinstance(obs, Observer)
-    assert not isinstance(obs, PollingObserver)
+    assert not isinstance(obs, RemoteObserver)
 
 def test_get_observer_non_eclipse(observer_factory_other):
-    obs = observer_factory_other.getObserver()
+    obs = observer_factory_other.getObserver('remote', {'monitor': {'remote': {'interval': 30, 'depth': 2}}})
 
     assert obs != None
     logger.info(type(obs))
 
-    assert isinstance(obs, PollingObserver)
+    assert isinstance(obs, RemoteObserver)
     assert not isinstance(obs, Observer)
-
+    assert obs.timeout == 30
+    assert obs.max_depth == 2
@@ -0,0 +1,121 @@
+from mock import patch
+
+from monitor.PoolSupervisor import WorkerPool, pool_bounds
+
+
+class FakeWorker:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def is_alive(self):
+        return self.running
+
+    def join(self, timeout=None):
+        pass
+
+
+def make_pool(backlog, min_size=1, max_size=3, cpu_bound=True, rate_window=0):
+    return WorkerPool('test', lambda x: FakeWorker(f'Worker{x}'), lambda: backlog[0], min_size, max_size, cpu_bound,
+                      rate_window)
+
+
+def test_pool_grows_with_backlog_up_to_max():
+    backlog = [10]
+    pool = make_pool(backlog)
+
+    for n in range(5):
+        for w in pool.workers:
+            w.processed += n + 1  # throughput keeps improving
+        pool.resize(cpu=10, memory=10, cpu_high=85, memory_high=90)
+
+    assert pool.size() == 3
+
+
+def test_pool_shrinks_when_idle():
+    backlog = [10]
+    pool = make_pool(backlog)
+    pool.resize(10, 10, 85, 90)
+    pool.resize(10, 10, 85, 90)
+    assert pool.size() == 2
+
+    backlog[0] = 0
+    pool.resize(10, 10, 85, 90)
+    pool.resize(10, 10, 85, 90)
+    assert pool.size() == 1
+
+
+def test_pool_does_not_grow_when_overloaded():
+    backlog = [10]
+    pool = make_pool(backlog)
+    pool.resize(10, 10, 85, 90)
+    assert pool.size() == 1
+
+    pool.resize(cpu=95, memory=10, cpu_high=85, memory_high=90)
+    assert pool.size() == 1
+
+    io_pool = make_pool(backlog, cpu_bound=False)
+    io_pool.resize(10, 10, 85, 90)
+    io_pool.resize(cpu=95, memory=10, cpu_high=85, memory_high=90)
+    assert io_pool.size() == 2
+
+
+def resize_every(pool, seconds, clock):
+    clock[0] += seconds
+    with patch('monitor.PoolSupervisor.time.monotonic', return_value=clock[0]):
+        pool.resize(10, 10, 85, 90)
+
+
+def test_pool_stops_growing_when_throughput_flat():
+    backlog = [10]
+    clock = [0]
+    with patch('monitor.PoolSupervisor.time.monotonic', return_value=0):
+        pool = make_pool(backlog, max_size=5)
+    resize_every(pool, 30, clock)
+    for _ in range(3):
+        pool.workers[0].processed += 1  # one item per evaluation whatever the pool size
+        resize_every(pool, 30, clock)
+
+    assert pool.size() == 2
+
+
+def test_pool_grows_without_completions():
+    # conversions take longer than an evaluation, there's no throughput to judge yet
+    backlog = [20]
+    pool = make_pool(backlog, max_size=4)
+    for _ in range(5):
+        pool.resize(10, 10, 85, 90)
+
+    assert pool.size() == 4
+
+
+def test_pool_waits_a_rate_window_after_growing():
+    backlog = [10]
+    clock = [0]
+    with patch('monitor.PoolSupervisor.time.monotonic', return_value=0):
+        pool = make_pool(backlog, max_size=5, rate_window=600)
+    resize_every(pool, 30, clock)
+    pool.workers[0].processed += 1
+    resize_every(pool, 30, clock)
+    assert pool.size() == 2
+
+    # the new worker can't show in the throughput yet
+    pool.workers[0].processed += 5
+    resize_every(pool, 30, clock)
+    assert pool.size() == 2
+
+    # a window later the throughput improved
+    pool.workers[1].processed += 20
+    resize_every(pool, 600, clock)
+    assert pool.size() == 3
+
+
+def test_pool_bounds():
+    config = {'monitor': {'pool': {'converters': {'min': 2, 'max': 6}, 'uploaders': {'min': 3, 'max': 1}}}}
+
+    assert pool_bounds(config, 'converters') == (2, 6)
+    assert pool_bounds(config, 'uploaders') == (3, 3)
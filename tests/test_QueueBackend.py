@@ -0,0 +1,140 @@
+import time
+from threading import Thread
+
+import pytest
+from botocore.exceptions import ClientError
+
+from monitor.QueueBackend import LocalQueueBackend, create_backend
+from monitor.QueueManager import QueueManager
+
+
+def test_send_receive_delete():
+    backend = LocalQueueBackend()
+    url = backend.create_queue(QueueName='q1')['QueueUrl']
+
+    backend.send_message_batch(url, [{'Id': str(i), 'MessageBody': f'msg{i}'} for i in range(3)])
+    assert backend.get_queue_attributes(url, ['ApproximateNumberOfMessages']) == \
+           {'Attributes': {'ApproximateNumberOfMessages': '3'}}
+
+    messages = backend.receive_message(url, MaxNumberOfMessages=2, VisibilityTimeout=60)['Messages']
+    assert [m['Body'] for m in messages] == ['msg0', 'msg1']
+    assert backend.get_queue_attributes(url, ['All'])['Attributes']['ApproximateNumberOfMessagesNotVisible'] == '2'
+
+    backend.delete_message_batch(url, [{'Id': '0', 'ReceiptHandle': messages[0]['ReceiptHandle']}])
+    assert backend.get_queue_attributes(url)['Attributes']['ApproximateNumberOfMessagesNotVisible'] == '1'
+
+
+def test_visibility_timeout():
+    backend = LocalQueueBackend()
+    url = backend.create_queue(QueueName='q1')['QueueUrl']
+    backend.send_message(url, 'msg0')
+
+    first = backend.receive_message(url, VisibilityTimeout=0.2)['Messages'][0]
+    assert backend.receive_message(url) == {}
+
+    # long polling wakes up when the message becomes visible again
+    second = backend.receive_message(url, WaitTimeSeconds=2)['Messages'][0]
+    assert second['MessageId'] == first['MessageId']
+    assert second['Attributes']['ApproximateReceiveCount'] == '2'
+
+    with pytest.raises(ClientError):
+        backend.change_message_visibility(url, first['ReceiptHandle'], 10)
+    backend.change_message_visibility(url, second['ReceiptHandle'], 0)
+    assert backend.receive_message(url)['Messages'][0]['Body'] == 'msg0'
+
+
+def test_change_visibility_batch():
+    backend = LocalQueueBackend()
+    url = backend.create_queue(QueueName='q1')['QueueUrl']
+    backend.send_message(url, 'msg0')
+    received = backend.receive_message(url, VisibilityTimeout=60)['Messages'][0]
+
+    response = backend.change_message_visibility_batch(url, [
+        {'Id': '0', 'ReceiptHandle': received['ReceiptHandle'], 'VisibilityTimeout': 0},
+        {'Id': '1', 'ReceiptHandle': 'unknown:1', 'VisibilityTimeout': 0}])
+
+    assert response['Successful'] == [{'Id': '0'}]
+    assert [f['Id'] for f in response['Failed']] == ['1']
+    assert backend.receive_message(url)['Messages'][0]['Body'] == 'msg0'
+
+
+def test_long_polling_wakes_on_send():
+    backend = LocalQueueBackend()
+    url = backend.create_queue(QueueName='q1')['QueueUrl']
+
+    Thread(target=lambda: time.sleep(0.2) or backend.send_message(url, 'late')).start()
+    start = time.monotonic()
+    assert backend.receive_message(url, WaitTimeSeconds=5)['Messages'][0]['Body'] == 'late'
+    assert time.monotonic() - start < 2
+
+
+def test_missing_queue():
+    backend = LocalQueueBackend()
+
+    with pytest.raises(ClientError) as ex:
+        backend.get_queue_url(QueueName='missing')
+    assert ex.value.response['Error']['Code'] == 'AWS.SimpleQueueService.NonExistentQueue'
+
+
+def test_journal_recovery(tmp_path):
+    journal = str(tmp_path / 'queues.jsonl')
+    backend = LocalQueueBackend(journal)
+    url = backend.create_queue(QueueName='q1')['QueueUrl']
+    backend.send_message_batch(url, [{'Id': str(i), 'MessageBody': f'msg{i}'} for i in range(3)])
+    received = backend.receive_message(url, MaxNumberOfMessages=2)['Messages']
+    backend.delete_message(url, received[0]['ReceiptHandle'])
+    backend.close()
+
+    # msg1 was received but not deleted before the crash
+    recovered = LocalQueueBackend(journal)
+    with open(journal) as f:
+        assert len(f.readlines()) == 3
+
+    messages = recovered.receive_message(url, MaxNumberOfMessages=10)['Messages']
+    assert sorted(m['Body'] for m in messages) == ['msg1', 'msg2']
+
+
+def test_journal_recovery_keeps_delay_and_receive_count(tmp_path):
+    journal = str(tmp_path / 'queues.jsonl')
+    backend = LocalQueueBackend(journal)
+    url = backend.create_queue(QueueName='q1')['QueueUrl']
+    backend.send_message(url, 'late', DelaySeconds=0.5)
+    backend.send_message(url, 'retried')
+    backend.receive_message(url)
+    backend.close()
+
+    for count in ['2', '3']:
+        # replayed from the operations, then from the compacted journal
+        recovered = LocalQueueBackend(journal)
+        messages = recovered.receive_message(url, MaxNumberOfMessages=10)['Messages']
+        assert [m['Body'] for m in messages] == ['retried']
+        assert messages[0]['Attributes']['ApproximateReceiveCount'] == count
+        recovered.close()
+
+    time.sleep(0.5)
+    recovered = LocalQueueBackend(journal)
+    messages = recovered.receive_message(url, MaxNumberOfMessages=10)['Messages']
+    assert sorted(m['Body'] for m in messages) == ['late', 'retried']
+
+
+def test_queue_manager_with_local_backend():
+    qm = QueueManager('test', host='local', wait_time=0, backend=create_backend({'aws': {'queue': {'backend': 'local'}}}))
+
+    assert qm.conversion_q() == 'local://MonitorConversionQueue-local-test'
+    assert qm.put_messages(qm.conversion_q(), ['a', 'b']) == 2
+    assert qm.get_size(qm.conversion_q()) == 2
+    assert qm.get_next_message(qm.conversion_q()) == 'a'
+    assert qm.get_next_message(qm.conversion_q()) == 'b'
+    assert qm.get_size(qm.conversion_q()) == 0
+
+
+def test_delayed_message():
+    backend = LocalQueueBackend()
+    url = backend.create_queue(QueueName='q1')['QueueUrl']
+    backend.send_message(url, 'late', DelaySeconds=0.2)
+    backend.send_message(url, 'early')
+
+    assert [m['Body'] for m in backend.receive_message(url, MaxNumberOfMessages=10)['Messages']] == ['early']
+    message = backend.receive_message(url, WaitTimeSeconds=2)['Messages'][0]
+    assert message['Body'] == 'late'
+    assert message['Attributes']['ApproximateReceiveCount'] == '1'
@@ -1,5 +1,9 @@
 import time
 
+from mock import patch
+
+from monitor.QueueManager import QueueManager, QueueDepthSampler, LeaseHeartbeat
+
 
 def test_create_queue_manager(test_qm):
     assert test_qm is not None
@@ -30,3 +34,181 @@ def test_put_receive_message(test_qm):
 
     assert data == msg
     assert test_qm.get_size(test_qm.conversion_q()) == 0
+
+
+def test_receive_messages_batch(test_qm):
+    msgs = [f'test message {x}' for x in range(12)]
+    for msg in msgs:
+        test_qm.put_message(test_qm.conversion_q(), msg)
+
+    data = test_qm.receive_messages(test_qm.conversion_q())
+
+    assert 0 < len(data) <= 10
+    assert all(d in msgs for d in data)
+
+    # the received batch was deleted, the rest is still in the queue
+    assert test_qm.get_size(test_qm.conversion_q()) == len(msgs) - len(data)
+
+
+def test_get_next_message_buffers_batch(test_qm):
+    msgs = [f'test message {x}' for x in range(3)]
+    for msg in msgs:
+        test_qm.put_message(test_qm.conversion_q(), msg)
+
+    received = [test_qm.get_next_message(test_qm.conversion_q()) for _ in msgs]
+
+    assert sorted(received) == msgs
+    assert test_qm.get_next_message(test_qm.conversion_q(), wait_time=0) == ''
+
+
+def test_queue_urls_are_cached(test_qm):
+    with patch.object(test_qm.sqs, 'get_queue_url', wraps=test_qm.sqs.get_queue_url) as get_url:
+        for _ in range(5):
+            test_qm.conversion_q()
+            test_qm.upload_q()
+
+    get_url.assert_not_called()
+
+
+def test_queue_url_refreshed_when_queue_missing(test_qm):
+    old_url = test_qm.conversion_q()
+    test_qm.sqs.delete_queue(QueueUrl=old_url)
+
+    test_qm.put_message(old_url, 'recreated')
+
+    assert test_qm.get_next_message(test_qm.conversion_q()) == 'recreated'
+
+
+def test_put_messages_batch(test_qm):
+    msgs = [f'test message {x}' for x in range(15)]
+
+    assert test_qm.put_messages(test_qm.conversion_q(), msgs) == 15
+    assert test_qm.get_size(test_qm.conversion_q()) == 15
+
+
+def test_depth_is_cached(test_qm):
+    test_qm.put_messages(test_qm.upload_q(), ['a', 'b', 'c'])
+    test_qm.sqs.receive_message(QueueUrl=test_qm.upload_q(), MaxNumberOfMessages=1, VisibilityTimeout=60)
+
+    assert test_qm.sample_depths()['upload'] == (2, 1)
+
+    with patch.object(test_qm.sqs, 'get_queue_attributes') as attributes:
+        assert test_qm.depth('upload') == 3
+        assert test_qm.depth('upload', inflight=False) == 2
+        assert test_qm.depth('conversion') == 0
+
+    attributes.assert_not_called()
+
+
+def test_depth_sampler(test_qm):
+    sampler = QueueDepthSampler(test_qm, interval=0.1)
+    sampler.start()
+    try:
+        test_qm.put_message(test_qm.conversion_q(), 'sample')
+        deadline = time.monotonic() + 5
+        while test_qm.depth('conversion') != 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert test_qm.depth('conversion') == 1
+    finally:
+        sampler.join(5)
+
+    assert not sampler.is_alive()
+
+
+def test_depth_sampler_joined_before_start(test_qm):
+    sampler = QueueDepthSampler(test_qm, interval=0.1)
+    # Monitor.join_threads during startup
+    sampler.running = False
+    sampler.join(0)
+
+    with patch.object(test_qm, 'sample_depths') as sample:
+        sampler.start()
+        sampler.join(5)
+
+    assert not sampler.is_alive()
+    sample.assert_not_called()
+
+
+def test_leased_message_is_acked_after_success(test_qm):
+    test_qm.leases = True
+    q = test_qm.conversion_q()
+    test_qm.put_message(q, 'sample1.d')
+
+    assert test_qm.next_message(q) == 'sample1.d'
+    assert test_qm.leased() == 1
+    assert test_qm.get_size(q) == 0
+
+    assert test_qm.ack(q, 'sample1.d') == 1
+    assert test_qm.leased() == 0
+    assert test_qm.sqs.get_queue_attributes(QueueUrl=q, AttributeNames=['ApproximateNumberOfMessagesNotVisible'])[
+               'Attributes']['ApproximateNumberOfMessagesNotVisible'] == '0'
+    # unknown messages are ignored
+    assert test_qm.ack(q, 'sample1.d') == 0
+
+
+def test_nacked_message_is_retried_until_max_receives(test_qm):
+    test_qm.leases = True
+    test_qm.max_receives = 2
+    q = test_qm.conversion_q()
+    test_qm.put_message(q, 'sample2.d')
+
+    assert test_qm.next_message(q) == 'sample2.d'
+    assert test_qm.nack(q, 'sample2.d', delay=0)
+
+    assert test_qm.next_message(q) == 'sample2.d'
+    assert not test_qm.nack(q, 'sample2.d', delay=0)
+
+    assert test_qm.next_message(q, wait_time=0) == ''
+    assert test_qm.leased() == 0
+
+
+def test_leases_are_extended_and_released(test_qm):
+    test_qm.leases = True
+    q = test_qm.upload_q()
+    test_qm.put_messages(q, ['a.mzml', 'b.mzml'])
+    test_qm.lease_messages(q)
+
+    with patch.object(test_qm.sqs, 'change_message_visibility_batch',
+                      wraps=test_qm.sqs.change_message_visibility_batch) as extend:
+        assert test_qm.extend_leases(older_than=0) == 2
+        assert test_qm.extend_leases(older_than=60) == 0
+
+    extend.assert_called_once()
+    assert all(e['VisibilityTimeout'] > 0 for e in extend.call_args.kwargs['Entries'])
+
+    assert test_qm.release_leases() == 2
+    assert test_qm.get_size(q) == 2
+
+
+def test_lease_heartbeat_stops(test_qm):
+    heartbeat = LeaseHeartbeat(test_qm, interval=0.1)
+    heartbeat.start()
+    heartbeat.join(5)
+
+    assert not heartbeat.is_alive()
+
+
+def test_fifo_queues_deduplicate_samples(mocks):
+    qm = QueueManager(stage='test', wait_time=1, fifo=True)
+    q = qm.conversion_q()
+    assert q.endswith('.fifo')
+
+    qm.put_message(q, '/data/sample1.d')
+    qm.put_messages(q, ['/data/sample1.d', '/data/sample2.d'])
+    assert qm.get_size(q) == 2
+
+    assert qm.get_next_message(q) == '/data/sample1.d'
+    assert qm.get_next_message(q) == '/data/sample2.d'
+
+    # a deferred sample is sent again even if its body was seen within the deduplication window
+    qm.defer(q, '/data/sample1.d')
+    assert qm.get_size(q) == 1
+
+
+def test_deferred_message_is_delayed(test_qm):
+    q = test_qm.conversion_q()
+    with patch.object(test_qm.sqs, 'send_message', wraps=test_qm.sqs.send_message) as send:
+        test_qm.defer(q, '/data/sample1.d', delay=5000)
+
+    assert send.call_args.kwargs['DelaySeconds'] == 900
+    assert test_qm.get_next_message(q) == ''
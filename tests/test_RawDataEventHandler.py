@@ -0,0 +1,66 @@
+import time
+
+from mock import MagicMock, patch
+from watchdog.events import DirCreatedEvent, DirMovedEvent, FileCreatedEvent
+
+from monitor.RawDataEventHandler import RawDataEventHandler
+from monitor.SampleFilter import SampleFilter
+
+
+def test_events_coalesced_by_sample():
+    queue_mgr = MagicMock()
+    handler = RawDataEventHandler(None, queue_mgr, ['.d', '.raw'], test=True, quiet_window=0.5)
+
+    handler.dispatch(DirCreatedEvent('/data/sample1.d'))
+    handler.dispatch(DirMovedEvent('/data/sample1.d', '/data/sample2.d'))
+    handler.dispatch(DirCreatedEvent('/data/sample2.d'))
+    handler.dispatch(FileCreatedEvent('/data/sample3.raw'))
+
+    time.sleep(1.5)
+    handler.stop()
+
+    sent = [args[1] for args, _ in queue_mgr.put_messages.call_args_list]
+    assert sent == [['/data/sample2.d', '/data/sample3.raw']]
+    queue_mgr.put_message.assert_not_called()
+
+
+def test_stop_flushes_pending_samples():
+    queue_mgr = MagicMock()
+    handler = RawDataEventHandler(None, queue_mgr, ['.d'], test=True, quiet_window=60)
+
+    handler.dispatch(DirCreatedEvent('/data/sample1.d'))
+    queue_mgr.put_message.assert_not_called()
+
+    handler.stop()
+
+    queue_mgr.put_message.assert_called_once_with(queue_mgr.conversion_q(), '/data/sample1.d')
+
+
+def test_rejected_samples_not_queued():
+    queue_mgr = MagicMock()
+    handler = RawDataEventHandler(None, queue_mgr, ['.d'], test=True, quiet_window=60,
+                                  sample_filter=SampleFilter(['preinj'], ['.d']))
+
+    handler.dispatch(DirCreatedEvent('/data/preinj_01.d'))
+    handler.dispatch(FileCreatedEvent('/data/sample1.raw'))
+    handler.stop()
+
+    queue_mgr.put_message.assert_not_called()
+    queue_mgr.put_messages.assert_not_called()
+    assert handler.filter.stats() == {'skip:preinj': 1, 'extension': 1}
+
+
+def test_flusher_waits_for_new_samples():
+    queue_mgr = MagicMock()
+    handler = RawDataEventHandler(None, queue_mgr, ['.d'], test=True, quiet_window=0.3)
+
+    with patch.object(handler, 'flush', wraps=handler.flush) as flush:
+        # idle, the flusher doesn't wake up
+        time.sleep(0.7)
+        assert flush.call_count == 0
+
+        handler.dispatch(DirCreatedEvent('/data/sample1.d'))
+        time.sleep(0.5)
+        queue_mgr.put_message.assert_called_once_with(queue_mgr.conversion_q(), '/data/sample1.d')
+
+    handler.stop()
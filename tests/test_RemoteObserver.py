@@ -0,0 +1,81 @@
+import os
+import time
+from queue import Queue
+
+from watchdog.events import DirCreatedEvent, FileCreatedEvent, FileDeletedEvent
+from watchdog.observers.api import ObservedWatch
+
+from monitor.RemoteObserver import RemoteEmitter, RemoteObserver
+
+
+def make_emitter(path, max_depth=None):
+    emitter = RemoteEmitter(Queue(), ObservedWatch(str(path), recursive=True), timeout=0.1, max_depth=max_depth)
+    emitter.on_thread_start()
+    return emitter
+
+
+def test_bundles_are_opaque(tmp_path):
+    (tmp_path / 'plate1' / 'sample1.d' / 'AcqData').mkdir(parents=True)
+    emitter = make_emitter(tmp_path)
+
+    assert sorted(emitter._dirs) == [str(tmp_path), str(tmp_path / 'plate1')]
+
+    (tmp_path / 'plate1' / 'sample1.d' / 'AcqData' / 'data.ms').write_text('x')
+    assert emitter.poll() == []
+
+
+def test_only_changed_folders_are_listed(tmp_path, monkeypatch):
+    (tmp_path / 'plate1').mkdir()
+    (tmp_path / 'plate2').mkdir()
+    emitter = make_emitter(tmp_path)
+
+    # let the recent changes settle
+    for d in [tmp_path, tmp_path / 'plate1', tmp_path / 'plate2']:
+        os.utime(d, (time.time() - 60, time.time() - 60))
+    emitter.poll()
+
+    listed = []
+    original = RemoteEmitter._list
+    monkeypatch.setattr(RemoteEmitter, '_list', staticmethod(lambda f: listed.append(f) or original(f)))
+
+    (tmp_path / 'plate2' / 'sample2.raw').write_text('x')
+    (tmp_path / 'plate3' / 'sample3.d').mkdir(parents=True)
+
+    events = emitter.poll()
+
+    assert str(tmp_path / 'plate1') not in listed
+    assert FileCreatedEvent(str(tmp_path / 'plate2' / 'sample2.raw')) in events
+    assert DirCreatedEvent(str(tmp_path / 'plate3')) in events
+    assert DirCreatedEvent(str(tmp_path / 'plate3' / 'sample3.d')) in events
+
+    os.remove(tmp_path / 'plate2' / 'sample2.raw')
+    assert FileDeletedEvent(str(tmp_path / 'plate2' / 'sample2.raw')) in emitter.poll()
+
+
+def test_max_depth(tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    emitter = make_emitter(tmp_path, max_depth=1)
+
+    assert sorted(emitter._dirs) == [str(tmp_path), str(tmp_path / 'a')]
+
+
+def test_observer_dispatches_events(tmp_path):
+    received = []
+
+    class Handler:
+        def dispatch(self, event):
+            received.append(event)
+
+    observer = RemoteObserver(timeout=0.2, intervals={str(tmp_path): 0.1})
+    observer.schedule(Handler(), str(tmp_path), recursive=True)
+    observer.start()
+    try:
+        assert next(iter(observer.emitters)).timeout == 0.1
+        time.sleep(0.5)
+        (tmp_path / 'sample1.raw').write_text('x')
+        time.sleep(1)
+    finally:
+        observer.stop()
+        observer.join()
+
+    assert FileCreatedEvent(str(tmp_path / 'sample1.raw')) in received
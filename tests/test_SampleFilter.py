@@ -0,0 +1,41 @@
+from monitor.SampleFilter import SampleFilter
+
+SKIP = ['\\.scan', '/(?:.*?)?[ _-]?DNU[ _-]?(?:.*?)', 'preinj']
+
+
+def test_accepts_valid_samples():
+    sample_filter = SampleFilter(SKIP, ['.d', '.raw'])
+
+    assert sample_filter.accepts('/data/sample1.d')
+    assert sample_filter.accepts('/data/sample2.raw')
+    assert sample_filter.stats() == {'accepted': 2}
+
+
+def test_extensions_are_case_insensitive():
+    sample_filter = SampleFilter(SKIP, ['.d', '.raw', '.mzml'])
+
+    assert sample_filter.accepts('C:\\data\\SAMPLE01.RAW')
+    assert sample_filter.accepts('/data/s.D')
+    assert sample_filter.accepts('/data/s.mzML')
+    assert sample_filter.stats() == {'accepted': 3}
+
+
+def test_rejects_by_rule():
+    sample_filter = SampleFilter(SKIP, ['.d', '.raw'])
+
+    assert sample_filter.check('/data/sample1.d/AcqData/data.ms') == 'type'
+    assert sample_filter.check('/data/sample2.wiff') == 'extension'
+    assert sample_filter.check('/data/preinj_01.raw') == 'skip:preinj'
+    assert sample_filter.check('/data/DNU_sample3.d') == f'skip:{SKIP[1]}'
+    assert sample_filter.check('/data/sample4.raw') is None
+
+    assert sample_filter.stats() == {'type': 1, 'extension': 1, 'skip:preinj': 1, f'skip:{SKIP[1]}': 1,
+                                     'accepted': 1}
+
+
+def test_patterns_that_cant_be_combined():
+    sample_filter = SampleFilter(['(?i)blank', 'preinj'])
+
+    assert sample_filter.check('/data/BLANK_01.raw') == 'skip:(?i)blank'
+    assert sample_filter.check('/data/preinj_01.raw') == 'skip:preinj'
+    assert sample_filter.accepts('/data/sample.wiff')
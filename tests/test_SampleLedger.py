@@ -0,0 +1,94 @@
+import json
+import os
+from threading import Thread
+
+from mock import patch
+
+from monitor.SampleLedger import SampleLedger, DONE
+
+
+def test_done_until_sample_changes(tmp_path):
+    sample = tmp_path / 'sample1.raw'
+    sample.write_bytes(b'x' * 1000)
+    ledger = SampleLedger(str(tmp_path / 'ledger.db'), args='--mzML')
+
+    assert not ledger.is_done(str(sample))
+
+    ledger.record(str(sample), 'converted')
+    assert not ledger.is_done(str(sample))
+
+    assert ledger.mark('sample1', DONE) == 1
+    assert ledger.is_done(str(sample))
+    assert not ledger.is_done(str(sample), args='--mzXML')
+
+    # touched but same content
+    os.utime(sample, ns=(0, 0))
+    assert ledger.is_done(str(sample))
+
+    sample.write_bytes(b'y' * 2000)
+    assert not ledger.is_done(str(sample))
+
+
+def test_folder_samples(tmp_path):
+    sample = tmp_path / 'sample2.d'
+    (sample / 'AcqData').mkdir(parents=True)
+    (sample / 'AcqData' / 'data.ms').write_bytes(b'x' * 100)
+    ledger = SampleLedger(str(tmp_path / 'ledger.db'))
+
+    ledger.record(str(sample), DONE)
+    assert ledger.get(str(sample))['sample'] == 'sample2'
+    assert ledger.is_done(str(sample))
+
+    (sample / 'AcqData' / 'more.ms').write_bytes(b'x')
+    assert not ledger.is_done(str(sample))
+
+
+def test_folder_check_does_not_walk_the_tree(tmp_path):
+    sample = tmp_path / 'sample3.d'
+    (sample / 'AcqData' / 'deep').mkdir(parents=True)
+    (sample / 'AcqData' / 'deep' / 'data.ms').write_bytes(b'x' * 100)
+    ledger = SampleLedger(str(tmp_path / 'ledger.db'))
+    ledger.record(str(sample), DONE)
+
+    with patch('monitor.SampleLedger.os.walk', side_effect=AssertionError('walked')):
+        assert ledger.is_done(str(sample))
+
+    # the acquisition data changed, the tree is walked
+    (sample / 'AcqData' / 'MSScan.bin').write_bytes(b'x')
+    assert not ledger.is_done(str(sample))
+
+
+def test_concurrent_writers(tmp_path):
+    ledger = SampleLedger(str(tmp_path / 'ledger.db'))
+
+    def write(x):
+        for i in range(50):
+            ledger.record(str(tmp_path / f'sample_{x}_{i}.raw'), 'failed')
+
+    threads = [Thread(target=write, args=(x,)) for x in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert ledger.count() == 400
+
+
+def test_compact_and_export(tmp_path):
+    done = tmp_path / 'done.raw'
+    done.write_bytes(b'x')
+    ledger = SampleLedger(str(tmp_path / 'ledger.db'))
+    ledger.record(str(done), DONE)
+    ledger.record(str(tmp_path / 'failed.raw'), 'failed')
+    ledger.record(str(tmp_path / 'gone.raw'), DONE)
+
+    assert ledger.compact() == 2
+    assert ledger.count() == 1
+
+    assert ledger.export(str(tmp_path / 'ledger.jsonl')) == 1
+    with open(tmp_path / 'ledger.jsonl') as f:
+        assert json.loads(f.readline())['sample'] == 'done'
+
+    assert ledger.export(str(tmp_path / 'ledger.csv')) == 1
+    with open(tmp_path / 'ledger.csv') as f:
+        assert f.readline().startswith('path,sample,size')
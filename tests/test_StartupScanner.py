@@ -0,0 +1,100 @@
+import os
+import time
+
+from mock import MagicMock, patch
+
+from monitor.SampleFilter import SampleFilter
+from monitor.StartupScanner import StartupScanner
+
+
+def test_scan_queues_samples(tmp_path):
+    (tmp_path / 'plate1' / 'sample1.d' / 'AcqData').mkdir(parents=True)
+    (tmp_path / 'plate1' / 'sample1.d' / 'AcqData' / 'nested.raw').write_text('x')
+    (tmp_path / 'plate1' / 'preinj_01.d').mkdir()
+    (tmp_path / 'plate2' / 'deep').mkdir(parents=True)
+    (tmp_path / 'plate2' / 'deep' / 'sample2.raw').write_text('x')
+    (tmp_path / 'plate2' / 'notes.txt').write_text('x')
+
+    queue_mgr = MagicMock()
+    queue_mgr.put_messages.side_effect = lambda url, batch: len(batch)
+
+    scanner = StartupScanner(queue_mgr, [str(tmp_path), str(tmp_path / 'missing')],
+                             SampleFilter(['preinj'], ['.d', '.raw']), workers=3)
+    scanner.start()
+    scanner.join(10)
+
+    assert not scanner.is_alive()
+    sent = sorted(s for args, _ in queue_mgr.put_messages.call_args_list for s in args[1])
+    assert sent == [str(tmp_path / 'plate1' / 'sample1.d'), str(tmp_path / 'plate2' / 'deep' / 'sample2.raw')]
+
+    stats = scanner.stats()
+    # sample folders are never descended into
+    assert stats['dirs'] == 4
+    assert stats['files'] == 2
+    assert stats['samples'] == 2
+    assert stats['errors'] == 0
+
+
+def scan_sent(data, checkpoint):
+    queue_mgr = MagicMock()
+    queue_mgr.put_messages.side_effect = lambda url, batch: len(batch)
+    scanner = StartupScanner(queue_mgr, [str(data)], SampleFilter([], ['.d', '.raw']), workers=2,
+                             checkpoint=checkpoint)
+    scanner.start()
+    scanner.join(10)
+    return sorted(s for args, _ in queue_mgr.put_messages.call_args_list for s in args[1])
+
+
+@patch('monitor.StartupScanner.CHECKPOINT_SKEW', 0)
+def test_scan_skips_samples_older_than_last_scan(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    (data / 'old.raw').write_text('x')
+    checkpoint = str(tmp_path / 'last-scan')
+
+    def scan():
+        queue_mgr = MagicMock()
+        queue_mgr.put_messages.side_effect = lambda url, batch: len(batch)
+        scanner = StartupScanner(queue_mgr, [str(data)], SampleFilter([], ['.d', '.raw']), workers=2,
+                                 checkpoint=checkpoint)
+        scanner.start()
+        scanner.join(10)
+        return scanner, sorted(s for args, _ in queue_mgr.put_messages.call_args_list for s in args[1])
+
+    # no checkpoint yet, everything is queued
+    scanner, sent = scan()
+    assert scanner.cutoff is None
+    assert sent == [str(data / 'old.raw')]
+
+    (data / 'new.d').mkdir()
+    scanner, sent = scan()
+    assert scanner.cutoff is not None
+    assert sent == [str(data / 'new.d')]
+    assert scanner.stats()['old'] == 1
+
+
+@patch('monitor.StartupScanner.CHECKPOINT_SKEW', 0)
+def test_scan_queues_bundles_written_to_after_last_scan(tmp_path):
+    data = tmp_path / 'data'
+    for name in ['idle.d', 'acquiring.d']:
+        (data / name / 'AcqData').mkdir(parents=True)
+        (data / name / 'AcqData' / 'MSScan.bin').write_text('x')
+    checkpoint = tmp_path / 'last-scan'
+    cutoff = time.time() + 1000
+    checkpoint.write_text(str(cutoff))
+
+    # only a file inside AcqData changes, the bundle folder itself keeps its times
+    os.utime(data / 'acquiring.d' / 'AcqData' / 'MSScan.bin', (cutoff + 10, cutoff + 10))
+
+    assert scan_sent(data, str(checkpoint)) == [str(data / 'acquiring.d')]
+
+
+def test_scan_checkpoint_allows_for_clock_skew(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    (data / 'sample.raw').write_text('x')
+    checkpoint = tmp_path / 'last-scan'
+    # a share whose clock is behind the monitor's
+    checkpoint.write_text(str(time.time() + 60))
+
+    assert scan_sent(data, str(checkpoint)) == [str(data / 'sample.raw')]
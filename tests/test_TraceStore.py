@@ -0,0 +1,71 @@
+import os
+import time
+
+import pytest
+
+from monitor.TraceStore import TraceStore, percentile, format_report, traced
+
+
+@pytest.fixture
+def traces(tmp_path):
+    return TraceStore(str(tmp_path / 'traces.db'), roots=[os.path.join('data', 'qtof')])
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 99) == 99
+    assert percentile([7], 99) == 7
+
+
+def test_lifecycle_joins_converted_files(traces):
+    raw = os.path.join('data', 'qtof', 'plate1', 'sample1.d')
+
+    traces.event(raw, 'enqueue')
+    traces.event(raw, 'dequeue', since='enqueue')
+    with traces.span(raw, 'msconvert'):
+        pass
+    with traces.span('sample1.mzml', 'upload'):
+        pass
+    with pytest.raises(ValueError):
+        with traces.span('sample1', 'status', 'uploaded_raw'):
+            raise ValueError()
+
+    spans = traces.lifecycle('sample1')
+    assert [s['stage'] for s in spans] == ['enqueue', 'dequeue', 'msconvert', 'upload', 'status']
+    assert spans[0]['instrument'] == os.path.normcase(os.path.join('data', 'qtof'))
+    assert spans[3]['instrument'] is None
+    assert spans[4]['outcome'] == 'ValueError'
+    assert spans[4]['detail'] == 'uploaded_raw'
+
+
+def test_report(traces):
+    now = time.time()
+    for i in range(1, 11):
+        raw = os.path.join('data', 'qtof', f'sample{i}.raw')
+        traces.add(raw, 'settle', now - 100, now - 50)
+        traces.add(raw, 'msconvert', now - 50, now - 50 + i)
+        traces.add(f'sample{i}.mzml', 'upload', now - 40, now - 30)
+    traces.add(os.path.join('other', 'sample0.raw'), 'msconvert', now - 10, now - 5, outcome='CalledProcessError')
+    traces.add(os.path.join('data', 'qtof', 'old.raw'), 'msconvert', now - 7200, now - 3600)
+
+    report = traces.report(since=now - 3600)
+    rows = {(r['stage'], r['instrument']): r for r in report}
+    qtof = os.path.normcase(os.path.join('data', 'qtof'))
+
+    assert [r['stage'] for r in report] == ['settle', 'msconvert', 'msconvert', 'upload', 'total']
+    assert rows[('msconvert', qtof)]['count'] == 10
+    assert rows[('msconvert', qtof)]['p50'] == pytest.approx(5)
+    assert rows[('msconvert', qtof)]['p95'] == pytest.approx(10)
+    assert rows[('msconvert', 'other')]['failed'] == 1
+    # uploads are reported under the instrument of the raw data file
+    assert rows[('upload', qtof)]['count'] == 10
+    assert rows[('total', qtof)]['p99'] == pytest.approx(20)
+
+    assert 'msconvert' in format_report(report)
+
+
+def test_traced_without_store():
+    with traced(None, 'sample1', 'upload'):
+        pass
@@ -1,8 +1,10 @@
 import logging
 import os
+import subprocess
 import tempfile
 
 import psutil as psutil
+from mock import MagicMock, patch
 
 from monitor.workers.PwizWorker import PwizWorker
 
@@ -79,3 +81,82 @@ def test_pwizworker_skip_file_not_in_aws(mocks, backend_cli, wconfig, test_qm):
 
     test_qm.clean(test_qm.conversion_q())
     test_qm.clean(test_qm.upload_q())
+
+
+def run_once(tmp_path, error):
+    sample = tmp_path / 'sample1.raw'
+    sample.write_bytes(b'x')
+    config = {'debug': False, 'test': True,
+              'monitor': {'storage': str(tmp_path), 'skip': [], 'extensions': ['.raw'], 'msconvert': 'msconvert',
+                          'exists': False, 'update_new': False},
+              'aws': {'bucket_name': 'data-carrot'}}
+    queue_mgr = MagicMock()
+    settler = MagicMock()
+    worker = PwizWorker(MagicMock(), MagicMock(), queue_mgr, config, settler=settler, bucket=MagicMock())
+    items = [str(sample)]
+
+    def get_ready():
+        if items:
+            return items.pop()
+        worker.running = False
+        return ''
+
+    settler.get_ready.side_effect = get_ready
+
+    with patch.object(worker, 'convert', side_effect=error):
+        worker.run()
+    return queue_mgr, str(sample)
+
+
+def test_msconvert_failure_is_acked(tmp_path):
+    error = subprocess.CalledProcessError(1, 'msconvert', output=b'', stderr=b'bad file')
+    queue_mgr, sample = run_once(tmp_path, error)
+
+    queue_mgr.ack.assert_called_once_with(queue_mgr.conversion_q(), sample)
+    queue_mgr.nack.assert_not_called()
+
+
+def test_transient_failure_is_retried(tmp_path):
+    queue_mgr, sample = run_once(tmp_path, OSError('network share went away'))
+
+    queue_mgr.nack.assert_called_once_with(queue_mgr.conversion_q(), sample)
+    queue_mgr.ack.assert_not_called()
+
+
+def stream_worker(tmp_path, upload):
+    msconvert = tmp_path / 'msconvert'
+    msconvert.write_text('#!/bin/sh\nhead -c 300000 /dev/zero\n')
+    msconvert.chmod(0o755)
+    config = {'debug': False, 'test': True,
+              'monitor': {'storage': str(tmp_path), 'skip': [], 'extensions': ['.raw'], 'msconvert': str(msconvert),
+                          'stream_upload': True},
+              'aws': {'bucket_name': 'data-carrot'}}
+    bucket = MagicMock()
+    bucket.save_stream.side_effect = upload
+    return PwizWorker(MagicMock(), MagicMock(), MagicMock(), config, bucket=bucket)
+
+
+def test_streamed_sample_is_not_written_locally(tmp_path):
+    received = []
+    worker = stream_worker(tmp_path, lambda key, stream, progress: received.append(len(stream.read())))
+    worker.convert = MagicMock()
+
+    worker.convert_stream('sample1', 'raw', str(tmp_path / 'sample1.raw'))
+
+    assert received == [300000]
+    worker.convert.assert_not_called()
+    assert not os.path.exists(os.path.join(tempfile.gettempdir(), 'sample1.mzml'))
+
+
+def test_failed_stream_is_converted_locally(tmp_path):
+    def broken_upload(key, stream, progress):
+        stream.read(1000)
+        raise ConnectionResetError('reset by peer')
+
+    worker = stream_worker(tmp_path, broken_upload)
+    worker.convert = MagicMock()
+
+    worker.convert_stream('sample1', 'raw', str(tmp_path / 'sample1.raw'))
+
+    worker.convert.assert_called_once_with('sample1', 'raw', str(tmp_path / 'sample1.raw'))
+    assert not os.path.exists(os.path.join(tempfile.gettempdir(), 'sample1.mzml'))
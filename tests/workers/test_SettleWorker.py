@@ -0,0 +1,140 @@
+import os
+import time
+
+from mock import MagicMock, patch
+
+from monitor.workers.SettleWorker import SettleWorker, take_snapshot
+
+
+def settle_config(interval):
+    return {'debug': False, 'test': True, 'monitor': {'settle_interval': interval}}
+
+
+def test_take_snapshot(tmp_path):
+    sample = tmp_path / 'sample.d'
+    (sample / 'AcqData').mkdir(parents=True)
+    (sample / 'AcqData' / 'MSScan.bin').write_bytes(b'x' * 10)
+    (sample / 'checksum.xml').write_bytes(b'x' * 5)
+
+    size, count, newest = take_snapshot(str(sample))
+
+    assert size == 15
+    assert count == 2
+    assert newest == max(os.stat(sample / 'checksum.xml').st_mtime_ns,
+                         os.stat(sample / 'AcqData' / 'MSScan.bin').st_mtime_ns)
+
+
+def test_old_sample_is_ready_immediately(tmp_path):
+    sample = tmp_path / 'old.raw'
+    sample.write_bytes(b'x' * 10)
+    os.utime(sample, (time.time() - 3600, time.time() - 3600))
+
+    settler = SettleWorker(None, MagicMock(), settle_config(60))
+    settler.track(str(sample))
+
+    assert settler.get_ready(timeout=0) == str(sample)
+    assert settler.pending() == 0
+
+
+def test_sample_ready_after_it_stops_changing(tmp_path):
+    sample = tmp_path / 'growing.raw'
+    sample.write_bytes(b'x' * 10)
+
+    settler = SettleWorker(None, MagicMock(), settle_config(0.2))
+    settler.track(str(sample))
+    assert settler.pending() == 1
+
+    time.sleep(0.3)
+    sample.write_bytes(b'x' * 20)
+    settler.check_due()
+    assert settler.get_ready(timeout=0) == ''
+
+    time.sleep(0.3)
+    settler.check_due()
+    assert settler.get_ready(timeout=0) == str(sample)
+    assert settler.pending() == 0
+
+
+def test_disappeared_sample_is_acked(tmp_path):
+    sample = tmp_path / 'deleted.raw'
+    sample.write_bytes(b'x' * 10)
+    queue_mgr = MagicMock()
+
+    settler = SettleWorker(None, queue_mgr, settle_config(0.1))
+    settler.track(str(sample))
+    sample.unlink()
+
+    time.sleep(0.2)
+    settler.check_due()
+
+    queue_mgr.ack.assert_called_once_with(queue_mgr.conversion_q(), str(sample))
+    assert settler.pending() == 0
+
+
+def test_incremental_snapshot(tmp_path):
+    sample = tmp_path / 'sample.d'
+    (sample / 'AcqData').mkdir(parents=True)
+    scan = sample / 'AcqData' / 'MSScan.bin'
+    scan.write_bytes(b'x' * 10)
+    cache = {}
+
+    assert take_snapshot(str(sample), cache)[:2] == (10, 1)
+
+    # the file keeps growing in a folder that didn't change
+    with open(scan, 'ab') as f:
+        f.write(b'x' * 5)
+    assert take_snapshot(str(sample), cache)[:2] == (15, 1)
+
+    (sample / 'AcqData' / 'MSPeak.bin').write_bytes(b'x' * 3)
+    assert take_snapshot(str(sample), cache) == take_snapshot(str(sample))
+
+    # unchanged folders are not listed again
+    with patch('monitor.workers.SettleWorker.os.scandir', side_effect=AssertionError('listed')):
+        assert take_snapshot(str(sample), cache)[:2] == (18, 2)
+
+
+def test_sample_growing_again_after_a_quiet_check(tmp_path):
+    sample = tmp_path / 'sample.d'
+    (sample / 'AcqData').mkdir(parents=True)
+    scan = sample / 'AcqData' / 'MSScan.bin'
+    scan.write_bytes(b'x' * 4)
+
+    config = settle_config(0.2)
+    config['monitor']['settle_checks'] = 2
+    settler = SettleWorker(None, MagicMock(), config)
+    settler.track(str(sample))
+
+    # one quiet check
+    time.sleep(0.3)
+    settler.check_due()
+    assert settler.pending() == 1
+
+    # the acquisition resumes, appending doesn't change the folder's mtime
+    with open(scan, 'ab') as f:
+        f.write(b'x' * 2)
+    time.sleep(0.3)
+    settler.check_due()
+    assert settler.pending() == 1
+    assert settler._tracked[str(sample)]['snapshot'][0] == 6
+
+    time.sleep(0.3)
+    settler.check_due()
+    time.sleep(0.3)
+    settler.check_due()
+    assert settler.get_ready(timeout=0) == str(sample)
+
+
+def test_intake_is_bounded(tmp_path):
+    config = settle_config(60)
+    config['monitor']['settle_capacity'] = 2
+    settler = SettleWorker(None, MagicMock(), config)
+
+    for name in ['a.raw', 'b.raw']:
+        (tmp_path / name).write_bytes(b'x')
+        os.utime(tmp_path / name, (time.time() - 3600, time.time() - 3600))
+        assert settler.has_room()
+        settler.track(str(tmp_path / name))
+
+    assert not settler.has_room()
+    assert settler.get_ready(timeout=0)
+    assert settler.has_room()